@@ -5,11 +5,18 @@ import asyncio
 import aiohttp
 import requests
 from aiohttp import ClientTimeout
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_from_directory, Response
 from flask_cors import CORS
 import threading
 import time
 
+from client_registry import ClientRegistry
+from registry_persistence import RegistryPersister
+from probe_scheduler import ProbeScheduler
+from metrics_exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsExporter, add_process_metrics
+from slow_requests import SlowRequestLog
+from stack_profiler import profile_request
+
 app = Flask(__name__)
 CORS(app)
 
@@ -21,6 +28,9 @@ except ImportError:
     PERFORMANCE_MONITORING = False
     monitor = None
 
+# 慢请求记录：阈值由 SLOW_REQUEST_SECONDS / SLOW_REQUEST_THRESHOLDS 配置，SLOW_REQUEST_SPILL=1 时另写入 logs/slow_master.jsonl
+slow_log = SlowRequestLog.from_env('master')
+
 @app.before_request
 def before_request():
     """请求前处理：记录开始时间"""
@@ -32,27 +42,28 @@ def after_request(response):
     """请求后处理：记录性能数据"""
     if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
         response_time = time.time() - request.start_time
-        endpoint = f"{request.method} {request.path}"
+        # 按路由模板统计（如 /api/send/<ip>），避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
         is_error = response.status_code >= 400
         monitor.record_request(endpoint, response_time, is_error)
+        # 超过路由阈值的请求连同分阶段耗时与参数摘要写入慢请求记录
+        slow_log.observe(endpoint, response_time, response.status_code, request,
+                         getattr(request, 'trace', None), getattr(request, 'slow_info', None))
     return response
 
 IPS_FILE = "ips.json"
-ip_list = []
-
-def load_ips_from_file():
-    global ip_list
-    if os.path.exists(IPS_FILE):
-        with open(IPS_FILE, "r", encoding="utf-8") as f:
-            ip_list = json.load(f)
-    else:
-        ip_list = []
-
-def save_ips_to_file():
-    with open(IPS_FILE, "w", encoding="utf-8") as f:
-        json.dump(ip_list, f, ensure_ascii=False, indent=2)
+# 同一 PC 名称只保留最新注册的 IP
+registry = ClientRegistry(replace_same_name=True)
 
-load_ips_from_file()
+# 注册表变化由后台线程防抖后原子写盘（与 app_server.py 相同）
+persister = RegistryPersister(
+    registry, IPS_FILE,
+    debounce=float(os.environ.get('IPS_SAVE_DEBOUNCE', '1.0')),
+    journal_path=os.environ.get('IPS_JOURNAL') or None
+)
+persister.load()
+persister.start()
 
 @app.route('/')
 def index():
@@ -60,18 +71,17 @@ def index():
 
 @app.route('/api/get_json_ips', methods=['GET'])
 def get_json_ips():
-    return jsonify({"status": "success", "ips": ip_list})
+    return jsonify({"status": "success", "ips": registry.snapshot()})
 
 @app.route('/api/ips', methods=['GET'])
 def get_ips():
-    return jsonify(ip_list)
+    return jsonify(registry.snapshot())
 
 @app.route('/api/ips', methods=['POST'])
 def add_ip():
     data = request.get_json() or {}
     new_ip = data.get('ip')
     pc_name = data.get('pc_name')
-    global ip_list
 
     # 验证IP格式
     if not new_ip:
@@ -85,22 +95,15 @@ def add_ip():
     except (ValueError, AttributeError):
         return jsonify({"status": "error", "message": "Invalid IP format"}), 400
 
-    # 如果已有相同的 pc_name，就先把旧记录删掉
-    ip_list = [e for e in ip_list if e.get('pc_name') != pc_name]
+    # 如果已有相同的 pc_name，注册表会先把旧记录删掉；没有变化时不写文件
+    registry.upsert(new_ip, pc_name)
 
-    # 新增 IP
-    if new_ip:
-        ip_list.append({'ip': new_ip, 'pc_name': pc_name})
-        save_ips_to_file()
-
-    return jsonify({"status": "success", "ips": ip_list})
+    return jsonify({"status": "success", "ips": registry.snapshot()})
 
 @app.route('/api/ips/<ip>', methods=['DELETE'])
 def delete_ip(ip):
-    global ip_list
-    ip_list = [e for e in ip_list if e['ip'] != ip]
-    save_ips_to_file()
-    return jsonify({"status": "success", "ips": ip_list})
+    registry.remove(ip)
+    return jsonify({"status": "success", "ips": registry.snapshot()})
 
 def send_post_request(ip, key='f7'):
     try:
@@ -113,10 +116,24 @@ def send_post_request(ip, key='f7'):
     except Exception as e:
         return {"ip": ip, "status": "error", "message": str(e)}
 
+def _record_dispatch(results):
+    """按结果统计指令下发：success / timeout / error"""
+    if not PERFORMANCE_MONITORING:
+        return
+    for result in results:
+        if result["status"] == "success":
+            outcome = "success"
+        elif "timed out" in result.get("message", ""):
+            outcome = "timeout"
+        else:
+            outcome = "error"
+        monitor.count('dispatch', outcome=outcome)
+
 @app.route('/api/send/<ip>', methods=['POST'])
 def send_request(ip):
     key = (request.get_json() or {}).get("key", "f7")
     result = send_post_request(ip, key)
+    _record_dispatch([result])
     return jsonify(result), (200 if result["status"]=="success" else 500)
 
 # 异步并发方案
@@ -148,22 +165,32 @@ async def _send_all(ip_snapshot, key):
 def send_request_all():
     data = request.get_json() or {}
     key = data.get("key", "f7")
-    snapshot = list(ip_list)
+    snapshot = registry.snapshot()
     results = asyncio.run(_send_all(snapshot, key))
+    _record_dispatch(results)
     return jsonify(results)
 
+# 后台可达性探测（与 app_server.py 相同），test_all 默认返回缓存结果
+prober = ProbeScheduler(
+    lambda: [entry['ip'] for entry in registry.snapshot()],
+    interval=float(os.environ.get('PROBE_INTERVAL', '60')),
+    rate=float(os.environ.get('PROBE_RATE', '20')),
+    timeout=1
+)
+prober.start()
+
 @app.route('/api/test/<ip>', methods=['GET'])
 def test_request(ip):
-    try:
-        resp = requests.get(f'http://{ip}:5000/test', timeout=1)
-        return jsonify({"ip": ip, "status": "success", "response": resp.text}), 200
-    except Exception as e:
-        return jsonify({"ip": ip, "status": "error", "message": str(e)}), 500
+    result = prober.probe_now([ip])[0]
+    return jsonify(result), 200 if result["status"] == "success" else 500
 
 @app.route('/api/test_all', methods=['GET'])
 def test_request_all():
-    results = [ test_request(e['ip'])[0].get_json() for e in ip_list ]
-    return jsonify(results)
+    targets = [e['ip'] for e in registry.snapshot()]
+    if request.args.get('refresh') == '1':
+        # 等待时间按客户端数量与并发数估算（见 ProbeScheduler.probe_duration）
+        return jsonify(prober.probe_now(targets))
+    return jsonify(prober.results(targets))
 
 @app.route('/api/server_info', methods=['GET'])
 def server_info():
@@ -178,7 +205,8 @@ def health_check():
         'timestamp': time.time(),
         'server_name': socket.gethostname(),
         'server_ips': socket.gethostbyname_ex(socket.gethostname())[2],
-        'client_count': len(ip_list)
+        'client_count': len(registry),
+        'probe': prober.get_stats()
     }
     if PERFORMANCE_MONITORING:
         health_status['performance'] = monitor.get_stats()
@@ -200,6 +228,45 @@ def reset_stats():
     monitor.reset_stats()
     return jsonify({"status": "success", "message": "Performance stats reset."}), 200
 
+# Prometheus 指标
+metrics = add_process_metrics(MetricsExporter('master', monitor))
+metrics.gauge('clients_registered', 'Clients in the registry', lambda: len(registry))
+metrics.gauge('persistence_pending_journal_records', 'Registry changes waiting to be written',
+              lambda: persister.get_stats()['pending_journal_records'])
+metrics.gauge('probe_clients', 'Probe cache by reachability',
+              lambda: [({'state': 'reachable'}, prober.get_stats()['reachable']),
+                       ({'state': 'cached'}, prober.get_stats()['cached'])])
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 文本格式指标"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """采样分析所有线程的调用栈（需设置 DEBUG_TOKEN），见 stack_profiler"""
+    result, status = profile_request(request.args, request.headers)
+    if isinstance(result, str):
+        return Response(result, mimetype='text/plain'), status
+    return jsonify(result), status
+
+@app.route('/debug/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """
+    查询最近的慢请求（耗时超过所在路由的阈值，见 slow_requests）
+    参数: endpoint（如 "POST /run_extract_amount"）、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": slow_log.get_stats(),
+        "requests": slow_log.query(request.args.get('endpoint'), min_ms, limit)
+    })
+
 if __name__ == '__main__':
     # 启动自动清理任务
     try:
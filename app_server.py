@@ -5,13 +5,32 @@ import requests
 import asyncio
 import aiohttp
 from aiohttp import ClientTimeout
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_from_directory, Response, stream_with_context
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask_cors import CORS
 import websocket
 import threading
 import time
 
+from broadcast_jobs import job_manager
+from change_log import ChangeLog
+from client_selector import SelectorError, normalize_tags
+from client_registry import ClientRegistry
+from command_ledger import CommandLedger
+from fleet_metrics import FleetMetrics
+from registry_persistence import RegistryPersister
+from sqlite_store import SQLiteStore
+from udp_heartbeat import UDPHeartbeatListener
+from heartbeat_rate import HeartbeatPolicy
+from heartbeat_tracker import HeartbeatTracker
+from probe_scheduler import ProbeScheduler
+from relay_tree import RelayPlanner, relay_fan_out, summarize_relay_stats
+from input_control import SequenceError, parse_command, describe_command, command_duration
+from metrics_exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsExporter, add_process_metrics
+from slow_requests import SlowRequestLog
+from stack_profiler import profile_request
+from tracing import TRACE_HEADER, new_trace_id
+
 app = Flask(__name__)
 CORS(app)
 
@@ -23,6 +42,9 @@ except ImportError:
     PERFORMANCE_MONITORING = False
     monitor = None
 
+# 慢请求记录：阈值由 SLOW_REQUEST_SECONDS / SLOW_REQUEST_THRESHOLDS 配置，SLOW_REQUEST_SPILL=1 时另写入 logs/slow_master.jsonl
+slow_log = SlowRequestLog.from_env('master')
+
 @app.before_request
 def before_request():
     """请求前处理：记录开始时间"""
@@ -34,34 +56,136 @@ def after_request(response):
     """请求后处理：记录性能数据"""
     if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
         response_time = time.time() - request.start_time
-        endpoint = f"{request.method} {request.path}"
+        # 按路由模板统计（如 /api/send/<ip>），避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
         is_error = response.status_code >= 400
         monitor.record_request(endpoint, response_time, is_error)
+        # 超过路由阈值的请求连同分阶段耗时与参数摘要写入慢请求记录
+        slow_log.observe(endpoint, response_time, response.status_code, request,
+                         getattr(request, 'trace', None), getattr(request, 'slow_info', None))
     return response
 
 # 文件存储路径
 IPS_FILE = "ips.json"
 
-# 用于存储目标 IP 地址及对应的 PC 名称的列表
-# 每个列表元素为一个字典，例如: {"ip": "192.168.0.123", "pc_name": "PC_A"}
-ip_list = []
-
-def save_ips_to_file():
-    """保存 ip_list 到文件中"""
-    with open(IPS_FILE, "w", encoding="utf-8") as f:
-        json.dump(ip_list, f, ensure_ascii=False, indent=2)
-
-def load_ips_from_file():
-    """从文件加载 ip_list，如果文件不存在，则初始化为空列表"""
-    global ip_list
-    if os.path.exists(IPS_FILE):
-        with open(IPS_FILE, "r", encoding="utf-8") as f:
-            ip_list = json.load(f)
+# 客户端注册表：按 IP / PC 名称索引，读取方使用写时复制快照
+# 每条记录为一个字典，例如: {"ip": "192.168.0.123", "pc_name": "PC_A", "tags": ["room1"], "window_count": 3}
+registry = ClientRegistry()
+
+# 注册表变化由后台线程防抖后原子写盘；设置 IPS_JOURNAL 时额外记录追加式变更日志用于崩溃恢复
+persister = RegistryPersister(
+    registry, IPS_FILE,
+    debounce=float(os.environ.get('IPS_SAVE_DEBOUNCE', '1.0')),
+    journal_path=os.environ.get('IPS_JOURNAL') or None
+)
+
+# 启动时加载快照并重放变更日志
+persister.load()
+persister.start()
+
+# 可选的 SQLite 存储（CLIENT_STORE=sqlite）：客户端与心跳持久化到 WAL 模式的数据库，
+# 分页、筛选与在线状态查询直接走 SQL；数据库为空时从 ips.json 导入
+store = None
+if os.environ.get('CLIENT_STORE', '').lower() == 'sqlite':
+    store = SQLiteStore(os.environ.get('CLIENT_DB', 'clients.db'),
+                        flush_interval_ms=int(os.environ.get('CLIENT_DB_FLUSH_MS', '200')))
+    db_clients = store.load_clients()
+    if db_clients:
+        registry.load(db_clients)
+        store.attach(registry)
     else:
-        ip_list = []
+        store.attach(registry)
+        store.import_clients(registry.snapshot())
+    store.start()
+
+# 注册表变更日志：供 ETag、since=<版本> 增量同步与长轮询/SSE 订阅使用
+registry_log = ChangeLog()
 
-# 启动时加载 IP 列表
-load_ips_from_file()
+def _log_registry_change(op, ip, entry):
+    if op == 'load':
+        registry_log.reset()
+    else:
+        registry_log.append({"op": op, "ip": ip, "entry": entry})
+
+registry.add_listener(_log_registry_change)
+
+# 长轮询最长等待时间（秒）
+MAX_LONG_POLL = 60
+# 全量列表按版本缓存序列化结果，没有变化时不重复编码
+_full_body_cache = {}
+
+def _json_body(payload):
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+
+def _sync_response(log, name, full_payload, cache_body=True):
+    """
+    版本化数据的通用响应
+    - 无 since 参数：返回全量数据，带 ETag；If-None-Match 与当前版本一致时返回 304
+    - since=<纪元>:<版本>：返回之后的变更 {"version", "changes"}；
+      无法增量（日志已截断、纪元不同即服务器已重启）时返回 {"version", "reset": true, "full"}
+    - wait=<秒>：与 since 一起使用，没有新变更时最多阻塞这么久（长轮询）
+    version、X-Version 与 ETag 都带进程纪元，重启后旧的版本标记不会被误认为最新
+    先读取版本再生成数据，保证数据至少包含该版本之前的所有变更
+    """
+    since_token = request.args.get('since')
+    if since_token is None:
+        version = log.version
+        etag = f'"{name}-{log.epoch}-{version}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=304, headers={'ETag': etag})
+        if cache_body:
+            cached = _full_body_cache.get(name)
+            if cached is None or cached[0] != version:
+                cached = _full_body_cache[name] = (version, _json_body(full_payload()))
+            body = cached[1]
+        else:
+            body = _json_body(full_payload())
+        return Response(body, mimetype='application/json',
+                        headers={'ETag': etag, 'X-Version': log.token(version)})
+
+    since = log.parse_token(since_token)
+    if since is None:
+        # 来自重启前的进程或格式不对：全量同步
+        changes, version = None, log.version
+    else:
+        wait = min(request.args.get('wait', 0, type=float), MAX_LONG_POLL)
+        if wait > 0:
+            log.wait(since, wait)
+        changes, version = log.since(since)
+    if changes is None:
+        body = {"version": log.token(version), "reset": True, "full": full_payload()}
+    else:
+        body = {"version": log.token(version), "changes": changes}
+    return Response(_json_body(body), mimetype='application/json',
+                    headers={'ETag': f'"{name}-{log.epoch}-{version}"', 'X-Version': log.token(version)})
+
+def _sse_stream(log, full_payload, keepalive=15):
+    """
+    以 SSE 推送版本化数据的变更
+    重连时浏览器自动携带 Last-Event-ID（或使用 since 参数），只补发之后的变更
+    事件: reset（全量数据）、changes（变更列表），事件 id 为版本标记 "<纪元>:<版本>"
+    """
+    since = log.parse_token(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+    def generate():
+        version = since
+        while True:
+            changes = None
+            if version is not None:
+                changes, current = log.since(version)
+            if changes is None:
+                version = log.version
+                yield f"id: {log.token(version)}\nevent: reset\ndata: {_json_body(full_payload())}\n\n"
+            elif changes:
+                version = current
+                yield f"id: {log.token(version)}\nevent: changes\ndata: {_json_body(changes)}\n\n"
+            else:
+                yield ": keepalive\n\n"
+            log.wait(version, keepalive)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/')
 def index():
@@ -75,60 +199,145 @@ def get_ips_list():
     """
     获取IPs List
     """
-    return jsonify({"status": "success", "ips": ip_list})
+    return jsonify({"status": "success", "ips": registry.snapshot()})
 
 @app.route('/api/ips', methods=['GET'])
 def get_ips():
     """
     获取当前所有 IP 地址及对应的 PC 名称
+    可选参数: limit、offset 分页，name 按 PC 名称前缀筛选（区分大小写，按注册顺序）
+    全量请求支持 ETag/If-None-Match；since=<纪元>:<版本>[&wait=<秒>] 返回增量变更（见 _sync_response）
     """
-    return jsonify(ip_list)
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    name = request.args.get('name')
+    if limit is None and not offset and not name:
+        return _sync_response(registry_log, 'ips', registry.snapshot)
+    if store is not None:
+        return jsonify(store.list_clients(limit=limit, offset=offset, name_prefix=name))
+    entries = registry.find_by_name_prefix(name) if name else registry.snapshot()
+    return jsonify(entries[offset:offset + limit] if limit is not None else entries[offset:])
 
-@app.route('/api/ips', methods=['POST'])
-def add_ip():
+@app.route('/api/ips/stream', methods=['GET'])
+def stream_ips():
     """
-    添加 IP 地址和 PC 名称
+    订阅注册表变更（SSE），首次连接先推送全量列表
+    """
+    return _sse_stream(registry_log, registry.snapshot)
+
+# 客户端注册时可上报的附加字段：窗口数、是否可作为中继
+REPORTED_FIELDS = ('window_count', 'relay')
+
+def _register_client(data):
+    """
+    校验并注册客户端（/api/ips 与 /api/checkin 共用）
+    返回:
+        (记录, 变化类型, 错误信息) 校验失败时记录为 None
     """
-    data = request.get_json() or {}
     new_ip = data.get('ip')
-    pc_name = data.get('pc_name', 'Unknown')
+    pc_name = data.get('pc_name')
+    try:
+        tags = normalize_tags(data.get('tags')) if 'tags' in data else None
+    except SelectorError as e:
+        return None, None, str(e)
     
     # 验证IP格式
     if not new_ip:
-        return jsonify({"status": "error", "message": "IP address is required"}), 400
+        return None, None, "IP address is required"
     
     # 简单的IP格式验证
     try:
         parts = new_ip.split('.')
         if len(parts) != 4 or not all(0 <= int(p) <= 255 for p in parts):
-            return jsonify({"status": "error", "message": "Invalid IP format"}), 400
+            return None, None, "Invalid IP format"
     except:
-        return jsonify({"status": "error", "message": "Invalid IP format"}), 400
+        return None, None, "Invalid IP format"
     
-    # 如果 ip_list 中不存在该 IP，则添加新的记录
-    if not any(entry['ip'] == new_ip for entry in ip_list):
-        ip_list.append({'ip': new_ip, 'pc_name': pc_name})
-        save_ips_to_file()
+    # 不存在则新增；已存在时仅当上报的名称、标签、窗口数或中继能力变化时才更新
+    fields = {field: data.get(field) for field in REPORTED_FIELDS}
+    entry, change = registry.upsert(new_ip, pc_name, tags=tags, **fields)
+    return entry, change, None
+
+@app.route('/api/ips', methods=['POST'])
+def add_ip():
+    """
+    添加 IP 地址和 PC 名称
+    """
+    _, _, error = _register_client(request.get_json() or {})
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
     
-    return jsonify({"status": "success", "ips": ip_list})
+    return jsonify({"status": "success", "ips": registry.snapshot()})
 
 @app.route('/api/ips/<ip>', methods=['DELETE'])
 def delete_ip(ip):
     """
     删除指定 IP 地址及对应的信息
     """
-    global ip_list
-    ip_list = [entry for entry in ip_list if entry['ip'] != ip]
-    save_ips_to_file()
-    return jsonify({"status": "success", "ips": ip_list})
+    registry.remove(ip)
+    return jsonify({"status": "success", "ips": registry.snapshot()})
+
+@app.route('/api/ips/<ip>/tags', methods=['PUT'])
+def set_ip_tags(ip):
+    """
+    设置指定客户端的标签（例如机房、分组）
+    """
+    data = request.get_json() or {}
+    try:
+        tags = normalize_tags(data.get('tags'))
+    except SelectorError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    entry = registry.update(ip, tags=tags)
+    if entry is None:
+        return jsonify({"status": "error", "message": "IP not found"}), 404
+    return jsonify({"status": "success", "entry": entry})
+
+@app.route('/api/tags', methods=['GET'])
+def get_tags():
+    """
+    获取所有标签及其客户端数量
+    """
+    return jsonify(registry.index.tag_counts())
 
-def send_post_request(ip, key='f7'):
+def _resolve_targets(data):
+    """
+    根据请求中的 selector 解析目标客户端，未提供时返回所有客户端的快照
+    选择器无效时抛出 SelectorError
     """
-    发送 POST 请求到指定 IP 的 /run 接口，携带按键参数，带超时和错误处理
+    selector = data.get("selector")
+    if selector:
+        targets = registry.index.resolve(selector)
+    else:
+        targets = registry.snapshot()  # 写时复制快照，避免并发修改
+    if data.get("online_only"):
+        online = _online_ips()
+        targets = [e for e in targets if e['ip'] in online]
+    return targets
+
+@app.route('/api/resolve', methods=['POST'])
+def resolve_targets():
+    """
+    预览选择器匹配的客户端，不发送任何指令
+    """
+    data = request.get_json() or {}
+    try:
+        targets = _resolve_targets(data)
+    except SelectorError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "target_count": len(targets), "targets": targets})
+
+def send_post_request(ip, command='f7', trace_id=None):
+    """
+    发送 POST 请求到指定 IP 的 /run 接口，携带按键参数（或按键序列），带超时和错误处理
     （保留同步版本用于单个发送）
+    trace_id 通过 X-Trace-Id 请求头传给客户端，用于在客户端 /traces 中查找本次处理
     """
+    if isinstance(command, str):
+        command = {"key": command}
+    headers = {TRACE_HEADER: trace_id} if trace_id else None
     try:
-        response = requests.post(f'http://{ip}:5000/run', json={"key": key}, timeout=3)
+        response = requests.post(f'http://{ip}:5000/run', json=command, headers=headers,
+                                 timeout=3 + command_duration(command))
         return {"ip": ip, "status": "success", "response": response.text}
     except requests.exceptions.Timeout:
         return {"ip": ip, "status": "error", "message": "Request timed out"}
@@ -139,23 +348,32 @@ def send_post_request(ip, key='f7'):
 
 # ==================== 异步高性能发送实现 ====================
 
-async def _send_one_with_retry(session, semaphore, ip, key, max_retries=3):
+async def _send_one_with_retry(session, semaphore, ip, command, max_retries=3, trace_id=None):
     """
     带重试机制的异步发送单个指令
     参数:
         session: aiohttp会话
         semaphore: 并发控制信号量
         ip: 目标IP
-        key: 按键
+        command: 按键字符串，或 {"key": ...} / {"sequence": [...]} 指令
         max_retries: 最大重试次数
+        trace_id: 通过 X-Trace-Id 请求头传给客户端的追踪 ID
+    按键序列超时后不重试（客户端可能已在执行），只在连接失败时重试；
+    客户端报告输入已开始执行但超时（504 且 outcome_unknown）时同样不重试
     """
+    if isinstance(command, str):
+        command = {"key": command}
+    is_sequence = "sequence" in command
+    request_timeout = ClientTimeout(total=5 + command_duration(command), connect=2)
+    headers = {TRACE_HEADER: trace_id} if trace_id else None
     for attempt in range(max_retries):
         try:
             async with semaphore:
                 async with session.post(
                     f'http://{ip}:5000/run',
-                    json={"key": key},
-                    timeout=ClientTimeout(total=5, connect=2)
+                    json=command,
+                    headers=headers,
+                    timeout=request_timeout
                 ) as resp:
                     if resp.status == 200:
                         text = await resp.text()
@@ -177,6 +395,20 @@ async def _send_one_with_retry(session, semaphore, ip, key, max_retries=3):
                                 "timestamp": time.time()
                             }
                     else:
+                        if resp.status == 504:
+                            # 客户端输入超时：已开始执行时结果未知，不重发
+                            try:
+                                body = json.loads(await resp.text())
+                            except ValueError:
+                                body = None
+                            if isinstance(body, dict) and body.get("outcome_unknown"):
+                                return {
+                                    "ip": ip,
+                                    "status": "error",
+                                    "message": body.get("message") or "HTTP 504",
+                                    "outcome_unknown": True,
+                                    "attempt": attempt + 1
+                                }
                         if attempt < max_retries - 1:
                             await asyncio.sleep(0.1 * (attempt + 1))
                             continue
@@ -187,7 +419,7 @@ async def _send_one_with_retry(session, semaphore, ip, key, max_retries=3):
                             "attempt": attempt + 1
                         }
         except asyncio.TimeoutError:
-            if attempt < max_retries - 1:
+            if attempt < max_retries - 1 and not is_sequence:
                 await asyncio.sleep(0.1 * (attempt + 1))  # 递增延迟
                 continue
             return {
@@ -223,10 +455,13 @@ async def _send_one_with_retry(session, semaphore, ip, key, max_retries=3):
         "message": "Max retries exceeded"
     }
 
-async def _send_all_async(ip_snapshot, key):
+async def _send_all_async(ip_snapshot, command, on_result=None, trace_id=None):
     """
     异步批量发送指令到所有客户端
     支持大量客户端，动态调整并发数，使用连接池提高效率
+    参数:
+        on_result: 可选回调，每个客户端完成时立即调用（用于流式推送进度）
+        trace_id: 本次广播的追踪 ID，随请求头下发
     """
     if not ip_snapshot:
         return []
@@ -254,34 +489,150 @@ async def _send_all_async(ip_snapshot, key):
         enable_cleanup_closed=True
     )
     
-    timeout = ClientTimeout(total=5, connect=2)
+    timeout = ClientTimeout(total=5 + command_duration(command), connect=2)
     
     async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        tasks = [_send_one_with_retry(session, semaphore, entry['ip'], key) for entry in ip_snapshot]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        async def send_timed(ip):
+            # 延迟包含排队等待与重试，与中继路径的 latency 含义一致
+            start = time.time()
+            result = await _send_one_with_retry(session, semaphore, ip, command, trace_id=trace_id)
+            result.setdefault('latency', round(time.time() - start, 4))
+            return result
         
-        # 处理异常结果
+        tasks = [send_timed(entry['ip']) for entry in ip_snapshot]
+        
+        # 按完成顺序收集结果，处理异常结果
         processed_results = []
-        for result in results:
-            if isinstance(result, Exception):
-                processed_results.append({
+        for future in asyncio.as_completed(tasks):
+            try:
+                result = await future
+            except Exception as e:
+                result = {
                     "ip": "unknown",
                     "status": "error",
-                    "message": str(result)
-                })
-            else:
-                processed_results.append(result)
+                    "message": str(e)
+                }
+            processed_results.append(result)
+            if on_result is not None:
+                on_result(result)
         
         return processed_results
 
+# ==================== 分层中继转发 ====================
+
+# 目标数量达到该值且存在可用中继时，自动改用中继树下发
+RELAY_MIN_CLIENTS = 200
+# 每个节点（含主服务器）最多直接发送的数量
+RELAY_FANOUT = 50
+
+relay_planner = RelayPlanner(fanout=RELAY_FANOUT)
+
+async def _send_all_relay(ip_snapshot, command, on_result=None, trace_id=None):
+    """
+    通过中继树下发指令：主服务器只向顶层节点发送，中继负责转发给各自的子树
+    中继失败时直接发送其子树，并让该中继进入冷却期（下次自动重建树）
+    返回: (results, relay_stats)
+    """
+    tree = relay_planner.plan(ip_snapshot)
+    concurrency = max(1, min(len(tree), 500))
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, force_close=False, enable_cleanup_closed=True)
+    
+    async def send_leaf(session, ip, leaf_command):
+        return await _send_one_with_retry(session, semaphore, ip, leaf_command, trace_id=trace_id)
+    
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await relay_fan_out(
+            session, tree, command, send_leaf,
+            on_result=on_result, on_relay_failure=relay_planner.mark_failed,
+            extra_timeout=command_duration(command),
+            headers={TRACE_HEADER: trace_id} if trace_id else None
+        )
+
+def _use_relay(snapshot, mode):
+    """根据请求的 mode（auto/direct/relay）判断是否走中继树"""
+    if mode == 'direct':
+        return False
+    has_relay = any(entry.get('relay') for entry in snapshot)
+    if mode == 'relay':
+        return has_relay
+    return has_relay and len(snapshot) >= RELAY_MIN_CLIENTS
+
+@app.route('/api/relay_tree', methods=['GET'])
+def get_relay_tree():
+    """
+    查看当前中继树（按最新注册表重新规划）
+    """
+    relay_planner.plan(registry.snapshot())
+    return jsonify(relay_planner.describe())
+
+# 指令延迟账本：每次下发的指令与各客户端的结果代码、尝试次数与延迟，按小时分段保留 LEDGER_RETENTION_HOURS 小时
+command_ledger = CommandLedger(
+    os.environ.get('LEDGER_DIR', 'ledger'),
+    retention_hours=float(os.environ.get('LEDGER_RETENTION_HOURS', '168'))
+).start()
+
+def _record_dispatch(result):
+    """按结果统计指令下发：success / timeout / error"""
+    if not PERFORMANCE_MONITORING:
+        return
+    if result.get("status") == "success":
+        outcome = "success"
+    elif "timed out" in str(result.get("message", "")).lower():
+        outcome = "timeout"
+    else:
+        outcome = "error"
+    monitor.count('dispatch', outcome=outcome)
+
+def _submit_broadcast(snapshot, command, mode='auto'):
+    """
+    将广播提交到后台任务循环，立即返回任务对象
+    command: {"key": ...} 或 {"sequence": [...]}
+    mode: auto（客户端较多时自动使用中继）、direct（直接发送）、relay（强制使用中继）
+    """
+    use_relay = _use_relay(snapshot, mode)
+    
+    async def runner(job):
+        ledger_no = command_ledger.begin(job.job_id, command, len(snapshot), "relay" if use_relay else "direct",
+                                         describe_command(command))
+        
+        def on_result(result):
+            _record_dispatch(result)
+            command_ledger.record_result(ledger_no, result)
+            job.add_result(result)
+        
+        # 以任务 ID 作为追踪 ID，可在各客户端的 /traces?trace_id= 中查到本次处理
+        job.meta["mode"] = "relay" if use_relay else "direct"
+        job.meta["trace_id"] = job.job_id
+        if use_relay:
+            _, relay_stats = await _send_all_relay(snapshot, command, on_result=on_result, trace_id=job.job_id)
+            job.meta["relay_hops"] = summarize_relay_stats(relay_stats)
+            job.meta["relay_fallbacks"] = sum(1 for stat in relay_stats if stat.get("fallback"))
+        else:
+            await _send_all_async(snapshot, command, on_result=on_result, trace_id=job.job_id)
+        summary = job.summary()
+        print(f"批量发送完成[{job.job_id}]: {summary['total']}个客户端, 成功: {summary['success']}, "
+              f"失败: {summary['error']}, 耗时: {summary['elapsed_time']:.2f}秒")
+    
+    return job_manager.submit(describe_command(command), len(snapshot), runner)
+
 @app.route('/api/send/<ip>', methods=['POST'])
 def send_request(ip):
     """
-    发送 POST 请求到指定 IP 的 /run 接口，同时传递用户选择的按键
+    发送 POST 请求到指定 IP 的 /run 接口，同时传递用户选择的按键或按键序列
     """
     data = request.get_json() or {}
-    key = data.get("key", "f7")
-    result = send_post_request(ip, key)
+    try:
+        command = parse_command(data)
+    except SequenceError as e:
+        return jsonify({"ip": ip, "status": "error", "message": str(e)}), 400
+    trace_id = new_trace_id()
+    start = time.time()
+    result = send_post_request(ip, command, trace_id=trace_id)
+    result["trace_id"] = trace_id
+    _record_dispatch(result)
+    command_ledger.record_result(command_ledger.begin(trace_id, command, 1, "single", describe_command(command)),
+                                 result, latency=time.time() - start)
     if result["status"] == "success":
         return jsonify(result), 200
     else:
@@ -290,36 +641,47 @@ def send_request(ip):
 @app.route('/api/send_all', methods=['POST'])
 def send_request_all():
     """
-    向所有 IP 地址发送 POST 请求到 /run 接口
-    使用异步高性能实现，支持大量客户端快速响应
+    向所有 IP 地址（或 selector 匹配的客户端）发送 POST 请求到 /run 接口
+    请求体可携带 key（单个按键）或 sequence（按键序列，格式见 input_control.py）
+    兼容旧接口：内部提交广播任务并等待其完成后一次性返回
+    如需立即返回并流式获取结果，请使用 /api/jobs
     """
     data = request.get_json() or {}
-    key = data.get("key", "f7")
-    snapshot = list(ip_list)  # 快照，避免并发修改
+    try:
+        command = parse_command(data)
+        snapshot = _resolve_targets(data)
+    except (SelectorError, SequenceError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    if data.get("dry_run"):
+        return jsonify({"status": "dry_run", "target_count": len(snapshot)}), 200
     
     if not snapshot:
         return jsonify([]), 200
     
-    start_time = time.time()
-    
-    # 使用异步执行
     try:
-        results = asyncio.run(_send_all_async(snapshot, key))
-        elapsed_time = time.time() - start_time
-        
-        # 统计结果
-        success_count = sum(1 for r in results if r.get("status") == "success")
-        error_count = len(results) - success_count
-        
-        print(f"批量发送完成: {len(results)}个客户端, 成功: {success_count}, 失败: {error_count}, 耗时: {elapsed_time:.2f}秒")
+        job = _submit_broadcast(snapshot, command, data.get("mode", "auto"))
+        job.wait()
+        summary = job.summary()
+        # 慢请求记录中附带广播汇总与失败的客户端
+        request.slow_info = {
+            "job_id": job.job_id,
+            **{key: summary.get(key) for key in ("total", "success", "error", "mode", "relay_hops")},
+            "failed": [r.get("ip") for r in job.results if r.get("status") != "success"][:20]
+        }
+        if summary["message"]:
+            raise RuntimeError(summary["message"])
         
         return jsonify({
-            "results": results,
+            "results": job.results,
             "summary": {
-                "total": len(results),
-                "success": success_count,
-                "error": error_count,
-                "elapsed_time": round(elapsed_time, 2)
+                "total": summary["total"],
+                "target_count": len(snapshot),
+                "success": summary["success"],
+                "error": summary["error"],
+                "elapsed_time": round(summary["elapsed_time"], 2),
+                "mode": summary.get("mode"),
+                "relay_hops": summary.get("relay_hops")
             }
         })
     except Exception as e:
@@ -329,83 +691,200 @@ def send_request_all():
             "results": []
         }), 500
 
-# ----------------------- 新增测试连接功能 -----------------------
+# ==================== 指令延迟账本 ====================
 
-def send_test_request(ip):
+@app.route('/api/ledger', methods=['GET'])
+def query_ledger():
     """
-    发送 GET 请求到指定 IP 的 /test 接口，用于测试连接
+    按客户端与按小时汇总指令下发的结果与延迟分布（数据最多滞后约 1 秒）
+    参数:
+        hours: 统计最近多少小时（默认 24）
+        ip: 只统计该客户端
+        command: 只统计该指令序号（见 /api/ledger/commands）
+        limit: 返回的客户端数量，按 p90 延迟从高到低（默认 20）
     """
     try:
-        response = requests.get(f'http://{ip}:5000/test', timeout=1)
-        return {"ip": ip, "status": "success", "response": response.text}
-    except requests.exceptions.Timeout:
-        return {"ip": ip, "status": "error", "message": "Request timed out"}
-    except requests.exceptions.ConnectionError:
-        return {"ip": ip, "status": "error", "message": "Connection error"}
-    except requests.exceptions.RequestException as e:
-        return {"ip": ip, "status": "error", "message": f"Unexpected error: {str(e)}"}
+        hours = float(request.args.get('hours', 24))
+        number = int(request.args['command']) if request.args.get('command') else None
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({"status": "error", "message": "hours, command and limit must be numbers"}), 400
+    try:
+        result = command_ledger.query(hours, request.args.get('ip'), number, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", **result})
+
+@app.route('/api/ledger/commands', methods=['GET'])
+def list_ledger_commands():
+    """
+    最近下发的指令（序号、指令 ID、按键或序列、发送方式、目标数量），最新的在前
+    参数: hours（默认 24）、limit（默认 50）
+    """
+    try:
+        hours = float(request.args.get('hours', 24))
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "hours and limit must be numbers"}), 400
+    try:
+        commands = command_ledger.commands(hours, limit)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "commands": commands})
+
+# ==================== 异步广播任务接口 ====================
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """
+    提交广播任务，立即返回任务ID及解析出的目标数量
+    可通过 selector 指定目标客户端，dry_run 为真时只返回目标数量不发送
+    mode 可选 auto/direct/relay，客户端较多时 auto 会自动使用中继树
+    结果通过 /api/jobs/<job_id>/stream 流式获取，汇总通过 /api/jobs/<job_id> 获取
+    """
+    data = request.get_json() or {}
+    try:
+        command = parse_command(data)
+        snapshot = _resolve_targets(data)
+    except (SelectorError, SequenceError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if data.get("dry_run"):
+        return jsonify({"status": "dry_run", "target_count": len(snapshot)}), 200
+    job = _submit_broadcast(snapshot, command, data.get("mode", "auto"))
+    return jsonify({
+        "status": "accepted",
+        "job_id": job.job_id,
+        "total": job.total,
+        "target_count": job.total,
+        "summary_url": f"/api/jobs/{job.job_id}",
+        "stream_url": f"/api/jobs/{job.job_id}/stream"
+    }), 202
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """
+    列出最近的广播任务汇总
+    """
+    return jsonify(job_manager.list_summaries())
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    获取广播任务的汇总，带 ?results=1 时附带所有已完成的结果
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    summary = job.summary()
+    if request.args.get('results') in ('1', 'true'):
+        with job.cond:
+            summary['results'] = list(job.results)
+    return jsonify(summary)
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """
+    流式推送广播任务的逐个客户端结果，最后推送汇总
+    默认使用 NDJSON；?format=sse 或 Accept: text/event-stream 时使用 Server-Sent Events
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    
+    use_sse = (request.args.get('format') == 'sse'
+               or 'text/event-stream' in request.headers.get('Accept', ''))
+    
+    def generate():
+        for result in job.iter_results():
+            if result is None:
+                # 保活，防止代理或浏览器断开空闲连接
+                yield ": keepalive\n\n" if use_sse else "\n"
+                continue
+            line = json.dumps(result, ensure_ascii=False)
+            yield f"event: result\ndata: {line}\n\n" if use_sse else line + "\n"
+        summary = json.dumps({"summary": job.summary()}, ensure_ascii=False)
+        yield f"event: summary\ndata: {summary}\n\n" if use_sse else summary + "\n"
+    
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# ----------------------- 新增测试连接功能 -----------------------
+
+# 后台可达性探测：按有限速率轮流探测所有客户端并缓存结果
+prober = ProbeScheduler(
+    lambda: [entry['ip'] for entry in registry.snapshot()],
+    interval=float(os.environ.get('PROBE_INTERVAL', '60')),
+    rate=float(os.environ.get('PROBE_RATE', '20'))
+)
+prober.start()
 
 @app.route('/api/test/<ip>', methods=['GET'])
 def test_request(ip):
     """
-    测试指定 IP 的连接
+    测试指定 IP 的连接（立即探测，并刷新缓存）
     """
-    result = send_test_request(ip)
+    result = prober.probe_now([ip])[0]
     if result["status"] == "success":
         return jsonify(result), 200
     else:
         return jsonify(result), 500
 
-@app.route('/api/test_all', methods=['GET'])
+@app.route('/api/test_all', methods=['GET', 'POST'])
 def test_request_all():
     """
-    测试所有 IP 地址的连接（异步版本）
+    获取所有客户端的连接状态
+    默认直接返回后台探测的缓存结果（带 age 字段）；
+    refresh=1 或 POST 时立即重新探测，可用 selector 或 ips 只刷新选定的客户端；
+    等待时间按客户端数量与并发数估算，到时未完成的客户端返回缓存结果
     """
-    async def _test_all_async(ip_snapshot):
-        """异步测试所有连接"""
-        if not ip_snapshot:
-            return []
-        
-        concurrency = min(len(ip_snapshot), 200)
-        semaphore = asyncio.Semaphore(concurrency)
-        connector = aiohttp.TCPConnector(limit=concurrency, force_close=False)
-        timeout = ClientTimeout(total=3, connect=1)
-        
-        async def test_one(session, sem, entry_ip):
-            async with sem:
-                try:
-                    async with session.get(f'http://{entry_ip}:5000/test', timeout=timeout) as resp:
-                        if resp.status == 200:
-                            text = await resp.text()
-                            return {"ip": entry_ip, "status": "success", "response": text}
-                        else:
-                            return {"ip": entry_ip, "status": "error", "message": f"HTTP {resp.status}"}
-                except asyncio.TimeoutError:
-                    return {"ip": entry_ip, "status": "error", "message": "Request timed out"}
-                except Exception as e:
-                    return {"ip": entry_ip, "status": "error", "message": str(e)}
-        
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            tasks = [test_one(session, semaphore, entry['ip']) for entry in ip_snapshot]
-            return await asyncio.gather(*tasks, return_exceptions=True)
-    
-    snapshot = list(ip_list)
+    data = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+    if request.args.get('selector'):
+        data = {**data, 'selector': request.args.get('selector')}
+    ips = data.get('ips')
+    if ips and not (isinstance(ips, list) and all(isinstance(ip, str) for ip in ips)):
+        return jsonify({"status": "error", "message": "ips must be a list of strings"}), 400
     try:
-        results = asyncio.run(_test_all_async(snapshot))
-        processed_results = []
-        for result in results:
-            if isinstance(result, Exception):
-                processed_results.append({"ip": "unknown", "status": "error", "message": str(result)})
-            else:
-                processed_results.append(result)
-        return jsonify(processed_results)
-    except Exception as e:
-        return jsonify([{"ip": "error", "status": "error", "message": str(e)}]), 500
+        targets = ips if ips else [e['ip'] for e in _resolve_targets(data)]
+    except SelectorError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    if request.method == 'POST' or request.args.get('refresh') == '1':
+        try:
+            return jsonify(prober.probe_now(targets))
+        except Exception as e:
+            return jsonify([{"ip": "error", "status": "error", "message": str(e)}]), 500
+    return jsonify(prober.results(targets))
 
 # ==================== 心跳检测功能 ====================
 
-# 存储客户端心跳信息
-client_heartbeats = {}
+# 超过该秒数未收到心跳视为离线
+HEARTBEAT_TIMEOUT = 30
+
+# 客户端心跳表：按到期时间维护在线状态，查询无需扫描全部客户端
+heartbeat_tracker = HeartbeatTracker(timeout=HEARTBEAT_TIMEOUT)
+if store is not None:
+    # 只恢复仍在注册表中的客户端（旧版本删除客户端时未删除心跳行）
+    heartbeat_tracker.restore(e for e in store.load_heartbeats().values() if e['ip'] in registry)
+heartbeat_tracker.start()
+# 客户端从注册表删除（DELETE /api/ips/<ip>、签到时更换 IP 等）时删除其心跳记录，
+# 数据库中的心跳行由 SQLiteStore 的注册表回调一并删除
+registry.add_listener(lambda op, ip, entry: heartbeat_tracker.remove(ip) if op == 'remove' else None)
+
+def _online_ips():
+    """返回当前在线客户端的 IP 集合"""
+    return heartbeat_tracker.online_ips()
+
+def _record_heartbeat(client_ip, pc_name, current_time=None, **metrics):
+    """更新客户端心跳信息，metrics 为 UDP 心跳携带的负载指标（cpu、mem、window_count）"""
+    current_time = current_time or time.time()
+    heartbeat_policy.meter.record(current_time)
+    heartbeat_tracker.beat(client_ip, pc_name, current_time,
+                           **{k: v for k, v in metrics.items() if v is not None})
+    if store is not None:
+        store.record_heartbeat(client_ip, pc_name, current_time)
 
 @app.route('/api/heartbeat', methods=['POST'])
 def heartbeat():
@@ -421,43 +900,183 @@ def heartbeat():
         return jsonify({"status": "error", "message": "No IP provided"}), 400
     
     # 快速更新心跳信息
-    current_time = time.time()
-    client_heartbeats[client_ip] = {
-        'ip': client_ip,
-        'pc_name': pc_name,
-        'last_heartbeat': current_time,
-        'status': 'online'
-    }
+    _record_heartbeat(client_ip, pc_name)
     
     return jsonify({"status": "success"}), 200
 
+# 心跳速率控制：按客户端数量与实际负载计算推荐间隔，签到响应中下发
+# 推荐间隔不超过离线超时的 1/3，避免正常客户端被判为离线
+heartbeat_policy = HeartbeatPolicy(target_rate=float(os.environ.get('HEARTBEAT_TARGET_RATE', '100')),
+                                   offline_timeout=HEARTBEAT_TIMEOUT)
+
+@app.route('/api/heartbeat_policy', methods=['GET', 'POST'])
+def heartbeat_policy_endpoint():
+    """
+    查看或调整心跳速率策略
+    POST 可设置 target_rate（每秒心跳数）、slowdown（放慢倍数）、min_interval、max_interval；
+    max_interval 不得超过离线超时的 1/3
+    """
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        try:
+            heartbeat_policy.update(**{field: data[field] for field in
+                                       ('target_rate', 'slowdown', 'min_interval', 'max_interval')
+                                       if field in data})
+        except (TypeError, ValueError) as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "success", "policy": heartbeat_policy.get_stats(),
+                    "recommended_interval": heartbeat_policy.recommend(len(registry))})
+
+# 签到会话：客户端ID -> {"ip", "pc_name", "seq", "last_seen"}
+checkin_sessions = {}
+checkin_lock = threading.Lock()
+checkin_stats = {'checkins': 0, 'registrations': 0, 'info_updates': 0, 'stale': 0, 'resend_requests': 0}
+
+@app.route('/api/checkin', methods=['POST'])
+def checkin():
+    """
+    注册与心跳合并的签到接口（幂等）
+    请求体: {"id": 客户端ID, "seq": 单调递增序号, "info": {...}}
+        info 与 /api/ips 的注册字段相同，只在首次签到或信息变化时携带；
+        平时只发送 id 与 seq。服务器不认识该 ID 时返回 resend=true，客户端下次携带完整 info
+    seq 不大于已记录值的请求视为重复或乱序，只确认不更新
+    响应中的 metrics_interval 为客户端附带指标（请求体 "metrics" 字段，见 fleet_metrics）的最短间隔（秒）
+    """
+    data = request.get_json(silent=True) or {}
+    client_id = data.get('id')
+    seq = data.get('seq')
+    info = data.get('info')
+    if not client_id or not isinstance(seq, int):
+        return jsonify({"status": "error", "message": "id and integer seq are required"}), 400
+
+    now = time.time()
+    with checkin_lock:
+        checkin_stats['checkins'] += 1
+        session = checkin_sessions.get(client_id)
+        if session is not None and seq <= session['seq'] and not info:
+            checkin_stats['stale'] += 1
+            return jsonify({"status": "success", "stale": True})
+
+    registered = False
+    if info:
+        entry, change, error = _register_client(info)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+        registered = change is not None
+        with checkin_lock:
+            old = checkin_sessions.get(client_id)
+            if old is not None and old['ip'] != entry['ip']:
+                # 客户端换了 IP：旧地址不再属于它
+                registry.remove(old['ip'])
+            checkin_stats['registrations' if change == 'added' else 'info_updates'] += bool(change)
+            session = checkin_sessions[client_id] = {'ip': entry['ip'], 'pc_name': entry['pc_name'],
+                                                     'seq': seq, 'last_seen': now}
+    else:
+        with checkin_lock:
+            session = checkin_sessions.get(client_id)
+            if session is None or session['ip'] not in registry:
+                # 服务器重启或记录已被删除：要求客户端重新携带完整信息
+                checkin_stats['resend_requests'] += 1
+                return jsonify({"status": "success", "resend": True})
+            session['seq'] = max(session['seq'], seq)
+            session['last_seen'] = now
+
+    _record_heartbeat(session['ip'], session['pc_name'], now)
+    if isinstance(data.get('metrics'), dict) and FLEET_METRICS_INTERVAL > 0:
+        fleet_metrics.update(session['ip'], session['pc_name'], data['metrics'], now)
+    # 推荐心跳间隔与本客户端的时间槽偏移，客户端按 (时间 mod interval) == offset 的时刻发送
+    interval, offset = heartbeat_policy.assign(client_id, len(registry), now)
+    response = {"status": "success", "registered": registered, "interval": interval, "offset": offset}
+    if udp_listener is not None:
+        response["udp_port"] = UDP_HEARTBEAT_PORT  # 客户端可改用 UDP 发送心跳
+    if FLEET_METRICS_INTERVAL > 0:
+        response["metrics_interval"] = FLEET_METRICS_INTERVAL
+    return jsonify(response)
+
+# ==================== 全网指标汇总 ====================
+
+# 客户端随签到附带指标的最短间隔（秒），0 为关闭；由主服务器在签到响应中下发，上报频率有上限
+FLEET_METRICS_INTERVAL = float(os.environ.get('FLEET_METRICS_INTERVAL', '60'))
+fleet_metrics = FleetMetrics(max_age=max(600, FLEET_METRICS_INTERVAL * 5))
+registry.add_listener(lambda op, ip, entry: fleet_metrics.remove(ip) if op == 'remove' else None)
+
+@app.route('/api/fleet_metrics', methods=['GET'])
+def get_fleet_metrics():
+    """
+    全网指标：合并各客户端最近一个上报周期的直方图与计数，
+    按 OCR 延迟（ocr_p90_ms）、CPU、错误率对客户端排序，并列出离群客户端
+    参数:
+        limit: 每个排行返回的客户端数量（默认 10）
+        rank_by: 只返回指定排行（ocr_p90_ms / cpu / error_rate）
+    """
+    try:
+        limit = max(1, int(request.args.get('limit', 10)))
+    except ValueError:
+        return jsonify({"status": "error", "message": "limit must be an integer"}), 400
+    rank_by = request.args.get('rank_by')
+    result = fleet_metrics.summary(limit=limit)
+    if rank_by:
+        if rank_by not in result['rankings']:
+            return jsonify({"status": "error", "message": f"unknown rank_by: {rank_by}"}), 400
+        result['rankings'] = {rank_by: result['rankings'][rank_by]}
+    result['stats'] = fleet_metrics.get_stats()
+    return jsonify(result)
+
+# UDP 心跳端口（UDP_HEARTBEAT_PORT=5001 启用，0 为关闭），HTTP 心跳始终可用作后备
+UDP_HEARTBEAT_PORT = int(os.environ.get('UDP_HEARTBEAT_PORT', '0'))
+udp_listener = None
+
+def _on_udp_heartbeats(records, received_at):
+    """批量写入一批 UDP 心跳"""
+    for record in records:
+        _record_heartbeat(record['ip'], record['pc_name'], received_at,
+                          cpu=record['cpu'], mem=record['mem'], window_count=record['window_count'])
+
+def start_udp_heartbeat_listener():
+    global udp_listener
+    if not UDP_HEARTBEAT_PORT:
+        return
+    try:
+        udp_listener = UDPHeartbeatListener(_on_udp_heartbeats, port=UDP_HEARTBEAT_PORT).start()
+        print(f"UDP 心跳监听已启动: 端口 {UDP_HEARTBEAT_PORT}")
+    except OSError as e:
+        print(f"UDP 心跳监听启动失败，仅使用 HTTP 心跳: {e}")
+
 @app.route('/api/client_status', methods=['GET'])
 def client_status():
     """
-    获取所有客户端在线状态
-    优化：更精确的超时检测和状态更新
+    获取所有客户端在线状态（在线在前、最近心跳在前）
+    在线/离线状态由心跳表按到期时间增量维护，查询只复制需要返回的部分
+    可选参数: status=online|offline 筛选，limit、offset 分页，source=db 从 SQLite 存储查询
     """
-    current_time = time.time()
-    HEARTBEAT_TIMEOUT = 30  # 30秒超时
-    status_list = []
+    status_filter = request.args.get('status')
+    limit = request.args.get('limit', type=int)
+    offset = request.args.get('offset', 0, type=int)
+    if store is not None and request.args.get('source') == 'db':
+        return jsonify(store.client_status(HEARTBEAT_TIMEOUT, status=status_filter,
+                                           limit=limit, offset=offset))
+    if status_filter is None and limit is None and not offset:
+        # ETag 与 since 增量基于上线/离线事件版本；time_since_heartbeat 等时间字段不参与版本比较
+        return _sync_response(heartbeat_tracker.events, 'status', heartbeat_tracker.status_list,
+                              cache_body=False)
     
-    # 检查心跳超时（30秒未收到心跳视为离线）
-    for ip, info in client_heartbeats.items():
-        time_since_heartbeat = current_time - info['last_heartbeat']
-        if time_since_heartbeat > HEARTBEAT_TIMEOUT:
-            info['status'] = 'offline'
-        else:
-            info['status'] = 'online'
-        
-        # 添加额外信息
-        status_info = info.copy()
-        status_info['time_since_heartbeat'] = round(time_since_heartbeat, 2)
-        status_list.append(status_info)
-    
-    # 按状态排序：在线在前
-    status_list.sort(key=lambda x: (x['status'] != 'online', x.get('time_since_heartbeat', 0)))
-    
-    return jsonify(status_list)
+    return jsonify(heartbeat_tracker.status_list(status=status_filter, limit=limit, offset=offset))
+
+@app.route('/api/client_status/stream', methods=['GET'])
+def stream_client_status():
+    """
+    订阅客户端上线/离线变化（SSE），首次连接先推送全量状态
+    """
+    return _sse_stream(heartbeat_tracker.events, heartbeat_tracker.status_list)
+
+@app.route('/api/client_events', methods=['GET'])
+def client_events():
+    """
+    获取客户端上线/离线事件
+    参数: since 为上次返回的 cursor（"<纪元>:<序号>"），只返回之后的事件；
+          服务器重启后旧的 cursor 返回 events 为 null，需要重新获取全量状态
+    """
+    return jsonify(heartbeat_tracker.events_since(request.args.get('since')))
 
 # ----------------------- 结束新增 -----------------------
 
@@ -486,9 +1105,20 @@ def health_check():
     health_status = {
         'status': 'healthy',
         'timestamp': time.time(),
-        'client_count': len(ip_list),
-        'online_clients': len([h for h in client_heartbeats.values() if h.get('status') == 'online'])
+        'client_count': len(registry),
+        'online_clients': heartbeat_tracker.counts()['online'],
+        'persistence': persister.get_stats()
     }
+    if store is not None:
+        health_status['store'] = store.get_stats()
+    with checkin_lock:
+        health_status['checkin'] = {**checkin_stats, 'sessions': len(checkin_sessions)}
+    if udp_listener is not None:
+        health_status['udp_heartbeat'] = udp_listener.get_stats()
+    health_status['heartbeat_rate'] = heartbeat_policy.get_stats()
+    health_status['probe'] = prober.get_stats()
+    health_status['fleet_metrics'] = fleet_metrics.get_stats()
+    health_status['ledger'] = command_ledger.get_stats()
     
     if PERFORMANCE_MONITORING:
         health_status['performance'] = monitor.get_stats()
@@ -500,6 +1130,7 @@ def health_check():
 def get_stats():
     """
     获取性能统计信息
+    windows 中为最近 1/5/15 分钟的请求速率、错误率与延迟分位数，不受重置影响
     """
     if not PERFORMANCE_MONITORING:
         return jsonify({'error': 'Performance monitoring not available'}), 503
@@ -517,6 +1148,73 @@ def reset_stats():
     monitor.reset_stats()
     return jsonify({'status': 'success', 'message': 'Statistics reset'}), 200
 
+# ==================== Prometheus 指标 ====================
+
+# 只读取各组件已有的计数，渲染结果缓存 1 秒
+metrics = add_process_metrics(MetricsExporter('master', monitor))
+metrics.gauge('clients_registered', 'Clients in the registry', lambda: len(registry))
+metrics.gauge('clients', 'Clients by heartbeat status',
+              lambda: [({'status': status}, count) for status, count in heartbeat_tracker.counts().items()
+                       if status != 'total'])
+metrics.gauge('heartbeats_per_second', 'Average heartbeats per second over the last minute',
+              lambda: heartbeat_policy.meter.snapshot()['beats_per_second'])
+metrics.gauge('heartbeat_interval_seconds', 'Recommended heartbeat interval',
+              lambda: heartbeat_policy.recommend(len(registry)))
+metrics.counter('checkins', 'Check-in requests by result',
+                lambda: [({'result': key}, value) for key, value in checkin_stats.items()])
+metrics.counter('udp_heartbeat_datagrams', 'UDP heartbeat datagrams by outcome',
+                lambda: [({'outcome': key}, udp_listener.stats[key])
+                         for key in ('received', 'invalid', 'lost', 'reordered', 'duplicates')])
+metrics.gauge('broadcast_jobs_running', 'Broadcast jobs not yet finished', job_manager.running_count)
+metrics.gauge('persistence_pending_journal_records', 'Registry changes waiting to be written',
+              lambda: persister.get_stats()['pending_journal_records'])
+if store is not None:
+    metrics.gauge('store_pending_writes', 'Operations queued for the SQLite writer',
+                  lambda: [({'kind': 'clients'}, store.get_stats()['pending_client_ops']),
+                           ({'kind': 'heartbeats'}, store.get_stats()['pending_heartbeats'])])
+metrics.gauge('probe_clients', 'Probe cache by reachability',
+              lambda: [({'state': 'reachable'}, prober.get_stats()['reachable']),
+                       ({'state': 'cached'}, prober.get_stats()['cached'])])
+
+metrics.gauge('fleet_clients_reporting', 'Clients with a recent metrics report',
+              lambda: fleet_metrics.get_stats()['reporting'])
+metrics.counter('fleet_metric_reports', 'Client metrics reports by outcome',
+                lambda: [({'outcome': key}, value) for key, value in fleet_metrics.stats.items()])
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus 文本格式指标
+    """
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    采样分析所有线程的调用栈（需设置 DEBUG_TOKEN），见 stack_profiler
+    """
+    result, status = profile_request(request.args, request.headers)
+    if isinstance(result, str):
+        return Response(result, mimetype='text/plain'), status
+    return jsonify(result), status
+
+@app.route('/debug/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """
+    查询最近的慢请求（耗时超过所在路由的阈值，见 slow_requests）
+    参数: endpoint（如 "POST /run_extract_amount"）、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": slow_log.get_stats(),
+        "requests": slow_log.query(request.args.get('endpoint'), min_ms, limit)
+    })
+
 
 # ------------------------ WebSocket 连接到云端（可选功能） ------------------------
 # 注意：这是可选功能，用于从云端接收远程指令
@@ -587,6 +1285,8 @@ if __name__ == '__main__':
     else:
         print("WebSocket云端连接已禁用，仅使用内网通信（更快、更稳定）")
     
+    start_udp_heartbeat_listener()
+    
     # 启用多线程模式，支持高并发处理
     # debug=False 提高生产环境性能
     app.run(debug=False, host="0.0.0.0", port=5000, threaded=True)
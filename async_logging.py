@@ -0,0 +1,97 @@
+"""
+异步日志模块
+请求线程只把日志记录放入有界队列，文件与控制台输出由 QueueListener 后台线程完成；
+队列满时丢弃新记录并计数，不阻塞请求线程。
+高频的逐条日志（如 OCR 每个预处理方法与配置组合的识别结果）可按 logger 加令牌桶限流，
+被限流的条数计数，并在下一条放行的日志后注明
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录并计数的 QueueHandler（标准实现会打印异常堆栈）"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self._stats_lock = threading.Lock()
+        self.stats = {'enqueued': 0, 'dropped': 0}
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats['dropped'] += 1
+            return
+        with self._stats_lock:
+            self.stats['enqueued'] += 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {**self.stats, 'pending': self.queue.qsize(), 'capacity': self.queue.maxsize}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    令牌桶限流过滤器，挂在 logger 上对该 logger 的全部记录生效
+    参数:
+        rate: 每秒允许的记录数
+        burst: 允许的突发条数
+    """
+
+    def __init__(self, rate=5.0, burst=20):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._suppressed_since = 0  # 上一条放行记录之后被限流的条数
+        self.stats = {'passed': 0, 'suppressed': 0}
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self.lock:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                self._suppressed_since += 1
+                self.stats['suppressed'] += 1
+                return False
+            self._tokens -= 1
+            self.stats['passed'] += 1
+            suppressed, self._suppressed_since = self._suppressed_since, 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} (此前 {suppressed} 条同类日志被限流)"
+            record.args = None
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'rate': self.rate, 'burst': self.burst}
+
+
+def setup_queue_logging(*handlers, queue_size=10000):
+    """
+    把 handlers 移到后台线程：返回 (DroppingQueueHandler, QueueListener)，
+    调用方把前者加到 logger 上；进程退出时停止监听线程并写完队列中剩余的记录
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return queue_handler, listener
+
+
+def rate_limited_logger(name, rate=5.0, burst=20):
+    """返回带 RateLimitFilter 的 logger（记录仍传播到根 logger 的队列），以及该过滤器"""
+    rate_filter = RateLimitFilter(rate, burst)
+    named = logging.getLogger(name)
+    named.addFilter(rate_filter)
+    return named, rate_filter
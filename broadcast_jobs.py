@@ -0,0 +1,172 @@
+"""
+批量指令任务模块
+将广播指令变为异步任务：提交后立即返回任务ID，
+每个客户端的结果在完成时即可被流式读取，最终汇总可单独查询
+"""
+import asyncio
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class BroadcastJob:
+    """单个广播任务的状态与结果"""
+
+    def __init__(self, job_id, key, total):
+        self.job_id = job_id
+        self.key = key
+        self.total = total
+        self.results = []
+        self.success_count = 0
+        self.error_count = 0
+        self.created_at = time.time()
+        self.finished_at = None
+        self.error = None
+        self.meta = {}  # 发送方式等附加信息，例如中继统计
+        self.cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def add_result(self, result):
+        """追加一个客户端的结果并唤醒所有等待中的读取者"""
+        with self.cond:
+            self.results.append(result)
+            if result.get("status") == "success":
+                self.success_count += 1
+            else:
+                self.error_count += 1
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        """标记任务结束"""
+        with self.cond:
+            self.error = error
+            self.finished_at = time.time()
+            self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        """阻塞等待任务结束，返回是否已结束"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.done, timeout=timeout)
+
+    def summary(self):
+        """返回任务汇总（不含逐个结果）"""
+        with self.cond:
+            end = self.finished_at or time.time()
+            return {
+                "job_id": self.job_id,
+                "key": self.key,
+                "state": ("failed" if self.error else "done") if self.done else "running",
+                "total": self.total,
+                "completed": len(self.results),
+                "pending": self.total - len(self.results),
+                "success": self.success_count,
+                "error": self.error_count,
+                "elapsed_time": round(end - self.created_at, 3),
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+                "message": self.error,
+                **self.meta
+            }
+
+    def iter_results(self, keepalive=15):
+        """
+        按完成顺序逐个产出结果，直到任务结束
+        等待超过 keepalive 秒没有新结果时产出 None，供调用方发送保活数据
+        """
+        index = 0
+        while True:
+            with self.cond:
+                if index >= len(self.results) and not self.done:
+                    self.cond.wait(timeout=keepalive)
+                batch = self.results[index:]
+                index += len(batch)
+                finished = self.done and index >= len(self.results)
+            if not batch and not finished:
+                yield None
+            for result in batch:
+                yield result
+            if finished:
+                return
+
+
+class JobManager:
+    """
+    广播任务管理器
+    所有任务共享一个后台事件循环线程，提交任务不会占用 Flask 工作线程
+    """
+
+    def __init__(self, max_jobs=200):
+        self.max_jobs = max_jobs  # 最多保留的任务数，超出后淘汰最早结束的任务
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def _run_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def _ensure_loop(self):
+        """懒启动后台事件循环"""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, args=(loop,),
+                                 name="broadcast-loop", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def _evict(self):
+        """淘汰多余的已结束任务（调用方需持有锁）"""
+        if len(self._jobs) <= self.max_jobs:
+            return
+        for job_id in [j for j, job in self._jobs.items() if job.done]:
+            if len(self._jobs) <= self.max_jobs:
+                break
+            del self._jobs[job_id]
+
+    def submit(self, key, total, runner):
+        """
+        提交广播任务
+        参数:
+            key: 指令内容（用于展示）
+            total: 目标客户端数量
+            runner: 协程函数 runner(job)，负责发送并通过 job.add_result 上报结果
+        返回:
+            BroadcastJob
+        """
+        job = BroadcastJob(uuid.uuid4().hex[:12], key, total)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict()
+        loop = self._ensure_loop()
+        asyncio.run_coroutine_threadsafe(self._run(job, runner), loop)
+        return job
+
+    async def _run(self, job, runner):
+        try:
+            await runner(job)
+            job.finish()
+        except Exception as e:
+            job.finish(str(e))
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def running_count(self):
+        """未结束的任务数"""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.done)
+
+    def list_summaries(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [job.summary() for job in reversed(jobs)]
+
+
+# 全局任务管理器实例
+job_manager = JobManager()
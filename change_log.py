@@ -0,0 +1,87 @@
+"""
+版本化变更日志模块
+为注册表、心跳状态等数据维护单调递增的版本号与最近的变更记录，
+用于 ETag 缓存校验、since=<版本> 增量同步以及长轮询/SSE 订阅。
+版本号在每个进程中都从 0 开始，对外使用带进程纪元的版本标记 "<纪元>:<版本>"：
+服务器重启后纪元不同，旧标记一律要求全量同步，不会与新进程的同号版本混淆
+"""
+import threading
+import uuid
+from collections import deque
+from itertools import islice
+
+
+class ChangeLog:
+    """
+    有界变更日志
+    参数:
+        max_entries: 保留的变更条数；请求的版本早于最旧记录时需要全量同步
+    """
+
+    def __init__(self, max_entries=10000):
+        self.cond = threading.Condition()
+        self._entries = deque(maxlen=max_entries)  # (版本, 记录)
+        self._version = 0
+        self._reset_version = 0  # 最近一次整体替换（如重新加载）的版本
+        self.epoch = uuid.uuid4().hex[:8]  # 进程纪元，区分不同进程（重启前后）产生的版本
+
+    @property
+    def version(self):
+        return self._version
+
+    def token(self, version=None):
+        """对外的版本标记 "<纪元>:<版本>"，用于 ETag、since 参数与 SSE 事件 id"""
+        return f'{self.epoch}:{self._version if version is None else version}'
+
+    def parse_token(self, token):
+        """
+        解析版本标记，返回本进程的版本号
+        纪元不同（服务器已重启）、没有纪元的旧格式或无法解析时返回 None，调用方应全量同步
+        """
+        epoch, sep, version = (token or '').partition(':')
+        if not sep or epoch != self.epoch:
+            return None
+        try:
+            return int(version)
+        except ValueError:
+            return None
+
+    def append(self, record):
+        """追加一条变更，返回新版本号"""
+        with self.cond:
+            self._version += 1
+            self._entries.append((self._version, record))
+            self.cond.notify_all()
+            return self._version
+
+    def reset(self):
+        """记录一次整体替换：之前的版本都只能通过全量同步获取"""
+        with self.cond:
+            self._version += 1
+            self._entries.clear()
+            self._reset_version = self._version
+            self.cond.notify_all()
+            return self._version
+
+    def since(self, version):
+        """
+        返回 version 之后的变更
+        返回:
+            (变更记录列表, 当前版本)；version 无法增量同步（日志已截断、发生过整体替换或服务器已重启）时变更列表为 None
+        """
+        with self.cond:
+            if version == self._version:
+                return [], self._version
+            oldest = self._entries[0][0] if self._entries else self._version + 1
+            # 版本比当前还新说明服务器已重启，同样需要全量同步
+            if version > self._version or version < self._reset_version or version + 1 < oldest:
+                return None, self._version
+            # 日志按版本递增且连续，直接定位起点
+            start = len(self._entries) - (self._version - version)
+            return [record for _, record in islice(self._entries, start, None)], self._version
+
+    def wait(self, version, timeout):
+        """阻塞直到版本大于 version 或超时，返回当前版本"""
+        with self.cond:
+            self.cond.wait_for(lambda: self._version > version, timeout=timeout)
+            return self._version
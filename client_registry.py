@@ -0,0 +1,244 @@
+"""
+客户端注册表模块
+替代全局 ip_list：按 IP 和 PC 名称建立字典索引，注册、更新、删除均为 O(1)，
+读取方通过写时复制的快照访问，无需加锁也不会看到中途修改的数据
+
+运行本文件可执行 10000 个客户端规模的微基准测试:
+    python client_registry.py
+"""
+import itertools
+import threading
+import time
+
+from client_selector import ClientIndex
+
+
+class ClientRegistry:
+    """
+    线程安全的客户端注册表
+    每条记录为字典，例如 {"ip": "192.168.0.123", "pc_name": "PC_A", "tags": ["room1"]}
+    记录一经发布即不再原地修改：更新时生成新字典替换，已取出的快照保持不变
+    """
+
+    def __init__(self, replace_same_name=False):
+        # replace_same_name 为 True 时，注册的 PC 名称已被其他 IP 使用则先删除旧记录（app.py 的语义）
+        self.replace_same_name = replace_same_name
+        self.lock = threading.RLock()
+        self._by_ip = {}    # ip -> 记录（保持注册顺序）
+        self._by_name = {}  # pc_name -> {ip: None}（同名客户端可能有多个）
+        self._order = {}    # ip -> 注册序号（更新记录时保持不变），用于按注册顺序返回子集
+        self._seq = itertools.count()
+        self.index = ClientIndex()  # 标签、窗口数、名称前缀等二级索引
+        self._snapshot = None
+        self.version = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        注册变更回调 callback(op, ip, entry)，在持有锁时按变更顺序调用，回调应尽快返回
+        op 为 'put'（entry 为新记录）、'remove'（entry 为 None）或 'load'（整体替换，ip 与 entry 为 None）
+        """
+        self._listeners.append(callback)
+
+    # ---------------- 读取 ----------------
+
+    def snapshot(self):
+        """
+        返回所有记录的列表快照（写时复制）
+        没有修改时多次调用返回同一个列表对象，调用方不得修改
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self.lock:
+                if self._snapshot is None:
+                    self._snapshot = list(self._by_ip.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def get(self, ip):
+        return self._by_ip.get(ip)
+
+    def find_by_name(self, pc_name):
+        """返回使用该 PC 名称的所有记录"""
+        with self.lock:
+            return [self._by_ip[ip] for ip in self._by_name.get(pc_name, ())]
+
+    def find_by_name_prefix(self, prefix):
+        """
+        返回 PC 名称以 prefix 开头的记录（区分大小写），按注册顺序
+        与 SQLiteStore.list_clients(name_prefix=) 的结果一致；prefix 按原样匹配，不经过选择器语法解析
+        """
+        with self.lock:
+            ips = [ip for ip in self.index.names_with_prefix(prefix)
+                   if (self._by_ip[ip].get('pc_name') or '').startswith(prefix)]
+            ips.sort(key=self._order.__getitem__)
+            return [self._by_ip[ip] for ip in ips]
+
+    def __contains__(self, ip):
+        return ip in self._by_ip
+
+    def __len__(self):
+        return len(self._by_ip)
+
+    # ---------------- 修改（调用方无需加锁） ----------------
+
+    def _changed(self, op, ip=None, entry=None):
+        self._snapshot = None
+        self.version += 1
+        for callback in self._listeners:
+            callback(op, ip, entry)
+
+    def _link_name(self, entry):
+        self._by_name.setdefault(entry.get('pc_name'), {})[entry['ip']] = None
+
+    def _unlink_name(self, entry):
+        ips = self._by_name.get(entry.get('pc_name'))
+        if ips is not None:
+            ips.pop(entry['ip'], None)
+            if not ips:
+                del self._by_name[entry.get('pc_name')]
+
+    def _remove_locked(self, ip):
+        entry = self._by_ip.pop(ip, None)
+        if entry is None:
+            return None
+        self._unlink_name(entry)
+        self._order.pop(ip, None)
+        self.index.remove(ip)
+        return entry
+
+    def _put_locked(self, entry):
+        old = self._by_ip.get(entry['ip'])
+        if old is not None:
+            self._unlink_name(old)
+        else:
+            self._order[entry['ip']] = next(self._seq)
+        self._by_ip[entry['ip']] = entry
+        self._link_name(entry)
+        self.index.add(entry)
+
+    def upsert(self, ip, pc_name=None, **fields):
+        """
+        注册或更新客户端
+        参数:
+            pc_name: PC 名称，新记录为空时使用 'Unknown'，已有记录为空时保持不变
+            fields: 其他字段（tags、window_count 等），值为 None 的字段忽略
+        返回:
+            (记录, 变化类型) 变化类型为 'added'、'updated' 或 None（无变化）
+        """
+        fields = {k: v for k, v in fields.items() if v is not None}
+        with self.lock:
+            replaced = False
+            if self.replace_same_name:
+                for other_ip in list(self._by_name.get(pc_name, ())):
+                    if other_ip != ip:
+                        self._remove_locked(other_ip)
+                        self._changed('remove', other_ip)
+                        replaced = True
+
+            existing = self._by_ip.get(ip)
+            if existing is None:
+                entry = {'ip': ip, 'pc_name': pc_name if pc_name is not None else 'Unknown', **fields}
+                self._put_locked(entry)
+                self._changed('put', ip, entry)
+                return entry, 'added'
+
+            if pc_name is not None:
+                fields['pc_name'] = pc_name
+            if all(existing.get(k) == v for k, v in fields.items()):
+                return existing, 'updated' if replaced else None
+            entry = {**existing, **fields}
+            self._put_locked(entry)
+            self._changed('put', ip, entry)
+            return entry, 'updated'
+
+    def update(self, ip, **fields):
+        """更新已有客户端的字段，客户端不存在时返回 None"""
+        with self.lock:
+            if ip not in self._by_ip:
+                return None
+            entry, _ = self.upsert(ip, **fields)
+            return entry
+
+    def remove(self, ip):
+        """删除客户端，返回被删除的记录（不存在时为 None）"""
+        with self.lock:
+            entry = self._remove_locked(ip)
+            if entry is not None:
+                self._changed('remove', ip)
+            return entry
+
+    def load(self, entries):
+        """用记录列表替换注册表全部内容（用于启动时从文件加载）"""
+        with self.lock:
+            self._by_ip.clear()
+            self._by_name.clear()
+            self._order.clear()
+            for entry in entries:
+                if entry.get('ip'):
+                    if entry['ip'] not in self._by_ip:
+                        self._order[entry['ip']] = next(self._seq)
+                    self._by_ip[entry['ip']] = dict(entry)
+                    self._link_name(self._by_ip[entry['ip']])
+            self.index.rebuild(self._by_ip.values())
+            self._changed('load')
+
+
+def _benchmark(count=10000):
+    """与旧的列表实现对比注册、重复注册、删除与快照的耗时"""
+    ips = [f"10.{i // 65536}.{(i // 256) % 256}.{i % 256}" for i in range(count)]
+
+    def report(name, seconds, ops):
+        print(f"{name:<36s} {seconds * 1000:10.2f} ms  {ops / seconds:14,.0f} ops/s")
+
+    print(f"客户端数量: {count}")
+
+    registry = ClientRegistry()
+    start = time.perf_counter()
+    for i, ip in enumerate(ips):
+        registry.upsert(ip, f"PC-{i}")
+    report("registry 首次注册", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    for i, ip in enumerate(ips):
+        registry.upsert(ip, f"PC-{i}")
+    report("registry 重复注册（无变化）", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        registry._snapshot = None
+        registry.snapshot()
+    report("registry 快照重建 x1000", time.perf_counter() - start, 1000)
+
+    start = time.perf_counter()
+    for _ in range(1000):
+        registry.snapshot()
+    report("registry 快照读取（缓存） x1000", time.perf_counter() - start, 1000)
+
+    start = time.perf_counter()
+    for ip in ips:
+        registry.remove(ip)
+    report("registry 删除", time.perf_counter() - start, count)
+
+    # 旧实现：每次注册都用 any() 扫描列表，删除时重建列表
+    legacy = []
+    sample = min(count, 2000)
+    start = time.perf_counter()
+    for i, ip in enumerate(ips):
+        if not any(entry['ip'] == ip for entry in legacy):
+            legacy.append({'ip': ip, 'pc_name': f"PC-{i}"})
+    report("list 首次注册", time.perf_counter() - start, count)
+
+    start = time.perf_counter()
+    for ip in ips[:sample]:
+        any(entry['ip'] == ip for entry in legacy)
+    report(f"list 重复注册（抽样 {sample}）", time.perf_counter() - start, sample)
+
+    start = time.perf_counter()
+    for ip in ips[:sample]:
+        legacy = [entry for entry in legacy if entry['ip'] != ip]
+    report(f"list 删除（抽样 {sample}）", time.perf_counter() - start, sample)
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,227 @@
+"""
+客户端分组与选择器模块
+为客户端列表维护内存二级索引（标签、PC名称前缀、窗口数），
+按选择器表达式解析目标客户端，耗时与匹配数量成正比而不是全表扫描
+
+选择器语法:
+    多个条件用空格或 & 连接，表示同时满足（AND）
+    同一条件内的多个值用逗号分隔，表示满足其一（OR）
+    条件前加 ! 表示排除
+    支持的条件:
+        all 或 *            所有客户端
+        ip:192.168.0.10     指定IP
+        tag:room1           带有该标签
+        name:PC-A*          PC名称前缀匹配（不带 * 为精确匹配，不区分大小写）
+        windows:3           窗口数等于3，也支持 >=3、<=3、>3、<3
+    例如: "tag:room1,room2 & name:PC-A* & !windows:0"
+"""
+import bisect
+import threading
+
+
+class SelectorError(ValueError):
+    """选择器表达式无效"""
+
+
+def normalize_tags(tags):
+    """将标签参数规范化为去重后的有序列表，支持列表或逗号分隔字符串"""
+    if not tags:
+        return []
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    if not isinstance(tags, (list, tuple, set)):
+        raise SelectorError("tags must be a list or comma separated string")
+    return sorted({str(t).strip() for t in tags if str(t).strip()})
+
+
+def _parse_window_count(value):
+    """将窗口数规范化为整数，无效值返回 None"""
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ClientIndex:
+    """
+    客户端二级索引
+    by_ip: ip -> 客户端记录
+    by_tag: 标签 -> ip 集合
+    by_windows: 窗口数 -> ip 集合
+    by_name: ip -> (小写PC名称, ip)
+    名称前缀查询使用按小写名称排序的列表二分查找；该列表在查询时按需重建，
+    注册、更新、删除只修改字典（O(1)），排序的 O(n log n) 代价只在名称变化后的第一次前缀查询时付出
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_ip = {}
+        self.by_tag = {}
+        self.by_windows = {}
+        self.by_name = {}
+        self._sorted_names = None  # 按需重建的有序 (小写PC名称, ip) 列表，名称变化后置空
+        # 记录每个 ip 建索引时使用的键，记录被原地修改后仍能准确移除旧索引
+        self._indexed_keys = {}
+
+    def rebuild(self, entries):
+        """根据客户端列表重建全部索引"""
+        with self.lock:
+            self.by_ip.clear()
+            self.by_tag.clear()
+            self.by_windows.clear()
+            self._indexed_keys.clear()
+            self.by_name.clear()
+            self._sorted_names = None
+            for entry in entries:
+                self.add(entry)
+
+    def add(self, entry):
+        """添加或更新一条客户端记录的索引"""
+        with self.lock:
+            ip = entry['ip']
+            if ip in self.by_ip:
+                self.remove(ip)
+            tags = tuple(entry.get('tags') or ())
+            window_count = _parse_window_count(entry.get('window_count'))
+            name_key = ((entry.get('pc_name') or '').lower(), ip)
+            self.by_ip[ip] = entry
+            self._indexed_keys[ip] = (tags, window_count, name_key)
+            for tag in tags:
+                self.by_tag.setdefault(tag, set()).add(ip)
+            if window_count is not None:
+                self.by_windows.setdefault(window_count, set()).add(ip)
+            self.by_name[ip] = name_key
+            self._sorted_names = None
+
+    def remove(self, ip):
+        """移除一条客户端记录的索引"""
+        with self.lock:
+            if self.by_ip.pop(ip, None) is None:
+                return
+            tags, window_count, name_key = self._indexed_keys.pop(ip)
+            for tag in tags:
+                ips = self.by_tag.get(tag)
+                if ips is not None:
+                    ips.discard(ip)
+                    if not ips:
+                        del self.by_tag[tag]
+            if window_count is not None:
+                ips = self.by_windows.get(window_count)
+                if ips is not None:
+                    ips.discard(ip)
+                    if not ips:
+                        del self.by_windows[window_count]
+            del self.by_name[ip]
+            self._sorted_names = None
+
+    def tag_counts(self):
+        """返回每个标签下的客户端数量"""
+        with self.lock:
+            return {tag: len(ips) for tag, ips in self.by_tag.items()}
+
+    # ---------------- 选择器解析 ----------------
+
+    def names_with_prefix(self, prefix):
+        """返回 PC 名称以 prefix 开头（不区分大小写）的 IP 集合，prefix 按原样匹配，不做选择器解析"""
+        with self.lock:
+            return self._match_name(prefix, is_prefix=True)
+
+    def _match_name(self, value, is_prefix=None):
+        value = value.lower()
+        if is_prefix is None:
+            is_prefix = value.endswith('*')
+            if is_prefix:
+                value = value[:-1]
+        names = self._sorted_names
+        if names is None:
+            names = self._sorted_names = sorted(self.by_name.values())
+        # 二分定位起点后顺序扫描，代价为 O(log n + 匹配数)
+        pos = bisect.bisect_left(names, (value, ''))
+        result = set()
+        while pos < len(names):
+            name, ip = names[pos]
+            if not (name.startswith(value) if is_prefix else name == value):
+                break
+            result.add(ip)
+            pos += 1
+        return result
+
+    def _match_windows(self, value):
+        for op in ('>=', '<=', '>', '<', '='):
+            if value.startswith(op):
+                number = value[len(op):]
+                break
+        else:
+            op, number = '=', value
+        try:
+            number = int(number)
+        except ValueError:
+            raise SelectorError(f"Invalid window count: {value}")
+        if op == '=':
+            return set(self.by_windows.get(number, ()))
+        compare = {
+            '>=': lambda n: n >= number,
+            '<=': lambda n: n <= number,
+            '>': lambda n: n > number,
+            '<': lambda n: n < number,
+        }[op]
+        # 不同窗口数的取值很少，遍历取值而不是遍历客户端
+        result = set()
+        for count, ips in self.by_windows.items():
+            if compare(count):
+                result |= ips
+        return result
+
+    def _match_term(self, term):
+        if term in ('all', '*'):
+            return set(self.by_ip)
+        field, sep, values = term.partition(':')
+        if not sep or not values:
+            raise SelectorError(f"Invalid selector term: {term}")
+        field = field.lower()
+        result = set()
+        for value in values.split(','):
+            value = value.strip()
+            if not value:
+                continue
+            if field == 'ip':
+                if value in self.by_ip:
+                    result.add(value)
+            elif field == 'tag':
+                result |= self.by_tag.get(value, set())
+            elif field == 'name':
+                result |= self._match_name(value)
+            elif field == 'windows':
+                result |= self._match_windows(value)
+            else:
+                raise SelectorError(f"Unknown selector field: {field}")
+        return result
+
+    def resolve(self, selector):
+        """
+        解析选择器表达式
+        返回: 匹配的客户端记录列表（按 IP 排序）
+        """
+        if selector is None or not str(selector).strip():
+            raise SelectorError("Selector is empty")
+        terms = str(selector).replace('&', ' ').split()
+        with self.lock:
+            include, exclude = [], []
+            for term in terms:
+                if term.startswith('!'):
+                    exclude.append(self._match_term(term[1:]))
+                else:
+                    include.append(self._match_term(term))
+            if include:
+                # 从最小集合开始求交集，代价取决于最小的匹配集合
+                include.sort(key=len)
+                matched = set(include[0])
+                for other in include[1:]:
+                    matched &= other
+                    if not matched:
+                        break
+            else:
+                matched = set(self.by_ip)
+            for other in exclude:
+                matched -= other
+            return [self.by_ip[ip] for ip in sorted(matched)]
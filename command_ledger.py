@@ -0,0 +1,272 @@
+"""
+指令延迟账本模块
+每次下发指令（广播任务或单个发送）追加写入定长二进制记录：
+- 指令记录：序号、时间、指令 ID（任务 ID / 追踪 ID）、按键或序列描述、发送方式、目标数量
+- 客户端记录：指令序号、时间、IP、结果代码、尝试次数、跳数、延迟
+按小时分段存放（commands-YYYYMMDDHH.bin / results-YYYYMMDDHH.bin，UTC 时间，不受时区与夏令时切换影响），
+超过保留时长的分段整段删除；
+写入由后台线程批量完成，查询按时间范围只读取相关分段，用 struct.iter_unpack 顺序解析
+"""
+import calendar
+import ipaddress
+import math
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from performance_monitor import LatencyHistogram
+
+# 指令记录：序号, 时间, 类型(0 按键 / 1 序列), 发送方式, 目标数量, 指令 ID, 描述（UTF-8 截断）
+COMMAND_RECORD = struct.Struct('<IdBBxxI16s48s')
+# 客户端记录：指令序号, 时间（秒）, IPv4, 结果代码, 尝试次数, 跳数, 延迟（秒）
+RESULT_RECORD = struct.Struct('<II4sBBBxf')
+
+OUTCOMES = ('success', 'timeout', 'connection_error', 'http_error', 'error')
+MODES = ('direct', 'relay', 'single')
+SEGMENT_FORMAT = '%Y%m%d%H'
+
+
+def classify_result(result):
+    """把下发结果映射为结果代码（OUTCOMES 的下标）"""
+    if result.get('status') == 'success':
+        return 0
+    message = str(result.get('message', ''))
+    if 'timed out' in message.lower():
+        return 1
+    if message.startswith('Connection error'):
+        return 2
+    if message.startswith('HTTP '):
+        return 3
+    return 4
+
+
+def _pack_ip(ip):
+    try:
+        return socket.inet_aton(ip)
+    except (OSError, TypeError):
+        return b'\0\0\0\0'  # 未知或非 IPv4 地址
+
+
+def _text(raw):
+    return raw.rstrip(b'\0').decode('utf-8', errors='ignore')
+
+
+class CommandLedger:
+    """
+    指令账本
+    参数:
+        directory: 分段文件所在目录
+        retention_hours: 保留的小时数，更早的分段被删除
+        flush_interval: 批量写盘间隔（秒），查询结果最多滞后该时长
+    """
+
+    def __init__(self, directory='ledger', retention_hours=168, flush_interval=1.0):
+        self.directory = directory
+        self.retention_hours = retention_hours
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._next_no = None
+        self._thread = None
+        self.stats = {'commands': 0, 'results': 0, 'flushes': 0, 'segments_removed': 0, 'write_errors': 0}
+
+    def start(self):
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._next_no = self._last_command_no() + 1
+            self._thread = threading.Thread(target=self._run, name="command-ledger", daemon=True)
+            self._thread.start()
+        return self
+
+    # ---------------- 写入（请求线程 / 任务循环中调用，只入队） ----------------
+
+    def begin(self, command_id, command, target_count, mode, description=''):
+        """记录一条指令，返回其序号（供 record_result 使用）"""
+        with self.lock:
+            number = self._next_no
+            self._next_no += 1
+            self.stats['commands'] += 1
+        record = COMMAND_RECORD.pack(
+            number, time.time(), 1 if 'sequence' in command else 0, MODES.index(mode), target_count,
+            command_id.encode('ascii', errors='ignore')[:16], description.encode('utf-8')[:48])
+        self._queue.put(('commands', time.time(), record))
+        return number
+
+    def record_result(self, number, result, latency=None):
+        """记录一个客户端的结果；latency 为空时使用结果中的 latency 字段"""
+        latency = latency if latency is not None else result.get('latency')
+        now = time.time()
+        record = RESULT_RECORD.pack(
+            number, int(now), _pack_ip(result.get('ip')), classify_result(result),
+            min(int(result.get('attempt') or 1), 255), min(int(result.get('hop') or 0), 255),
+            float(latency) if latency is not None else float('nan'))
+        with self.lock:
+            self.stats['results'] += 1
+        self._queue.put(('results', now, record))
+
+    # ---------------- 后台写盘与保留 ----------------
+
+    def _segment_path(self, kind, timestamp):
+        return os.path.join(self.directory, f'{kind}-{time.strftime(SEGMENT_FORMAT, time.gmtime(timestamp))}.bin')
+
+    def _run(self):
+        last_cleanup = 0
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+            if time.time() - last_cleanup > 600:
+                self.cleanup()
+                last_cleanup = time.time()
+
+    def flush(self):
+        """把队列中的记录按分段追加写入"""
+        batches = {}
+        while True:
+            try:
+                kind, timestamp, record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batches.setdefault(self._segment_path(kind, timestamp), []).append(record)
+        for path, records in batches.items():
+            try:
+                with open(path, 'ab') as f:
+                    f.write(b''.join(records))
+            except OSError as e:
+                print(f"写入指令账本失败: {e}")
+                with self.lock:
+                    self.stats['write_errors'] += 1
+        if batches:
+            with self.lock:
+                self.stats['flushes'] += 1
+
+    def _segments(self, kind):
+        """返回 [(分段开始时间, 路径)]，按时间排序"""
+        segments = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return segments
+        for name in names:
+            prefix, _, rest = name.partition('-')
+            if prefix != kind or not rest.endswith('.bin'):
+                continue
+            try:
+                start = calendar.timegm(time.strptime(rest[:-4], SEGMENT_FORMAT))
+            except ValueError:
+                continue
+            segments.append((start, os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def cleanup(self, now=None):
+        """删除超过保留时长的分段"""
+        oldest = (now or time.time()) - self.retention_hours * 3600
+        for kind in ('commands', 'results'):
+            for start, path in self._segments(kind):
+                if start + 3600 > oldest:
+                    break
+                try:
+                    os.remove(path)
+                    with self.lock:
+                        self.stats['segments_removed'] += 1
+                except OSError:
+                    pass
+
+    def _last_command_no(self):
+        segments = self._segments('commands')
+        if not segments:
+            return 0
+        with open(segments[-1][1], 'rb') as f:
+            data = f.read()
+        usable = len(data) - len(data) % COMMAND_RECORD.size  # 忽略写了一半的尾部记录
+        if not usable:
+            return 0
+        return COMMAND_RECORD.unpack_from(data, usable - COMMAND_RECORD.size)[0]
+
+    # ---------------- 查询 ----------------
+
+    def _read(self, kind, record, since):
+        for start, path in self._segments(kind):
+            if start + 3600 <= since:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            data = data[:len(data) - len(data) % record.size]
+            yield from record.iter_unpack(data)
+
+    @staticmethod
+    def _check_range(hours, limit):
+        if not (math.isfinite(hours) and hours >= 0):
+            raise ValueError("hours must be a non-negative finite number")
+        if limit < 0:
+            raise ValueError("limit must not be negative")
+
+    def commands(self, hours=24, limit=50):
+        """最近的指令记录，最新的在前；hours 或 limit 无效时抛出 ValueError"""
+        self._check_range(hours, limit)
+        since = time.time() - hours * 3600
+        rows = [row for row in self._read('commands', COMMAND_RECORD, since) if row[1] >= since]
+        return [{
+            'number': number, 'timestamp': timestamp, 'command_id': _text(command_id),
+            'kind': 'sequence' if kind else 'key', 'mode': MODES[mode], 'target_count': target_count,
+            'command': _text(description)
+        } for number, timestamp, kind, mode, target_count, command_id, description
+            in reversed(rows[max(0, len(rows) - limit):])]  # rows[-0:] 会返回全部
+
+    def query(self, hours=24, ip=None, number=None, limit=20):
+        """
+        按时间范围（及可选的 IP、指令序号）汇总客户端记录
+        返回:
+            outcomes: 各结果代码的数量
+            by_hour: 每小时的数量、错误率与延迟分位数
+            by_client: 各客户端的数量、错误率与延迟分位数，按 p90 延迟从高到低取前 limit 个
+        hours、limit 或 ip（须为 IPv4 地址）无效时抛出 ValueError
+        """
+        self._check_range(hours, limit)
+        try:
+            packed_ip = ipaddress.IPv4Address(ip).packed if ip else None
+        except ValueError:
+            raise ValueError(f"invalid IPv4 address: {ip}")
+        since = time.time() - hours * 3600
+        outcomes = [0] * len(OUTCOMES)
+        by_hour = {}
+        by_client = {}
+        for cmd_no, timestamp, raw_ip, outcome, attempts, _, latency in self._read('results', RESULT_RECORD, since):
+            if timestamp < since or (packed_ip and raw_ip != packed_ip) or (number is not None and cmd_no != number):
+                continue
+            outcomes[outcome] += 1
+            hour = timestamp - timestamp % 3600
+            for groups, key in ((by_hour, hour), (by_client, raw_ip)):
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = [0, 0, 0, LatencyHistogram()]  # 数量, 错误数, 重试数, 延迟
+                group[0] += 1
+                group[1] += outcome != 0
+                group[2] += attempts > 1
+                if latency == latency:  # 跳过 NaN（未知延迟）
+                    group[3].record(latency)
+
+        def row(group):
+            count, errors, retried, hist = group
+            return {'count': count, 'errors': errors, 'error_rate': round(errors / count, 4),
+                    'retried': retried, 'latency': hist.summary()}
+
+        clients = [{'ip': socket.inet_ntoa(raw_ip), **row(group)} for raw_ip, group in by_client.items()]
+        clients.sort(key=lambda c: c['latency'].get('p90', 0), reverse=True)
+        return {
+            'hours': hours,
+            'outcomes': dict(zip(OUTCOMES, outcomes)),
+            'by_hour': [{'hour': hour, **row(group)} for hour, group in sorted(by_hour.items())],
+            'by_client': clients[:limit],
+            'client_count': len(clients),
+        }
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'pending': self._queue.qsize(), 'directory': self.directory,
+                    'retention_hours': self.retention_hours}
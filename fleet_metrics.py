@@ -0,0 +1,197 @@
+"""
+全网指标汇总模块
+客户端在 HTTP 签到时按有限频率附带本机的紧凑统计（PerformanceMonitor.export() 的累计直方图与计数，
+以及 CPU/内存），主服务器保存每个客户端最近一次上报，并与上一次上报相减得到最近一个上报周期的增量；
+全网合计由各客户端的增量直方图合并得到，按 OCR 延迟、CPU、错误率对客户端排序并标出离群者
+"""
+import math
+import threading
+import time
+
+from performance_monitor import LatencyHistogram
+
+# 用于按 OCR 延迟排序的耗时项（tracing 的阶段耗时经 record_timing('ocr_stage', stage=...) 记录）
+OCR_TIMING = 'ocr_stage{stage=ocr}'
+RANK_KEYS = ('ocr_p90_ms', 'cpu', 'error_rate')
+# 离群判定的最低阈值：中位数为 0 时（如全网几乎没有错误）仍能标出错误率明显偏高的客户端
+OUTLIER_FLOORS = {'error_rate': 0.05}
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def _optional_number(value):
+    """把客户端上报的 CPU/内存转换为数值，缺失或无法转换时为 None（不影响排序）"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+class FleetMetrics:
+    """
+    客户端指标汇总表
+    参数:
+        max_age: 超过该秒数未上报的客户端不参与汇总
+        outlier_factor: 指标超过全网中位数该倍数的客户端视为离群
+    """
+
+    def __init__(self, max_age=600, outlier_factor=2.0):
+        self.max_age = max_age
+        self.outlier_factor = outlier_factor
+        self.lock = threading.Lock()
+        self._clients = {}  # ip -> 最近一次上报（含累计值与增量）
+        self.stats = {'reports': 0, 'rejected': 0, 'restarts': 0}
+
+    def _parse(self, report):
+        latency = LatencyHistogram.from_dict(report['latency']) if report.get('latency') else LatencyHistogram()
+        timings = {key: LatencyHistogram.from_dict(value)
+                   for key, value in (report.get('timings') or {}).items()}
+        return {
+            'requests': int(report.get('requests', 0)),
+            'errors': int(report.get('errors', 0)),
+            'latency': latency,
+            'timings': timings,
+            'cpu': _optional_number(report.get('cpu')),
+            'mem': _optional_number(report.get('mem')),
+        }
+
+    def update(self, ip, pc_name, report, now=None):
+        """
+        记录客户端的一次上报
+        累计值比上一次小（客户端重启）时，本次累计值整体作为增量
+        返回:
+            是否接受（格式错误的上报被丢弃并计数）
+        """
+        now = now or time.time()
+        try:
+            current = self._parse(report)
+        except (TypeError, ValueError, KeyError, IndexError, AttributeError):
+            with self.lock:
+                self.stats['rejected'] += 1
+            return False
+        with self.lock:
+            previous = self._clients.get(ip)
+            restarted = previous is not None and (current['requests'] < previous['requests']
+                                                  or current['latency'].count < previous['latency'].count)
+            if previous is None or restarted:
+                delta_latency = current['latency']
+                delta_timings = current['timings']
+                delta_requests, delta_errors = current['requests'], current['errors']
+                if restarted:
+                    self.stats['restarts'] += 1
+            else:
+                delta_latency = current['latency'].subtract(previous['latency'])
+                empty = LatencyHistogram()
+                delta_timings = {key: hist.subtract(previous['timings'].get(key, empty))
+                                 for key, hist in current['timings'].items()}
+                delta_requests = current['requests'] - previous['requests']
+                delta_errors = max(0, current['errors'] - previous['errors'])
+            current.update({
+                'ip': ip,
+                'pc_name': pc_name,
+                'received_at': now,
+                'period': now - previous['received_at'] if previous and not restarted else None,
+                'recent': {'requests': delta_requests, 'errors': delta_errors,
+                           'latency': delta_latency, 'timings': delta_timings},
+            })
+            self._clients[ip] = current
+            self.stats['reports'] += 1
+        return True
+
+    def remove(self, ip):
+        with self.lock:
+            self._clients.pop(ip, None)
+
+    def _live(self, now):
+        with self.lock:
+            return [c for c in self._clients.values() if now - c['received_at'] <= self.max_age]
+
+    @staticmethod
+    def _client_row(client, now):
+        recent = client['recent']
+        ocr = recent['timings'].get(OCR_TIMING)
+        requests = recent['requests']
+        return {
+            'ip': client['ip'],
+            'pc_name': client['pc_name'],
+            'age': round(now - client['received_at'], 1),
+            'period': round(client['period'], 1) if client['period'] is not None else None,
+            'requests': requests,
+            'errors': recent['errors'],
+            'error_rate': round(recent['errors'] / requests, 4) if requests else 0.0,
+            'latency_p99_ms': round(recent['latency'].percentile(99) * 1000, 2) if recent['latency'].count else None,
+            'ocr_count': ocr.count if ocr else 0,
+            'ocr_p90_ms': round(ocr.percentile(90) * 1000, 2) if ocr and ocr.count else None,
+            'cpu': client['cpu'],
+            'mem': client['mem'],
+            'total_requests': client['requests'],
+            'total_errors': client['errors'],
+        }
+
+    def summary(self, limit=10, now=None):
+        """
+        返回全网汇总：
+            fleet: 最近一个上报周期内的全网请求数、错误率、延迟与各项耗时分位数（秒）
+            rankings: 按 OCR p90 延迟（毫秒）、CPU、错误率从高到低的前 limit 个客户端
+            outliers: 任一指标超过全网中位数 outlier_factor 倍（且不低于 OUTLIER_FLOORS）的客户端
+        """
+        now = now or time.time()
+        clients = self._live(now)
+        latency = LatencyHistogram()
+        timings = {}
+        requests = errors = 0
+        rows = []
+        for client in clients:
+            recent = client['recent']
+            requests += recent['requests']
+            errors += recent['errors']
+            latency.merge(recent['latency'])
+            for key, hist in recent['timings'].items():
+                timings.setdefault(key, LatencyHistogram()).merge(hist)
+            rows.append(self._client_row(client, now))
+
+        rankings = {}
+        medians = {}
+        for key in RANK_KEYS:
+            ranked = [row for row in rows if row[key] is not None]
+            ranked.sort(key=lambda row: row[key], reverse=True)
+            rankings[key] = ranked[:limit]
+            medians[key] = _median([row[key] for row in ranked])
+
+        thresholds = {key: max((medians[key] or 0) * self.outlier_factor, OUTLIER_FLOORS.get(key, 0))
+                      for key in RANK_KEYS}
+        outliers = []
+        for row in rows:
+            reasons = [key for key in RANK_KEYS
+                       if row[key] is not None and thresholds[key] and row[key] > thresholds[key]]
+            if reasons:
+                outliers.append({**row, 'reasons': reasons})
+        outliers.sort(key=lambda row: len(row['reasons']), reverse=True)
+
+        return {
+            'timestamp': now,
+            'clients_reporting': len(clients),
+            'fleet': {
+                'requests': requests,
+                'errors': errors,
+                'error_rate': round(errors / requests, 4) if requests else 0.0,
+                'latency': latency.summary(),
+                'timings': {key: hist.summary() for key, hist in sorted(timings.items())},
+            },
+            'medians': medians,
+            'rankings': rankings,
+            'outliers': outliers[:limit],
+        }
+
+    def get_stats(self):
+        now = time.time()
+        with self.lock:
+            reporting = sum(1 for c in self._clients.values() if now - c['received_at'] <= self.max_age)
+            return {**self.stats, 'clients': len(self._clients), 'reporting': reporting}
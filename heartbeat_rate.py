@@ -0,0 +1,158 @@
+"""
+心跳速率控制模块
+主服务器根据客户端数量与当前负载计算推荐心跳间隔，并给每个客户端分配均匀分布的时间槽，
+签到响应中下发给客户端；同时统计实际达到的每秒心跳数与突发程度。
+推荐间隔不超过离线超时的 1/MISSED_BEATS，连续丢失几次心跳才会被判为离线，正常客户端不会在线/离线来回切换
+"""
+import math
+import threading
+import time
+
+
+class BeatRateMeter:
+    """
+    按秒分桶的心跳计数器（环形缓冲区）
+    参数:
+        window: 统计窗口（秒）
+    """
+
+    def __init__(self, window=60):
+        self.window = window
+        self.lock = threading.Lock()
+        self._counts = [0] * window
+        self._seconds = [0] * window  # 每个桶对应的整秒时间戳，用于识别过期桶
+
+    def record(self, now=None):
+        second = int(now or time.time())
+        slot = second % self.window
+        with self.lock:
+            if self._seconds[slot] != second:
+                self._seconds[slot] = second
+                self._counts[slot] = 0
+            self._counts[slot] += 1
+
+    def snapshot(self, now=None):
+        """
+        返回最近完整 window 秒（不含当前这一秒）的统计
+            beats_per_second: 平均每秒心跳数
+            peak_per_second: 最大的单秒心跳数
+            burstiness: 峰值 / 平均值（1 表示完全均匀）
+            cv: 每秒心跳数的变异系数
+        """
+        current = int(now or time.time())
+        with self.lock:
+            counts = [
+                self._counts[s % self.window] if self._seconds[s % self.window] == s else 0
+                for s in range(current - self.window, current)
+            ]
+        total = sum(counts)
+        mean = total / self.window
+        peak = max(counts)
+        variance = sum((c - mean) ** 2 for c in counts) / self.window
+        return {
+            'window_seconds': self.window,
+            'beats': total,
+            'beats_per_second': round(mean, 2),
+            'peak_per_second': peak,
+            'burstiness': round(peak / mean, 2) if mean else None,
+            'cv': round(math.sqrt(variance) / mean, 3) if mean else None,
+        }
+
+
+# 离线超时内至少容纳的心跳次数
+MISSED_BEATS = 3
+
+
+class HeartbeatPolicy:
+    """
+    心跳间隔与时间槽计算
+    参数:
+        target_rate: 主服务器希望承受的每秒心跳数
+        min_interval, max_interval: 推荐间隔的上下限（秒），max_interval 默认为 offline_timeout / MISSED_BEATS
+        offline_timeout: 主服务器判定客户端离线的超时（秒），max_interval 不得超过其 1/MISSED_BEATS
+    """
+
+    def __init__(self, target_rate=100, min_interval=2, max_interval=None, offline_timeout=30):
+        self.offline_timeout = offline_timeout
+        self.target_rate = target_rate
+        self.min_interval = min_interval
+        self.max_interval = self.interval_limit if max_interval is None else max_interval
+        self.slowdown = 1.0  # 运维手动设置的放慢倍数
+        self._validate(self.min_interval, self.max_interval)
+        self.meter = BeatRateMeter()
+        self.lock = threading.Lock()
+        self._slots = {}     # 客户端ID -> 时间槽序号
+        self._next_slot = 0
+
+    @property
+    def interval_limit(self):
+        """推荐间隔的上限：离线超时内至少发送 MISSED_BEATS 次心跳"""
+        return self.offline_timeout / MISSED_BEATS
+
+    def _validate(self, min_interval, max_interval):
+        if max_interval > self.interval_limit:
+            raise ValueError(f"max_interval must not exceed {self.interval_limit:g} seconds "
+                             f"(offline timeout {self.offline_timeout:g} / {MISSED_BEATS})")
+        if min_interval > max_interval:
+            raise ValueError("min_interval must not exceed max_interval")
+
+    def update(self, **fields):
+        """
+        调整 target_rate、slowdown、min_interval、max_interval；
+        任一值无效（非正数、非有限数或违反间隔上限）时抛出 ValueError，且不修改任何值
+        """
+        values = {}
+        for field, value in fields.items():
+            if field not in ('target_rate', 'slowdown', 'min_interval', 'max_interval'):
+                raise ValueError(f"unknown field: {field}")
+            value = float(value)
+            if not (math.isfinite(value) and value > 0):
+                raise ValueError(f"{field} must be a positive number")
+            values[field] = value
+        with self.lock:
+            self._validate(values.get('min_interval', self.min_interval),
+                           values.get('max_interval', self.max_interval))
+            for field, value in values.items():
+                setattr(self, field, value)
+
+    def slot_for(self, client_id):
+        """按首次出现顺序分配时间槽序号（稳定不变）"""
+        with self.lock:
+            slot = self._slots.get(client_id)
+            if slot is None:
+                slot = self._slots[client_id] = self._next_slot
+                self._next_slot += 1
+            return slot
+
+    def recommend(self, fleet_size, now=None):
+        """
+        根据客户端数量与实际负载返回推荐间隔（秒）
+        实际每秒心跳数超过目标时按比例放慢
+        """
+        base = max(fleet_size, 1) / self.target_rate
+        achieved = self.meter.snapshot(now)['beats_per_second']
+        pressure = max(1.0, achieved / self.target_rate)
+        interval = base * pressure * self.slowdown
+        return round(min(self.max_interval, max(self.min_interval, interval)), 2)
+
+    def assign(self, client_id, fleet_size, now=None):
+        """
+        返回 (interval, offset)
+        offset 为客户端在每个间隔内的发送时刻（秒），各时间槽在间隔内均匀分布
+        """
+        interval = self.recommend(fleet_size, now)
+        slot = self.slot_for(client_id)
+        slots = max(fleet_size, self._next_slot, 1)
+        offset = round((slot % slots) / slots * interval, 3)
+        return interval, offset
+
+    def get_stats(self):
+        return {
+            'target_rate': self.target_rate,
+            'min_interval': self.min_interval,
+            'max_interval': self.max_interval,
+            'offline_timeout': self.offline_timeout,
+            'slowdown': self.slowdown,
+            'assigned_slots': self._next_slot,
+            **self.meter.snapshot()
+        }
@@ -0,0 +1,176 @@
+"""
+心跳跟踪模块
+用到期时间最小堆维护客户端在线状态：心跳只更新最后心跳时间（O(1)），
+到期检查只处理截止时间已过的客户端，在线/离线计数与按最近心跳排序的视图随状态变化增量维护，
+每次状态切换记录一条上线/离线事件
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from change_log import ChangeLog
+
+
+class HeartbeatTracker:
+    """
+    客户端心跳表
+    参数:
+        timeout: 超过该秒数未收到心跳视为离线
+        max_events: 保留的状态切换事件数量
+    """
+
+    def __init__(self, timeout=30, max_events=2000):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._entries = {}                 # ip -> 心跳记录
+        self._online = OrderedDict()       # 在线客户端，末尾为最近心跳
+        self._offline = OrderedDict()      # 离线客户端，末尾为最近离线
+        self._heap = []                    # (截止时间, ip)，每个在线客户端一项
+        self.events = ChangeLog(max_entries=max_events)  # 上线/离线事件，版本号即事件序号
+        self._thread = None
+
+    def start(self, interval=1.0):
+        """启动后台到期检查线程，使离线事件及时产生"""
+        if self._thread is None:
+            def run():
+                while True:
+                    time.sleep(interval)
+                    self.expire()
+            self._thread = threading.Thread(target=run, name="heartbeat-expiry", daemon=True)
+            self._thread.start()
+        return self
+
+    def _emit(self, entry, now):
+        self.events.append({'timestamp': now, 'ip': entry['ip'], 'pc_name': entry.get('pc_name'),
+                            'status': entry['status'], 'last_heartbeat': entry['last_heartbeat']})
+
+    def _set_online(self, entry, now):
+        ip = entry['ip']
+        self._offline.pop(ip, None)
+        entry['status'] = 'online'
+        self._online[ip] = entry
+        heapq.heappush(self._heap, (entry['last_heartbeat'] + self.timeout, ip))
+        self._emit(entry, now)
+
+    def beat(self, ip, pc_name, now=None, **metrics):
+        """记录一次心跳"""
+        now = now or time.time()
+        with self.lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                entry = self._entries[ip] = {'ip': ip, 'pc_name': pc_name, 'last_heartbeat': now,
+                                             'status': 'offline'}
+            else:
+                # 乱序到达的旧心跳不回退时间
+                entry['last_heartbeat'] = max(entry['last_heartbeat'], now)
+                entry['pc_name'] = pc_name
+            entry.update(metrics)
+            if entry['status'] == 'online':
+                self._online.move_to_end(ip)
+            else:
+                self._set_online(entry, now)
+
+    def restore(self, entries, now=None):
+        """从持久化的心跳记录恢复（启动时），不产生事件"""
+        now = now or time.time()
+        with self.lock:
+            for record in sorted(entries, key=lambda e: e['last_heartbeat']):
+                entry = self._entries[record['ip']] = {**record}
+                if now - entry['last_heartbeat'] <= self.timeout:
+                    entry['status'] = 'online'
+                    self._online[entry['ip']] = entry
+                    heapq.heappush(self._heap, (entry['last_heartbeat'] + self.timeout, entry['ip']))
+                else:
+                    entry['status'] = 'offline'
+                    self._offline[entry['ip']] = entry
+
+    def remove(self, ip, now=None):
+        """
+        删除客户端的心跳记录（客户端已从注册表删除），产生 status 为 removed 的事件，
+        增量同步的订阅方据此移除该客户端
+        """
+        now = now or time.time()
+        with self.lock:
+            entry = self._entries.pop(ip, None)
+            if entry is not None:
+                self._online.pop(ip, None)
+                self._offline.pop(ip, None)
+                entry['status'] = 'removed'
+                self._emit(entry, now)
+            # 堆中残留的项在到期时因找不到记录而被丢弃
+
+    def expire(self, now=None):
+        """把截止时间已过的客户端标记为离线，返回本次离线的数量"""
+        now = now or time.time()
+        expired = 0
+        with self.lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                _, ip = heapq.heappop(heap)
+                entry = self._entries.get(ip)
+                if entry is None or entry['status'] != 'online':
+                    continue
+                deadline = entry['last_heartbeat'] + self.timeout
+                if deadline > now:
+                    # 期间收到过心跳：按新的截止时间重新入堆
+                    heapq.heappush(heap, (deadline, ip))
+                    continue
+                entry['status'] = 'offline'
+                del self._online[ip]
+                self._offline[ip] = entry
+                self._emit(entry, now)
+                expired += 1
+        return expired
+
+    def counts(self):
+        self.expire()
+        with self.lock:
+            return {'online': len(self._online), 'offline': len(self._offline), 'total': len(self._entries)}
+
+    def online_ips(self):
+        self.expire()
+        with self.lock:
+            return set(self._online)
+
+    def status_list(self, status=None, limit=None, offset=0):
+        """
+        返回客户端状态列表：在线在前、最近心跳在前
+        只复制需要返回的部分，耗时与返回数量成正比
+        """
+        self.expire()
+        now = time.time()
+        with self.lock:
+            views = []
+            if status in (None, 'online'):
+                views.append(reversed(self._online.values()))
+            if status in (None, 'offline'):
+                views.append(reversed(self._offline.values()))
+            result = []
+            skipped = 0
+            for view in views:
+                for entry in view:
+                    if skipped < offset:
+                        skipped += 1
+                        continue
+                    if limit is not None and len(result) >= limit:
+                        break
+                    item = dict(entry)
+                    item['time_since_heartbeat'] = round(now - entry['last_heartbeat'], 2)
+                    result.append(item)
+            return result
+
+    def events_since(self, cursor=None):
+        """
+        返回游标（上次返回的 cursor，格式 "<纪元>:<序号>"）之后的状态切换事件，游标为空时返回全部保留的事件
+        游标过旧（事件已被淘汰）或来自重启前的进程时 events 为 None，调用方应重新获取全量状态
+        """
+        seq = 0 if cursor is None else self.events.parse_token(cursor)
+        if seq is None:
+            events, latest = None, self.events.version
+        else:
+            events, latest = self.events.since(seq)
+        return {'latest_seq': latest, 'cursor': self.events.token(latest), 'events': events}
+
+    def __len__(self):
+        return len(self._entries)
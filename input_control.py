@@ -0,0 +1,470 @@
+"""
+输入控制模块
+定义按键序列（宏）指令的格式与执行方式，并提供客户端输入子系统：
+可替换的按键注入后端（win32 / pyautogui / 记录型）与单消费者优先级输入队列
+
+按键序列格式（/run 的请求体）:
+    {"sequence": [
+        {"key": "f7", "delay": 0.2, "hold": 0.05, "repeat": 3, "interval": 0.1},
+        "enter"
+    ]}
+    key: 按键名称（必填，字符串形式的步骤等价于 {"key": ...}）
+    delay: 执行该步骤前等待的秒数
+    hold: 按住的秒数，为0时直接按下松开
+    repeat: 重复次数
+    interval: 每次重复之间等待的秒数
+"""
+import concurrent.futures
+import itertools
+import math
+import queue
+import time
+import threading
+from concurrent.futures import Future
+
+# 限制单个序列的规模，避免一个请求长时间占用输入线程
+MAX_STEPS = 100
+MAX_REPEAT = 100
+MAX_SEQUENCE_SECONDS = 60
+
+
+class SequenceError(ValueError):
+    """按键序列格式无效"""
+
+
+class InputTimeout(TimeoutError):
+    """
+    输入操作未在超时内完成
+    outcome_unknown 为假时操作仍在排队、已被取消，不会再执行；
+    为真时操作已经开始执行，按键是否全部注入未知，调用方不应直接重试
+    """
+
+    def __init__(self, message, outcome_unknown):
+        super().__init__(message)
+        self.outcome_unknown = outcome_unknown
+
+
+def _number(step, name, default=0.0):
+    value = step.get(name, default)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise SequenceError(f"'{name}' must be a number")
+    # nan/inf 会绕过下面的范围检查与 MAX_SEQUENCE_SECONDS 的总时长限制
+    if not math.isfinite(value):
+        raise SequenceError(f"'{name}' must be a finite number")
+    if value < 0:
+        raise SequenceError(f"'{name}' must not be negative")
+    return value
+
+
+def parse_key_sequence(raw):
+    """
+    校验并规范化按键序列
+    返回: 步骤字典列表，每个步骤都包含 key/delay/hold/repeat/interval
+    """
+    if not isinstance(raw, list) or not raw:
+        raise SequenceError("sequence must be a non-empty list")
+    if len(raw) > MAX_STEPS:
+        raise SequenceError(f"sequence has more than {MAX_STEPS} steps")
+
+    steps = []
+    for index, step in enumerate(raw):
+        if isinstance(step, str):
+            step = {"key": step}
+        if not isinstance(step, dict):
+            raise SequenceError(f"step {index} must be a string or object")
+        key = step.get("key")
+        if not key or not isinstance(key, str):
+            raise SequenceError(f"step {index} has invalid key")
+        try:
+            repeat = int(step.get("repeat", 1))
+        except (TypeError, ValueError):
+            raise SequenceError(f"step {index} has invalid repeat")
+        if not 1 <= repeat <= MAX_REPEAT:
+            raise SequenceError(f"step {index} repeat must be between 1 and {MAX_REPEAT}")
+        steps.append({
+            "key": key,
+            "delay": _number(step, "delay"),
+            "hold": _number(step, "hold"),
+            "repeat": repeat,
+            "interval": _number(step, "interval"),
+        })
+
+    if estimate_duration(steps) > MAX_SEQUENCE_SECONDS:
+        raise SequenceError(f"sequence would take longer than {MAX_SEQUENCE_SECONDS} seconds")
+    return steps
+
+
+def estimate_duration(steps):
+    """估算序列执行所需的最短时间（秒），用于计算请求超时"""
+    total = 0.0
+    for step in steps:
+        total += step["delay"] + step["hold"] * step["repeat"] + step["interval"] * (step["repeat"] - 1)
+    return total
+
+
+def parse_command(data):
+    """
+    从请求体中解析指令：带 sequence 时为按键序列，否则为单个按键
+    返回: {"key": ...} 或 {"sequence": [...]}
+    """
+    if data.get("sequence") is not None:
+        return {"sequence": parse_key_sequence(data["sequence"])}
+    key = data.get("key", "f7")
+    if not key or not isinstance(key, str):
+        raise SequenceError("Invalid key parameter")
+    return {"key": key}
+
+
+def describe_command(command):
+    """返回指令的简短描述，用于日志与任务展示"""
+    if "sequence" in command:
+        return f"sequence({len(command['sequence'])} steps)"
+    return command.get("key", "")
+
+
+def command_duration(command):
+    """指令在客户端执行的预计时长（秒）"""
+    if "sequence" in command:
+        return estimate_duration(command["sequence"])
+    return 0.0
+
+
+def execute_sequence(steps, press, key_down, key_up, sleep=time.sleep):
+    """
+    依次执行按键序列
+    参数:
+        press/key_down/key_up: 按键操作函数，参数为按键名称
+    返回:
+        每个步骤的耗时明细列表
+    """
+    timings = []
+    sequence_start = time.perf_counter()
+    for index, step in enumerate(steps):
+        if step["delay"]:
+            sleep(step["delay"])
+        step_start = time.perf_counter()
+        for i in range(step["repeat"]):
+            if i and step["interval"]:
+                sleep(step["interval"])
+            if step["hold"]:
+                key_down(step["key"])
+                sleep(step["hold"])
+                key_up(step["key"])
+            else:
+                press(step["key"])
+        step_end = time.perf_counter()
+        timings.append({
+            "step": index,
+            "key": step["key"],
+            "repeat": step["repeat"],
+            "started_at": round(step_start - sequence_start, 4),
+            "duration": round(step_end - step_start, 4),
+        })
+    return timings
+
+
+# ==================== 按键注入后端 ====================
+
+class PyAutoGuiBackend:
+    """pyautogui 后端：关闭 pyautogui 每次调用后的默认停顿"""
+
+    name = "pyautogui"
+
+    def __init__(self):
+        import pyautogui
+        self._pyautogui = pyautogui
+
+    def press(self, key):
+        self._pyautogui.press(key, _pause=False)
+
+    def key_down(self, key):
+        self._pyautogui.keyDown(key, _pause=False)
+
+    def key_up(self, key):
+        self._pyautogui.keyUp(key, _pause=False)
+
+
+class Win32Backend:
+    """
+    Win32 keybd_event 后端：直接注入虚拟键码，开销最低
+    无法映射的按键名称交给 pyautogui 处理
+    """
+
+    name = "win32"
+
+    # 常用命名按键的虚拟键码
+    NAMED_KEYS = {
+        "enter": 0x0D, "return": 0x0D, "tab": 0x09, "space": 0x20, "esc": 0x1B, "escape": 0x1B,
+        "backspace": 0x08, "delete": 0x2E, "del": 0x2E, "insert": 0x2D, "home": 0x24, "end": 0x23,
+        "pageup": 0x21, "pagedown": 0x22, "up": 0x26, "down": 0x28, "left": 0x25, "right": 0x27,
+        "shift": 0x10, "ctrl": 0x11, "alt": 0x12, "win": 0x5B,
+    }
+    NAMED_KEYS.update({f"f{i}": 0x6F + i for i in range(1, 25)})
+
+    def __init__(self):
+        import win32api
+        import win32con
+        self._win32api = win32api
+        self._keyup_flag = win32con.KEYEVENTF_KEYUP
+        self._fallback = None
+
+    # VkKeyScan 高字节的修饰键位：Shift、Ctrl、Alt
+    MODIFIER_KEYS = ((0x01, 0x10), (0x02, 0x11), (0x04, 0x12))
+
+    def _vk(self, key):
+        """返回 (虚拟键码, 需要同时按住的修饰键码列表)，无法映射时返回 (None, ())"""
+        lowered = key.lower()
+        if lowered in self.NAMED_KEYS:
+            return self.NAMED_KEYS[lowered], ()
+        if len(key) == 1:
+            code = self._win32api.VkKeyScan(key)
+            if code != -1:
+                # 高字节为字符所需的修饰键状态，例如 "A" 与 "!" 需要 Shift
+                state = (code >> 8) & 0xFF
+                return code & 0xFF, tuple(vk for bit, vk in self.MODIFIER_KEYS if state & bit)
+        return None, ()
+
+    def _fallback_backend(self):
+        if self._fallback is None:
+            self._fallback = PyAutoGuiBackend()
+        return self._fallback
+
+    def _down(self, vk):
+        self._win32api.keybd_event(vk, 0, 0, 0)
+
+    def _up(self, vk):
+        self._win32api.keybd_event(vk, 0, self._keyup_flag, 0)
+
+    def key_down(self, key):
+        vk, modifiers = self._vk(key)
+        if vk is None:
+            return self._fallback_backend().key_down(key)
+        for modifier in modifiers:
+            self._down(modifier)
+        self._down(vk)
+
+    def key_up(self, key):
+        vk, modifiers = self._vk(key)
+        if vk is None:
+            return self._fallback_backend().key_up(key)
+        self._up(vk)
+        for modifier in reversed(modifiers):
+            self._up(modifier)
+
+    def press(self, key):
+        vk, modifiers = self._vk(key)
+        if vk is None:
+            return self._fallback_backend().press(key)
+        for modifier in modifiers:
+            self._down(modifier)
+        self._down(vk)
+        self._up(vk)
+        for modifier in reversed(modifiers):
+            self._up(modifier)
+
+
+class RecordingBackend:
+    """记录型后端：不注入任何按键，只记录事件，用于 Linux 等无桌面环境下测试"""
+
+    name = "recording"
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def _record(self, action, key):
+        with self._lock:
+            self.events.append((action, key, time.perf_counter()))
+
+    def press(self, key):
+        self._record("press", key)
+
+    def key_down(self, key):
+        self._record("down", key)
+
+    def key_up(self, key):
+        self._record("up", key)
+
+
+def create_backend(name="auto"):
+    """
+    创建按键注入后端
+    name: auto（Windows 上优先 win32，否则 pyautogui）、win32、pyautogui、recording
+    """
+    if name == "recording":
+        return RecordingBackend()
+    if name == "pyautogui":
+        return PyAutoGuiBackend()
+    if name == "win32":
+        return Win32Backend()
+    try:
+        return Win32Backend()
+    except ImportError:
+        return PyAutoGuiBackend()
+
+
+# ==================== 串行输入队列 ====================
+
+# 优先级：数值越小越先执行
+PRIORITY_HIGH = 0    # 单个按键
+PRIORITY_NORMAL = 1  # 按键序列
+PRIORITY_LOW = 2     # 窗口激活、截图等长时间占用输入焦点的操作
+
+
+class _TimingStats:
+    """简单的耗时统计（次数、总和、最大值、最近一次）"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0,
+            "max_ms": round(self.max * 1000, 3),
+            "last_ms": round(self.last * 1000, 3),
+        }
+
+
+class InputQueue:
+    """
+    单消费者优先级输入队列
+    客户端所有输入操作（按键、按键序列、窗口焦点切换）都在同一个线程上按优先级顺序执行，
+    多个并发请求的输入不会互相穿插
+    """
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.max_depth = 0
+        self.executed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.wait_stats = _TimingStats()  # 入队到开始执行的等待时间
+        self.run_stats = _TimingStats()   # 任务执行时间
+        self._thread = threading.Thread(target=self._worker, name="input-queue", daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            _, _, enqueued_at, future, fn, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.failed += 1
+                    self.wait_stats.add(started - enqueued_at)
+                    self.run_stats.add(finished - started)
+                future.set_exception(e)
+            else:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.executed += 1
+                    self.wait_stats.add(started - enqueued_at)
+                    self.run_stats.add(finished - started)
+                future.set_result(result)
+
+    def submit(self, fn, *args, priority=PRIORITY_NORMAL, **kwargs):
+        """提交输入操作，返回 Future"""
+        future = Future()
+        self._queue.put((priority, next(self._seq), time.perf_counter(), future, fn, args, kwargs))
+        depth = self._queue.qsize()
+        with self._lock:
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return future
+
+    def run(self, fn, *args, priority=PRIORITY_NORMAL, timeout=None, **kwargs):
+        """
+        提交输入操作并等待结果
+        超时时取消仍在排队的操作（之后不会再执行），并抛出 InputTimeout
+        """
+        future = self.submit(fn, *args, priority=priority, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                with self._lock:
+                    self.cancelled += 1
+                raise InputTimeout("Input timed out while queued; cancelled, not executed", False)
+            raise InputTimeout("Input timed out after it started; outcome unknown", True)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_depth,
+                "executed": self.executed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "queue_wait": self.wait_stats.to_dict(),
+                "task_time": self.run_stats.to_dict(),
+            }
+
+
+class InputController:
+    """
+    客户端输入子系统：注入后端 + 串行输入队列 + 注入耗时统计
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or create_backend()
+        self.queue = InputQueue()
+        self._lock = threading.Lock()
+        self.injection_stats = _TimingStats()  # 单次按键注入耗时
+
+    def _timed(self, action, key):
+        start = time.perf_counter()
+        action(key)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.injection_stats.add(elapsed)
+
+    def _press(self, key):
+        self._timed(self.backend.press, key)
+
+    def _key_down(self, key):
+        self._timed(self.backend.key_down, key)
+
+    def _key_up(self, key):
+        self._timed(self.backend.key_up, key)
+
+    def press(self, key, timeout=10):
+        """排队执行单个按键并等待完成"""
+        return self.queue.run(self._press, key, priority=PRIORITY_HIGH, timeout=timeout)
+
+    def run_sequence(self, steps, timeout=None):
+        """排队执行按键序列，返回每个步骤的耗时明细"""
+        return self.queue.run(execute_sequence, steps, self._press, self._key_down, self._key_up,
+                              priority=PRIORITY_NORMAL, timeout=timeout)
+
+    def run_exclusive(self, fn, *args, timeout=None, **kwargs):
+        """在输入线程上独占执行一段操作（例如切换窗口焦点并截图），期间不会穿插其他按键"""
+        return self.queue.run(fn, *args, priority=PRIORITY_LOW, timeout=timeout, **kwargs)
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        with self._lock:
+            stats["backend"] = self.backend.name
+            stats["injection"] = self.injection_stats.to_dict()
+        return stats
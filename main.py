@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response
 import requests
 import cv2
 import pytesseract
@@ -16,6 +16,10 @@ from utils import (
     ocr_with_multiple_configs,
     extract_amount_from_text
 )
+from metrics_exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsExporter, add_process_metrics
+from slow_requests import SlowRequestLog
+from stack_profiler import profile_request
+from tracing import TRACE_HEADER, tracer
 
 app = Flask(__name__)
 
@@ -25,6 +29,62 @@ pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tessera
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 性能监控
+try:
+    from performance_monitor import monitor
+    PERFORMANCE_MONITORING = True
+except ImportError:
+    PERFORMANCE_MONITORING = False
+    monitor = None
+
+# 慢请求记录：阈值由 SLOW_REQUEST_SECONDS / SLOW_REQUEST_THRESHOLDS 配置，SLOW_REQUEST_SPILL=1 时另写入 logs/slow_ocr_server.jsonl
+slow_log = SlowRequestLog.from_env('ocr_server')
+
+@app.before_request
+def before_request():
+    """请求前处理：记录开始时间"""
+    if PERFORMANCE_MONITORING:
+        request.start_time = time.time()
+    if request.endpoint in TRACED_ENDPOINTS:
+        request.trace = tracer.begin(request.url_rule.rule, request.headers.get(TRACE_HEADER))
+
+@app.after_request
+def after_request(response):
+    """请求后处理：记录性能数据"""
+    trace = getattr(request, 'trace', None)
+    if trace is not None:
+        response.headers[TRACE_HEADER] = trace.trace_id
+        response.headers['Server-Timing'] = trace.server_timing()
+    if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
+        response_time = time.time() - request.start_time
+        # 按路由模板统计，避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
+        is_error = response.status_code >= 400
+        monitor.record_request(endpoint, response_time, is_error)
+        # 超过路由阈值的请求连同分阶段耗时与参数摘要写入慢请求记录
+        slow_log.observe(endpoint, response_time, response.status_code, request,
+                         getattr(request, 'trace', None), getattr(request, 'slow_info', None))
+    return response
+
+@app.teardown_request
+def end_trace(error=None):
+    """请求结束时结束追踪并存入缓冲区"""
+    trace = getattr(request, 'trace', None)
+    if trace is not None:
+        tracer.end(trace, error=error is not None)
+
+# 分阶段追踪的接口（/traces 查询），截图请求把追踪 ID 传给客户端 /capture
+TRACED_ENDPOINTS = {'get_balances', 'preview_screenshot'}
+
+# 各阶段耗时同时写入性能监控（/metrics 中的 ocr_server_ocr_stage_duration_seconds）
+if PERFORMANCE_MONITORING:
+    tracer.add_listener(lambda name, seconds: monitor.record_timing('ocr_stage', seconds, stage=name))
+
+def _trace_headers():
+    trace = tracer.current()
+    return {TRACE_HEADER: trace.trace_id} if trace is not None else None
+
 @app.route('/preview_screenshot', methods=['GET'])
 def preview_screenshot():
     """
@@ -34,9 +94,10 @@ def preview_screenshot():
     ip = request.args.get('ip', '<PC2_IP>')
     try:
         # 调用 PC2 上的 capture 接口获取截图（返回 JSON 数据）
-        response = requests.get(f'http://{ip}:5000/capture', timeout=5)
-        response.raise_for_status()
-        data = response.json()
+        with tracer.span('capture'):
+            response = requests.get(f'http://{ip}:5000/capture', headers=_trace_headers(), timeout=5)
+            response.raise_for_status()
+            data = response.json()
         img_base64 = data.get('image', '')
         if not img_base64:
             raise ValueError("没有获取到截图数据。")
@@ -93,13 +154,14 @@ def ocr_extract_amount_enhanced(image, debug_dir=None, roi_index=None):
     processed_images = preprocess_image_multiple_methods(image, debug_dir, roi_index)
     all_results = []
     
-    for method_name, proc_img in processed_images:
-        ocr_results = ocr_with_multiple_configs(proc_img)
-        for config_name, text, confidence in ocr_results:
-            amount = extract_amount_from_text(text)
-            if amount:
-                all_results.append((method_name, config_name, amount, confidence, text))
-                logging.info(f"方法 {method_name} + 配置 {config_name}: 识别到金额 {amount} (置信度: {confidence:.1f})")
+    with tracer.span('recognize'):
+        for method_name, proc_img in processed_images:
+            ocr_results = ocr_with_multiple_configs(proc_img)
+            for config_name, text, confidence in ocr_results:
+                amount = extract_amount_from_text(text)
+                if amount:
+                    all_results.append((method_name, config_name, amount, confidence, text))
+                    logging.info(f"方法 {method_name} + 配置 {config_name}: 识别到金额 {amount} (置信度: {confidence:.1f})")
     
     if not all_results:
         logging.warning("所有OCR方法都未能识别到金额")
@@ -147,10 +209,12 @@ def get_balances():
     """
     ip = request.args.get('ip', '<PC2_IP>')
     try:
-        response = requests.get(f'http://{ip}:5000/capture', timeout=5)
-        response.raise_for_status()
-        img_array = np.frombuffer(response.content, np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+        with tracer.span('capture'):
+            response = requests.get(f'http://{ip}:5000/capture', headers=_trace_headers(), timeout=5)
+            response.raise_for_status()
+        with tracer.span('decode'):
+            img_array = np.frombuffer(response.content, np.uint8)
+            img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
 
         if img is None or img.size == 0:
             raise ValueError("无法解码屏幕截图图像。")
@@ -175,7 +239,8 @@ def get_balances():
                 continue
 
             # 使用增强OCR函数
-            amount, processed_img = ocr_extract_amount_enhanced(roi_img, debug_dir=debug_dir, roi_index=i)
+            with tracer.span('ocr', roi=i):
+                amount, processed_img = ocr_extract_amount_enhanced(roi_img, debug_dir=debug_dir, roi_index=i)
             
             if amount:
                 print(f"ROI {i} 检测到的余额: {amount}")
@@ -184,8 +249,9 @@ def get_balances():
                 print(f"ROI {i} 中未检测到金额")
 
             # 将处理后的图像编码为 base64 传回前端显示
-            _, roi_buffer = cv2.imencode('.png', processed_img)
-            roi_base64 = base64.b64encode(roi_buffer).decode('utf-8')
+            with tracer.span('encode'):
+                _, roi_buffer = cv2.imencode('.png', processed_img)
+                roi_base64 = base64.b64encode(roi_buffer).decode('utf-8')
             roi_imgs.append(roi_base64)
 
         if not balances:
@@ -198,7 +264,8 @@ def get_balances():
         response_data = {
             'balances': balances,
             'roi_imgs': roi_imgs,
-            'timestamp': int(time.time() * 1000)  # 当前时间戳（毫秒）
+            'timestamp': int(time.time() * 1000),  # 当前时间戳（毫秒）
+            'timings': request.trace.breakdown()
         }
         return jsonify(response_data)
 
@@ -213,6 +280,59 @@ def get_balances():
 def index():
     return render_template('index.html')
 
+# Prometheus 指标：请求统计与 OCR 各阶段耗时
+metrics = add_process_metrics(MetricsExporter('ocr_server', monitor))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus 文本格式指标
+    """
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    采样分析所有线程的调用栈（需设置 DEBUG_TOKEN），见 stack_profiler
+    """
+    result, status = profile_request(request.args, request.headers)
+    if isinstance(result, str):
+        return Response(result, mimetype='text/plain'), status
+    return jsonify(result), status
+
+@app.route('/debug/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """
+    查询最近的慢请求（耗时超过所在路由的阈值，见 slow_requests）
+    参数: endpoint（如 "POST /run_extract_amount"）、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": slow_log.get_stats(),
+        "requests": slow_log.query(request.args.get('endpoint'), min_ms, limit)
+    })
+
+@app.route('/traces', methods=['GET'])
+def get_traces():
+    """
+    查询最近的分阶段追踪
+    参数: endpoint（如 /get_balances）、trace_id、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({'error': 'min_ms and limit must be numbers'}), 400
+    return jsonify({
+        'stats': tracer.get_stats(),
+        'traces': tracer.query(request.args.get('endpoint'), request.args.get('trace_id'), min_ms, limit)
+    })
+
 if __name__ == '__main__':
     # 启用多线程模式，提高性能
     app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
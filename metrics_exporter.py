@@ -0,0 +1,157 @@
+"""
+Prometheus 文本格式导出模块
+各服务的 /metrics 接口：请求计数与延迟直方图来自 performance_monitor 的分片统计，
+其余指标（注册表大小、在线数、队列深度等）由各服务注册的回调读取已有的计数；
+渲染结果缓存 cache_seconds 秒，频繁抓取时直接返回缓存文本
+"""
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 直方图 le 上界：2 的幂（约 1ms 到 64s），与 LatencyHistogram 的桶边界对齐
+HISTOGRAM_BOUNDS = tuple(2.0 ** e for e in range(-10, 7))
+_BOUND_LABELS = tuple(repr(b) for b in HISTOGRAM_BOUNDS) + ('+Inf',)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsExporter:
+    """
+    /metrics 渲染器
+    参数:
+        namespace: 指标名前缀，如 "master"、"client"
+        monitor: PerformanceMonitor 实例，为空时不导出请求指标
+        cache_seconds: 渲染结果的缓存时间
+    """
+
+    def __init__(self, namespace, monitor=None, cache_seconds=1.0):
+        self.namespace = namespace
+        self.monitor = monitor
+        self.cache_seconds = cache_seconds
+        self.lock = threading.Lock()
+        self._metrics = []  # (名称, 类型, 说明, 回调)
+        self._cached = None
+        self._cached_at = 0.0
+
+    def gauge(self, name, help_text, fn):
+        """
+        注册 gauge 指标
+        fn() 返回数值，或 {标签值元组: 数值} / [(标签字典, 数值)] 表示多个样本
+        """
+        self._metrics.append((f'{self.namespace}_{name}', 'gauge', help_text, fn))
+        return self
+
+    def counter(self, name, help_text, fn):
+        """注册 counter 指标，名称以 _total 结尾，fn 的返回格式同 gauge"""
+        self._metrics.append((f'{self.namespace}_{name}_total', 'counter', help_text, fn))
+        return self
+
+    def render(self):
+        """返回 Prometheus 文本格式的全部指标"""
+        now = time.time()
+        with self.lock:
+            if self._cached is not None and now - self._cached_at < self.cache_seconds:
+                return self._cached
+            lines = []
+            if self.monitor is not None:
+                self._render_monitor(lines)
+            for name, kind, help_text, fn in self._metrics:
+                try:
+                    value = fn()
+                except Exception:
+                    continue  # 单个指标读取失败不影响其它指标
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                if isinstance(value, dict):
+                    samples = value.items()
+                elif isinstance(value, list):
+                    samples = [(tuple(sorted(labels.items())), v) for labels, v in value]
+                else:
+                    samples = [((), value)]
+                for labels, v in samples:
+                    lines.append(f'{name}{_labels(labels)} {_number(v)}')
+            self._cached = '\n'.join(lines) + '\n'
+            self._cached_at = now
+            return self._cached
+
+    def _render_histogram(self, lines, name, labels, hist):
+        cumulative = hist.cumulative(HISTOGRAM_BOUNDS) + [hist.count]
+        for le, count in zip(_BOUND_LABELS, cumulative):
+            lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {count}')
+        lines.append(f'{name}_sum{_labels(labels)} {_number(float(hist.total))}')
+        lines.append(f'{name}_count{_labels(labels)} {hist.count}')
+
+    def _render_monitor(self, lines):
+        endpoints, counters, timings = self.monitor.collect()
+        ns = self.namespace
+
+        lines.append(f'# HELP {ns}_http_requests_total HTTP requests by route template')
+        lines.append(f'# TYPE {ns}_http_requests_total counter')
+        for endpoint, (count, _, _) in endpoints.items():
+            lines.append(f'{ns}_http_requests_total{_labels((("endpoint", endpoint),))} {count}')
+        lines.append(f'# HELP {ns}_http_request_errors_total HTTP responses with status >= 400')
+        lines.append(f'# TYPE {ns}_http_request_errors_total counter')
+        for endpoint, (_, errors, _) in endpoints.items():
+            lines.append(f'{ns}_http_request_errors_total{_labels((("endpoint", endpoint),))} {errors}')
+        name = f'{ns}_http_request_duration_seconds'
+        lines.append(f'# HELP {name} HTTP request latency')
+        lines.append(f'# TYPE {name} histogram')
+        for endpoint, (_, _, hist) in endpoints.items():
+            self._render_histogram(lines, name, (('endpoint', endpoint),), hist)
+
+        # monitor.count / monitor.record_timing 记录的自定义指标
+        by_name = {}
+        for (metric, labels), value in counters.items():
+            by_name.setdefault(metric, []).append((labels, value))
+        for metric, samples in sorted(by_name.items()):
+            name = f'{ns}_{metric}_total'
+            lines.append(f'# TYPE {name} counter')
+            for labels, value in samples:
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        by_name = {}
+        for (metric, labels), hist in timings.items():
+            by_name.setdefault(metric, []).append((labels, hist))
+        for metric, samples in sorted(by_name.items()):
+            name = f'{ns}_{metric}_duration_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            for labels, hist in samples:
+                self._render_histogram(lines, name, labels, hist)
+
+
+def add_process_metrics(exporter):
+    """
+    注册进程级指标（线程数、运行时间），所有服务共用
+    exporter 带有 monitor 时另外导出后台系统采样器的最近一次采样（CPU、内存、打开文件数）
+    """
+    started = time.time()
+    exporter.gauge('threads', 'Live Python threads', threading.active_count)
+    exporter.gauge('uptime_seconds', 'Seconds since the metrics exporter was created',
+                   lambda: round(time.time() - started, 3))
+    sampler = getattr(exporter.monitor, 'system_sampler', None)
+    if sampler is not None:
+        def latest(key):
+            return lambda: sampler.start().latest()[key]
+        exporter.gauge('process_cpu_percent', 'Process CPU usage between the last two samples', latest('cpu_percent'))
+        exporter.gauge('process_memory_mb', 'Process resident memory', latest('memory_mb'))
+        exporter.gauge('process_open_files', 'Open files (handles on Windows)', latest('open_files'))
+    return exporter
+
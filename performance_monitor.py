@@ -2,63 +2,454 @@
 性能监控模块
 用于监控系统性能、请求统计、资源使用等
 """
+import math
 import time
 import threading
 import os
-from collections import defaultdict, deque
-from datetime import datetime
 
-# 尝试导入psutil，如果不存在则使用简化版本
-try:
-    import psutil
-    PSUTIL_AVAILABLE = True
-except ImportError:
-    PSUTIL_AVAILABLE = False
+from system_sampler import PSUTIL_AVAILABLE, SystemSampler
+
+# 健康检查中返回的系统资源历史长度（秒）
+HEALTH_HISTORY_SECONDS = 60
+
+class LatencyHistogram:
+    """
+    对数分桶的延迟直方图（固定内存）
+    每个 2 的幂区间再均分为 SUB_BUCKETS 个子桶，相对误差约 1/(2*SUB_BUCKETS)；
+    覆盖 MIN_VALUE 到 2**MAX_EXPONENT = 512 秒，超出范围的值计入首尾桶。
+    桶为左开右闭区间 (下界, 上界]，恰好等于上界的值计入该桶，与 Prometheus 的 le（<=）语义一致。
+    桶布局固定，不同线程、不同进程的直方图可直接按桶相加合并
+    """
+
+    SUB_BUCKETS = 8
+    MIN_VALUE = 1e-6  # 秒
+    MIN_EXPONENT = math.frexp(MIN_VALUE)[1]
+    MAX_EXPONENT = 9
+    BUCKETS = (MAX_EXPONENT - MIN_EXPONENT + 1) * SUB_BUCKETS
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value <= cls.MIN_VALUE:
+            return 0
+        mantissa, exponent = math.frexp(value)  # value = mantissa * 2**exponent，mantissa ∈ [0.5, 1)
+        sub = (mantissa - 0.5) * 2 * cls.SUB_BUCKETS  # 乘以 2 的幂，没有舍入误差
+        index = (exponent - cls.MIN_EXPONENT) * cls.SUB_BUCKETS + int(sub)
+        if sub == int(sub):
+            index -= 1  # 恰好落在桶边界上：属于以它为上界的桶
+        return max(0, min(index, cls.BUCKETS - 1))
+
+    @classmethod
+    def bucket_bounds(cls, index):
+        """返回桶的 (下界, 上界)，桶包含上界、不含下界"""
+        exponent = index // cls.SUB_BUCKETS + cls.MIN_EXPONENT
+        sub = index % cls.SUB_BUCKETS
+        lower = math.ldexp(0.5 + sub / (2 * cls.SUB_BUCKETS), exponent)
+        upper = math.ldexp(0.5 + (sub + 1) / (2 * cls.SUB_BUCKETS), exponent)
+        return lower, upper
+
+    def record(self, value):
+        # 先更新 min/max：并发读取时只要 count 非零，min/max 就已经有值
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.counts[self.bucket_index(value)] += 1
+        self.total += value
+        self.count += 1
+
+    def merge(self, other):
+        """把另一个直方图累加到当前直方图"""
+        if not other.count:
+            return self
+        counts = self.counts
+        for i, c in enumerate(other.counts):
+            if c:
+                counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def subtract(self, earlier):
+        """
+        返回当前累计直方图减去更早一次累计结果的增量（用于计算两次上报之间的分布）
+        增量的 min/max 无法精确得到，沿用当前值
+        """
+        delta = LatencyHistogram()
+        delta.counts = [max(0, a - b) for a, b in zip(self.counts, earlier.counts)]
+        delta.count = sum(delta.counts)
+        delta.total = max(0.0, self.total - earlier.total)
+        if delta.count:
+            delta.min, delta.max = self.min, self.max
+        return delta
+
+    def percentile(self, q):
+        """返回第 q 百分位（0-100）的估计值：所在桶的中点，并限制在实际最小/最大值之间"""
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * q / 100.0))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                lower, upper = self.bucket_bounds(i)
+                return min(self.max, max(self.min, (lower + upper) / 2))
+        return self.max
+
+    def cumulative(self, bounds):
+        """
+        返回每个上界（升序）对应的 <= 上界的累计计数，用于 Prometheus 直方图的 le 桶
+        上界在桶边界上（如 2 的幂）时计数是精确的；否则包含上界所在的整个桶，
+        可能多计入该桶中略大于上界的值
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            end = self.bucket_index(bound) + 1
+            while index < end:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 4),
+            'min': round(self.min, 4),
+            'max': round(self.max, 4),
+            'p50': round(self.percentile(50), 4),
+            'p90': round(self.percentile(90), 4),
+            'p99': round(self.percentile(99), 4),
+            'p999': round(self.percentile(99.9), 4),
+        }
+
+    def to_dict(self):
+        """导出为可 JSON 序列化的稀疏格式（只包含非零桶），用于跨进程合并"""
+        return {
+            'sub_buckets': self.SUB_BUCKETS,
+            'min_value': self.MIN_VALUE,
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {str(i): c for i, c in enumerate(self.counts) if c},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        从 to_dict 的输出恢复（数据可能来自其他进程或客户端上报）
+        桶布局不一致、桶序号越界或计数不是非负整数时抛出 ValueError
+        """
+        if data.get('sub_buckets') != cls.SUB_BUCKETS or data.get('min_value') != cls.MIN_VALUE:
+            raise ValueError("histogram bucket layout mismatch")
+        hist = cls()
+        for index, c in data.get('buckets', {}).items():
+            index, c = int(index), int(c)
+            if not 0 <= index < cls.BUCKETS or c < 0:
+                raise ValueError(f"invalid histogram bucket {index}: {c}")
+            hist.counts[index] += c
+        hist.count = int(data.get('count', 0))
+        hist.total = float(data.get('sum', 0.0))
+        hist.min = None if data.get('min') is None else float(data['min'])
+        hist.max = None if data.get('max') is None else float(data['max'])
+        return hist
+
+
+class _Shard:
+    """单个线程的统计分片：只由所属线程写入，读取时合并"""
+
+    __slots__ = ('thread', 'endpoints', 'buckets', 'counters', 'timings')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.endpoints = {}  # 端点 -> [请求数, 错误数, LatencyHistogram]
+        self.buckets = {}    # 时间桶起始秒 -> {端点 -> [请求数, 错误数, LatencyHistogram]}
+        self.counters = {}   # (名称, 标签) -> 计数
+        self.timings = {}    # (名称, 标签) -> LatencyHistogram
+
 
 class PerformanceMonitor:
-    """性能监控器"""
-    
+    """
+    性能监控器
+    每个线程写自己的分片，记录请求时不加锁；读取统计时合并所有分片，
+    已退出线程的分片合并进汇总后丢弃，分片数量不随请求线程的创建而增长
+    """
+
+    # 分片数超过该值时，新建分片前先回收已退出线程的分片
+    SWEEP_THRESHOLD = 64
+    # 滑动窗口统计：按 BUCKET_SECONDS 分桶，保留最长窗口所需的桶
+    BUCKET_SECONDS = 10
+    WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))
+
     def __init__(self):
-        self.request_count = defaultdict(int)  # 请求计数
-        self.response_times = defaultdict(list)  # 响应时间记录
-        self.error_count = defaultdict(int)  # 错误计数
-        self.last_reset_time = time.time()
+        self.started_time = time.time()
+        self.last_reset_time = self.started_time
         self.lock = threading.Lock()
-        
-        # 保留最近1000个响应时间记录
-        self.max_records = 1000
-        
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}          # 已退出线程的累计数据：端点 -> [请求数, 错误数, LatencyHistogram]
+        self._retired_buckets = {}  # 已退出线程的时间桶
+        self._retired_counters = {}  # 已退出线程的计数器与耗时（不随 reset_stats 清空）
+        self._retired_timings = {}
+        self._generation = 0        # reset_stats 时递增，使各线程重新创建分片
+        self._span = max(seconds for _, seconds in self.WINDOWS)
+        # 系统资源由后台线程定期采样，健康检查只读取缓冲区
+        self.system_sampler = SystemSampler(
+            interval=float(os.environ.get('SYSTEM_SAMPLE_INTERVAL', '5')),
+            history=int(os.environ.get('SYSTEM_SAMPLE_HISTORY', '120'))
+        )
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None or self._local.generation != self._generation:
+            shard = _Shard(threading.current_thread())
+            with self.lock:
+                if len(self._shards) >= self.SWEEP_THRESHOLD:
+                    self._sweep()
+                self._shards.append(shard)
+                self._local.generation = self._generation
+            self._local.shard = shard
+        return shard
+
+    @staticmethod
+    def _fold(target, endpoints):
+        for endpoint, (count, errors, hist) in list(endpoints.items()):
+            slot = target.get(endpoint)
+            if slot is None:
+                slot = target[endpoint] = [0, 0, LatencyHistogram()]
+            slot[0] += count
+            slot[1] += errors
+            slot[2].merge(hist)
+
+    def _sweep(self):
+        """把已退出线程的分片并入汇总（调用方持有锁）"""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._fold(self._retired, shard.endpoints)
+                self._retire(shard)
+        self._shards = alive
+        self._prune(self._retired_buckets, time.time())
+
+    @staticmethod
+    def _fold_counters(target, counters):
+        for key, value in list(counters.items()):
+            target[key] = target.get(key, 0) + value
+
+    @staticmethod
+    def _fold_timings(target, timings):
+        for key, hist in list(timings.items()):
+            if key not in target:
+                target[key] = LatencyHistogram()
+            target[key].merge(hist)
+
+    def _retire(self, shard):
+        """把分片中不随重置清空的数据（时间桶、计数器、耗时）并入汇总（调用方持有锁）"""
+        for start, endpoints in list(shard.buckets.items()):
+            self._fold(self._retired_buckets.setdefault(start, {}), endpoints)
+        self._fold_counters(self._retired_counters, shard.counters)
+        self._fold_timings(self._retired_timings, shard.timings)
+
+    def _prune(self, buckets, now):
+        oldest = now - self._span - self.BUCKET_SECONDS
+        for start in [start for start in buckets if start < oldest]:
+            del buckets[start]
+
     def record_request(self, endpoint, response_time=None, is_error=False):
-        """记录请求"""
-        with self.lock:
-            self.request_count[endpoint] += 1
+        """
+        记录请求
+        endpoint 应使用路由模板（如 "POST /api/send/<ip>"）而不是实际路径，避免键的数量无限增长
+        """
+        shard = self._shard()
+        now = time.time()
+        start = int(now // self.BUCKET_SECONDS) * self.BUCKET_SECONDS
+        bucket = shard.buckets.get(start)
+        if bucket is None:
+            # 进入新的时间桶时顺便淘汰本分片过期的桶
+            self._prune(shard.buckets, now)
+            bucket = shard.buckets[start] = {}
+        for endpoints in (shard.endpoints, bucket):
+            slot = endpoints.get(endpoint)
+            if slot is None:
+                slot = endpoints[endpoint] = [0, 0, LatencyHistogram()]
+            slot[0] += 1
             if is_error:
-                self.error_count[endpoint] += 1
+                slot[1] += 1
             if response_time is not None:
-                if endpoint not in self.response_times:
-                    self.response_times[endpoint] = deque(maxlen=self.max_records)
-                self.response_times[endpoint].append(response_time)
-    
-    def get_stats(self):
-        """获取统计信息"""
+                slot[2].record(response_time)
+
+    def count(self, name, value=1, **labels):
+        """累加计数器，如 count('dispatch', outcome='success')"""
+        counters = self._shard().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def record_timing(self, name, seconds, **labels):
+        """记录一次耗时，如 record_timing('ocr_stage', 0.12, stage='preprocess')"""
+        timings = self._shard().timings
+        key = (name, tuple(sorted(labels.items())))
+        hist = timings.get(key)
+        if hist is None:
+            hist = timings[key] = LatencyHistogram()
+        hist.record(seconds)
+
+    def collect(self):
+        """
+        合并所有分片，返回 (端点统计, 计数器, 耗时)，供 /metrics 等导出使用
+            端点统计: 端点 -> [请求数, 错误数, LatencyHistogram]
+            计数器: (名称, 标签) -> 计数
+            耗时: (名称, 标签) -> LatencyHistogram
+        """
+        endpoints, counters, timings = {}, {}, {}
         with self.lock:
-            stats = {
-                'request_count': dict(self.request_count),
-                'error_count': dict(self.error_count),
-                'avg_response_time': {},
-                'min_response_time': {},
-                'max_response_time': {},
-                'uptime_seconds': time.time() - self.last_reset_time,
-                'uptime_formatted': self._format_uptime(time.time() - self.last_reset_time)
+            self._sweep()
+            self._fold(endpoints, self._retired)
+            self._fold_counters(counters, self._retired_counters)
+            self._fold_timings(timings, self._retired_timings)
+            for shard in self._shards:
+                self._fold(endpoints, shard.endpoints)
+                self._fold_counters(counters, shard.counters)
+                self._fold_timings(timings, shard.timings)
+        return endpoints, counters, timings
+
+    @staticmethod
+    def _timing_key(name, labels):
+        label_text = ','.join(f'{k}={v}' for k, v in labels)
+        return f'{name}{{{label_text}}}' if label_text else name
+
+    def get_timings(self):
+        """返回各项耗时的分位数摘要，键为 "名称{标签=值}" """
+        _, _, timings = self.collect()
+        return {self._timing_key(name, labels): hist.summary() for (name, labels), hist in timings.items()}
+
+    def export(self):
+        """
+        导出紧凑的累计统计（可跨进程合并），用于客户端随签到上报：
+            requests/errors: 全部端点的请求数与错误数
+            latency: 全部端点合并的延迟直方图（稀疏格式）
+            timings: 各项耗时直方图，键为 "名称{标签=值}"
+        """
+        endpoints, _, timings = self.collect()
+        latency = LatencyHistogram()
+        requests = errors = 0
+        for count, error_count, hist in endpoints.values():
+            requests += count
+            errors += error_count
+            latency.merge(hist)
+        return {
+            'requests': requests,
+            'errors': errors,
+            'latency': latency.to_dict(),
+            'timings': {self._timing_key(name, labels): hist.to_dict()
+                        for (name, labels), hist in timings.items()},
+        }
+
+    def _merged(self):
+        """合并所有分片，返回 端点 -> [请求数, 错误数, LatencyHistogram]"""
+        merged = {}
+        with self.lock:
+            self._sweep()
+            self._fold(merged, self._retired)
+            for shard in self._shards:
+                self._fold(merged, shard.endpoints)
+        return merged
+
+    def get_windows(self, now=None):
+        """
+        返回最近 1/5/15 分钟的滑动窗口统计（不受 reset_stats 影响）
+            request_rate: 每秒请求数
+            error_rate: 错误请求占比
+            latency: 所有端点合并后的延迟分位数
+            endpoints: 各端点的请求数、错误数与延迟分位数
+        """
+        now = now or time.time()
+        current = int(now // self.BUCKET_SECONDS) * self.BUCKET_SECONDS
+        with self.lock:
+            self._sweep()
+            sources = [self._retired_buckets] + [shard.buckets for shard in self._shards]
+            buckets = {}
+            for source in sources:
+                for start, endpoints in list(source.items()):
+                    if start > current - self._span:
+                        self._fold(buckets.setdefault(start, {}), endpoints)
+
+        windows = {}
+        for name, seconds in self.WINDOWS:
+            # 窗口由包含当前桶在内的 seconds / BUCKET_SECONDS 个桶组成
+            oldest = current - seconds + self.BUCKET_SECONDS
+            merged = {}
+            for start, endpoints in buckets.items():
+                if start >= oldest:
+                    self._fold(merged, endpoints)
+            total = LatencyHistogram()
+            requests = errors = 0
+            for count, error_count, hist in merged.values():
+                requests += count
+                errors += error_count
+                total.merge(hist)
+            elapsed = max(now - max(oldest, self.started_time), 1e-6)
+            windows[name] = {
+                'seconds': seconds,
+                'requests': requests,
+                'errors': errors,
+                'request_rate': round(requests / elapsed, 3),
+                'error_rate': round(errors / requests, 4) if requests else 0.0,
+                'latency': total.summary(),
+                'endpoints': {
+                    endpoint: {**hist.summary(), 'count': count, 'errors': error_count}
+                    for endpoint, (count, error_count, hist) in merged.items()
+                },
             }
-            
-            for endpoint, times in self.response_times.items():
-                if times:
-                    stats['avg_response_time'][endpoint] = round(sum(times) / len(times), 3)
-                    stats['min_response_time'][endpoint] = round(min(times), 3)
-                    stats['max_response_time'][endpoint] = round(max(times), 3)
-            
-            return stats
+        return windows
+
+    def get_histograms(self):
+        """导出各端点的直方图（稀疏格式），可与其它进程导出的结果用 merge_histograms 合并"""
+        return {endpoint: hist.to_dict() for endpoint, (_, _, hist) in self._merged().items()}
+
+    def get_stats(self):
+        """获取统计信息"""
+        merged = self._merged()
+        uptime = time.time() - self.last_reset_time
+        stats = {
+            'request_count': {},
+            'error_count': {},
+            'avg_response_time': {},
+            'min_response_time': {},
+            'max_response_time': {},
+            'latency': {},
+            'windows': self.get_windows(),
+            'timings': self.get_timings(),
+            'uptime_seconds': uptime,
+            'uptime_formatted': self._format_uptime(uptime)
+        }
+        for endpoint, (count, errors, hist) in merged.items():
+            stats['request_count'][endpoint] = count
+            if errors:
+                stats['error_count'][endpoint] = errors
+            if hist.count:
+                summary = hist.summary()
+                stats['avg_response_time'][endpoint] = round(summary['avg'], 3)
+                stats['min_response_time'][endpoint] = round(summary['min'], 3)
+                stats['max_response_time'][endpoint] = round(summary['max'], 3)
+                stats['latency'][endpoint] = summary
+        return stats
     
     def _format_uptime(self, seconds):
         """格式化运行时间"""
@@ -71,34 +462,43 @@ class PerformanceMonitor:
     def reset_stats(self):
         """重置统计"""
         with self.lock:
-            self.request_count.clear()
-            self.error_count.clear()
-            self.response_times.clear()
+            # 时间窗口、计数器与耗时保留下来，只清空累计请求统计
+            for shard in self._shards:
+                self._retire(shard)
+            self._generation += 1
+            self._shards = []
+            self._retired = {}
             self.last_reset_time = time.time()
     
-    def get_system_info(self):
-        """获取系统信息"""
+    def get_system_info(self, history_seconds=HEALTH_HISTORY_SECONDS):
+        """
+        获取系统信息：后台采样器最近一次的采样，以及最近 history_seconds 秒的历史（0 为不返回）
+        不在调用线程中采样，首次调用时启动采样线程
+        """
         if not PSUTIL_AVAILABLE:
             return {'error': 'psutil not available', 'note': 'Install psutil for system monitoring'}
-        
-        try:
-            process = psutil.Process(os.getpid())
-            memory_info = process.memory_info()
-            
-            return {
-                'cpu_percent': round(process.cpu_percent(interval=0.1), 2),
-                'memory_mb': round(memory_info.rss / (1024 * 1024), 2),
-                'memory_percent': round(process.memory_percent(), 2),
-                'thread_count': threading.active_count(),
-                'disk_usage': {
-                    'total_gb': round(psutil.disk_usage('.').total / (1024**3), 2),
-                    'used_gb': round(psutil.disk_usage('.').used / (1024**3), 2),
-                    'free_gb': round(psutil.disk_usage('.').free / (1024**3), 2),
-                    'percent': round(psutil.disk_usage('.').percent, 2)
-                }
-            }
-        except Exception as e:
-            return {'error': str(e)}
+
+        sampler = self.system_sampler.start()
+        latest = sampler.latest() or sampler.sample()
+        info = {**latest, 'age': round(time.time() - latest['timestamp'], 2)} if 'timestamp' in latest else latest
+        if history_seconds:
+            info['history'] = sampler.history(history_seconds)
+        return info
+
+def merge_histograms(*exports):
+    """
+    合并多个 get_histograms() 的导出结果（例如来自多个进程），
+    返回 端点 -> LatencyHistogram
+    """
+    merged = {}
+    for export in exports:
+        for endpoint, data in export.items():
+            hist = LatencyHistogram.from_dict(data)
+            if endpoint in merged:
+                merged[endpoint].merge(hist)
+            else:
+                merged[endpoint] = hist
+    return merged
 
 # 全局监控实例
 monitor = PerformanceMonitor()
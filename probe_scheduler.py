@@ -0,0 +1,203 @@
+"""
+主动探测调度模块
+后台按有限速率轮流探测每个客户端的 /test 接口，并缓存最近一次的可达性与延迟：
+/api/test_all 直接返回缓存结果，不再每次点击都对全部客户端发起扫描；
+需要最新结果时可以对选定的客户端强制立即探测（等待时间随客户端数量与并发数增长，
+超时未完成的探测返回缓存结果，探测在后台继续并更新缓存）
+"""
+import asyncio
+import concurrent.futures
+import heapq
+import math
+import random
+import threading
+import time
+
+import aiohttp
+from aiohttp import ClientTimeout
+
+
+class ProbeScheduler:
+    """
+    可达性探测调度器
+    参数:
+        get_targets: 返回当前需要探测的 IP 列表的函数
+        interval: 每个客户端的探测周期（秒）
+        rate: 每秒最多发起的探测数
+        jitter: 探测周期的随机抖动比例，避免所有客户端在同一时刻被探测
+        concurrency: 同时进行的最大探测数
+        timeout: 单次探测超时（秒）
+    """
+
+    def __init__(self, get_targets, interval=60, rate=20, jitter=0.2, concurrency=50,
+                 timeout=3, port=5000, sync_interval=5):
+        if not (math.isfinite(rate) and rate > 0):
+            raise ValueError(f"probe rate must be a positive number, got {rate}")
+        if concurrency < 1:
+            raise ValueError(f"probe concurrency must be at least 1, got {concurrency}")
+        self.get_targets = get_targets
+        self.interval = interval
+        self.rate = rate
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.port = port
+        self.sync_interval = sync_interval  # 重新读取目标列表的间隔（秒）
+        self.lock = threading.Lock()
+        self._cache = {}    # ip -> 最近一次探测结果
+        self._due = {}      # ip -> 下次探测时间
+        self._heap = []     # (下次探测时间, ip)，过期项在弹出时丢弃
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self.stats = {'probes': 0, 'failures': 0, 'forced': 0, 'forced_timeouts': 0}
+
+    # ---------------- 后台循环 ----------------
+
+    def start(self):
+        if self._loop is None:
+            loop = asyncio.new_event_loop()
+            self._loop = loop
+            threading.Thread(target=self._run, args=(loop,), name="probe-loop", daemon=True).start()
+        return self
+
+    def _run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._main())
+
+    def _next_due(self, now):
+        return now + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, ip, due):
+        self._due[ip] = due
+        heapq.heappush(self._heap, (due, ip))
+
+    def _sync_targets(self, now):
+        """
+        加入新客户端（首次探测时间在一个周期内均匀分布），移除已删除的客户端；
+        缓存中不属于目标的结果（包括对未注册 IP 的强制探测）一并清除
+        """
+        try:
+            targets = set(self.get_targets())
+        except Exception as e:
+            print(f"获取探测目标失败: {e}")
+            return
+        for ip in targets - set(self._due):
+            self._schedule(ip, now + random.uniform(0, min(self.interval, len(targets) / self.rate)))
+        for ip in set(self._due) - targets:
+            del self._due[ip]
+        with self.lock:
+            for ip in set(self._cache) - targets:
+                del self._cache[ip]
+
+    def _ensure_session(self):
+        # 只在事件循环线程中调用，强制探测可能先于 _main 运行
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, force_close=False),
+                timeout=ClientTimeout(total=self.timeout, connect=1)
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def _main(self):
+        self._ensure_session()
+        next_sync = 0
+        while True:
+            now = time.time()
+            if now >= next_sync:
+                self._sync_targets(now)
+                next_sync = now + self.sync_interval
+            if not self._heap or self._heap[0][0] > now:
+                delay = min(self._heap[0][0] - now if self._heap else self.sync_interval, next_sync - now)
+                await asyncio.sleep(max(delay, 0.01))
+                continue
+            due, ip = heapq.heappop(self._heap)
+            if self._due.get(ip) != due:
+                continue  # 已被重新安排或已删除
+            self._schedule(ip, self._next_due(now))
+            asyncio.ensure_future(self._probe(ip))
+            # 控制发起速率
+            await asyncio.sleep(1.0 / self.rate)
+
+    async def _probe(self, ip):
+        """探测单个客户端并更新缓存"""
+        self._ensure_session()
+        async with self._semaphore:
+            start = time.time()
+            try:
+                async with self._session.get(f'http://{ip}:{self.port}/test') as resp:
+                    text = await resp.text()
+                    if resp.status == 200:
+                        result = {"ip": ip, "status": "success", "response": text}
+                    else:
+                        result = {"ip": ip, "status": "error", "message": f"HTTP {resp.status}"}
+            except asyncio.TimeoutError:
+                result = {"ip": ip, "status": "error", "message": "Request timed out"}
+            except Exception as e:
+                result = {"ip": ip, "status": "error", "message": str(e) or type(e).__name__}
+            result["latency"] = round(time.time() - start, 4)
+            result["checked_at"] = time.time()
+        with self.lock:
+            self._cache[ip] = result
+            self.stats['probes'] += 1
+            if result["status"] != "success":
+                self.stats['failures'] += 1
+        return result
+
+    async def _probe_many(self, ips):
+        now = time.time()
+        for ip in ips:
+            if ip in self._due:
+                self._schedule(ip, self._next_due(now))
+        return await asyncio.gather(*(self._probe(ip) for ip in ips))
+
+    # ---------------- 供 Flask 线程调用 ----------------
+
+    def probe_duration(self, count):
+        """探测 count 个客户端所需的最长时间：按并发数分批，每批最多一个超时"""
+        return math.ceil(count / self.concurrency) * self.timeout
+
+    def probe_now(self, ips, timeout=None):
+        """
+        立即探测指定客户端并等待结果（同时刷新缓存）
+        timeout 为空时按 probe_duration 估算等待时间；到时仍未全部完成则返回缓存结果
+        （已完成的探测已写入缓存，未完成的继续在后台进行）
+        """
+        ips = list(ips)
+        self.start()
+        with self.lock:
+            self.stats['forced'] += len(ips)
+        future = asyncio.run_coroutine_threadsafe(self._probe_many(ips), self._loop)
+        try:
+            return future.result(timeout=timeout or self.probe_duration(len(ips)) + 2)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                self.stats['forced_timeouts'] += 1
+            return self.results(ips)
+
+    def results(self, ips):
+        """返回指定客户端的缓存结果，附带结果的新旧程度 age（秒）"""
+        now = time.time()
+        output = []
+        with self.lock:
+            for ip in ips:
+                result = self._cache.get(ip)
+                if result is None:
+                    output.append({"ip": ip, "status": "unknown", "message": "Not probed yet"})
+                else:
+                    output.append({**result, "age": round(now - result["checked_at"], 1)})
+        return output
+
+    def get_stats(self):
+        with self.lock:
+            cached = list(self._cache.values())
+        reachable = [r for r in cached if r["status"] == "success"]
+        return {
+            **self.stats,
+            'interval': self.interval,
+            'rate': self.rate,
+            'targets': len(self._due),
+            'cached': len(cached),
+            'reachable': len(reachable),
+            'avg_latency': round(sum(r["latency"] for r in reachable) / len(reachable), 4) if reachable else None,
+        }
@@ -65,7 +65,9 @@ def after_request(response):
     """请求后处理：记录性能数据"""
     if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
         response_time = time.time() - request.start_time
-        endpoint = f"{request.method} {request.path}"
+        # 按路由模板统计（如 /api/send/<ip>），避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
         is_error = response.status_code >= 400
         monitor.record_request(endpoint, response_time, is_error)
     return response
@@ -0,0 +1,209 @@
+"""
+注册表持久化模块
+注册表变化时只标记为脏数据，由后台线程在防抖间隔后统一写盘：
+先写临时文件再原子重命名，进程崩溃也不会留下写了一半的 ips.json
+
+可选的追加式变更日志（journal）：每次变更追加一行 JSON，
+启动时先加载快照再按顺序重放日志，快照写入成功后清空日志
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+
+def _write_atomic(path, data):
+    """写入临时文件后用 os.replace 原子替换目标文件"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, journal_path=None):
+    """
+    读取快照并重放变更日志
+    返回:
+        (记录列表, 重放的日志条数)
+    """
+    entries = []
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"读取 {path} 失败，将以空注册表启动并重放日志: {e}")
+            entries = []
+
+    replayed = 0
+    if journal_path and os.path.exists(journal_path):
+        by_ip = {e['ip']: e for e in entries if e.get('ip')}
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能只写了一半，忽略即可
+                    continue
+                if record.get('op') == 'put':
+                    # 已有的 IP 原地更新以保持注册顺序，新 IP 追加到末尾
+                    entry = record['entry']
+                    by_ip[entry['ip']] = entry
+                elif record.get('op') == 'remove':
+                    by_ip.pop(record.get('ip'), None)
+                replayed += 1
+        entries = list(by_ip.values())
+    return entries, replayed
+
+
+class RegistryPersister:
+    """
+    注册表写回器
+    参数:
+        registry: ClientRegistry 实例
+        path: 快照文件路径（ips.json）
+        debounce: 防抖间隔（秒），间隔内的多次变化合并为一次写盘
+        journal_path: 变更日志路径，为空时不记录日志
+        max_journal_records: 日志超过该条数时立即写快照并清空日志
+    """
+
+    def __init__(self, registry, path, debounce=1.0, journal_path=None, max_journal_records=5000):
+        self.registry = registry
+        self.path = path
+        self.debounce = debounce
+        self.journal_path = journal_path
+        self.max_journal_records = max_journal_records
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()  # 串行化日志追加与快照写入（后台线程与退出时的 flush）
+        self.wakeup = threading.Event()
+        self._pending = []          # 尚未写入日志的变更
+        self._dirty_since = None    # 第一次未落盘变化的时间
+        self._journal_records = 0   # 上次快照之后写入日志的条数
+        self._thread = None
+        self.stats = {
+            'snapshots_written': 0,
+            'journal_records_written': 0,
+            'last_snapshot_at': None,
+            'last_snapshot_seconds': None,
+            'last_error': None,
+        }
+        registry.add_listener(self._on_change)
+
+    def load(self):
+        """启动时加载快照并重放日志，重放过日志则立即写一次快照"""
+        entries, replayed = load_snapshot(self.path, self.journal_path)
+        self.registry.load(entries)
+        with self.lock:
+            # 刚从磁盘加载的内容无需再写回
+            self._pending.clear()
+            self._dirty_since = None
+        if replayed:
+            print(f"已从变更日志重放 {replayed} 条记录")
+            self.flush()
+        return len(entries)
+
+    def start(self):
+        """启动后台写盘线程，并在进程退出时写入剩余变化"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="registry-persister", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+        return self
+
+    def _on_change(self, op, ip, entry):
+        # 在注册表锁内调用，只做内存操作
+        with self.lock:
+            if self.journal_path and op != 'load':
+                self._pending.append({'op': op, 'ip': ip, 'entry': entry})
+            if self._dirty_since is None:
+                self._dirty_since = time.time()
+        self.wakeup.set()
+
+    def mark_dirty(self):
+        """手动标记需要写快照"""
+        with self.lock:
+            if self._dirty_since is None:
+                self._dirty_since = time.time()
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # 日志尽快落盘，快照等防抖间隔结束再写
+            self._write_journal()
+            with self.lock:
+                dirty_since = self._dirty_since
+            if dirty_since is None:
+                continue
+            delay = dirty_since + self.debounce - time.time()
+            if delay > 0 and self._journal_records < self.max_journal_records:
+                if self.wakeup.wait(timeout=delay):
+                    continue  # 期间又有变化：先写日志，下一轮再判断
+            self.flush()
+
+    def _write_journal(self):
+        if not self.journal_path:
+            return
+        with self.io_lock:
+            self._append_journal()
+
+    def _append_journal(self):
+        with self.lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        try:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in pending))
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_records += len(pending)
+            self.stats['journal_records_written'] += len(pending)
+        except OSError as e:
+            self.stats['last_error'] = str(e)
+            print(f"写入变更日志失败: {e}")
+
+    def flush(self):
+        """立即写入快照；快照成功后清空日志"""
+        with self.io_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            self._dirty_since = None
+            pending, self._pending = self._pending, []
+        start = time.time()
+        try:
+            # 先取快照再写：快照之后的变化会重新标记为脏数据
+            snapshot = self.registry.snapshot()
+            _write_atomic(self.path, json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')))
+            if self.journal_path and os.path.exists(self.journal_path):
+                open(self.journal_path, "w").close()
+            self._journal_records = 0
+            self.stats['snapshots_written'] += 1
+            self.stats['last_snapshot_at'] = time.time()
+            self.stats['last_snapshot_seconds'] = round(time.time() - start, 4)
+        except OSError as e:
+            # 快照失败：把变更放回日志队列，稍后重试
+            with self.lock:
+                self._pending[:0] = pending
+                if self._dirty_since is None:
+                    self._dirty_since = time.time()
+            self.wakeup.set()
+            self.stats['last_error'] = str(e)
+            print(f"保存 {self.path} 失败: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                'dirty': self._dirty_since is not None,
+                'pending_journal_records': len(self._pending),
+                'journal_records_since_snapshot': self._journal_records,
+                'debounce': self.debounce,
+                'journal_enabled': bool(self.journal_path),
+            }
@@ -0,0 +1,273 @@
+"""
+分层中继转发模块
+客户端数量很大时，主服务器只向少量中继客户端发送一次指令，
+由中继把指令转发给自己负责的子树并汇总返回每个客户端的确认结果
+
+中继树由注册表自动生成：只有上报了 relay=true 的客户端（run_v2.py）会被选为中继，
+目标集合变化或中继失败时自动重建；中继失败后进入冷却期，期间由上一级直接发送其子树。
+连接中继失败时由上一级直接发送该子树；指令发出后才失败（超时、非 200 等）时不重发，子树结果记为未知
+"""
+import asyncio
+import math
+import threading
+import time
+
+import aiohttp
+from aiohttp import ClientTimeout
+
+RELAY_PATH = '/relay'
+
+# 请求发出之前的失败（连接被拒绝、主机不可达、建立连接超时）：中继肯定没有收到指令，可以改为直接发送；
+# 其它失败（读取超时、非 200、响应无法解析）时中继可能已经执行并转发，重发会让整个子树执行两次
+CONNECT_ERRORS = tuple(e for e in (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', None))
+                       if e is not None)
+
+
+def _ip_sort_key(ip):
+    """按数值顺序排序 IP，使同一网段的客户端落在同一子树"""
+    try:
+        return tuple(int(p) for p in ip.split('.'))
+    except (ValueError, AttributeError):
+        return (999, str(ip))
+
+
+def flatten_tree(nodes):
+    """返回树中所有节点的 IP（先序）"""
+    ips = []
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        ips.append(node['ip'])
+        stack.extend(reversed(node.get('children') or []))
+    return ips
+
+
+def tree_depth(nodes):
+    """返回树的深度（只有叶子时为1）"""
+    if not nodes:
+        return 0
+    return 1 + max(tree_depth(node.get('children') or []) for node in nodes)
+
+
+def _build(entries, fanout):
+    if len(entries) <= fanout:
+        return [{'ip': e['ip']} for e in entries]
+    relays = [e for e in entries if e.get('relay')]
+    if not relays:
+        return [{'ip': e['ip']} for e in entries]
+
+    # 在有序列表中均匀挑选中继，其余客户端按连续区间分给各个中继
+    group_count = min(fanout, len(relays))
+    step = len(relays) / group_count
+    heads = [relays[int(i * step)] for i in range(group_count)]
+    head_ips = {h['ip'] for h in heads}
+    rest = [e for e in entries if e['ip'] not in head_ips]
+    chunk = math.ceil(len(rest) / group_count) if rest else 0
+
+    nodes = []
+    for i, head in enumerate(heads):
+        node = {'ip': head['ip']}
+        part = rest[i * chunk:(i + 1) * chunk]
+        if part:
+            node['children'] = _build(part, fanout)
+        nodes.append(node)
+    return nodes
+
+
+def build_relay_tree(entries, fanout=50):
+    """
+    根据客户端记录构建中继树
+    参数:
+        entries: 客户端记录列表，relay 为真的记录可以作为中继
+        fanout: 每个节点（含主服务器）最多直接发送的数量
+    返回:
+        顶层节点列表，每个节点为 {"ip": ..., "children": [...]}（叶子没有 children）
+    """
+    ordered = sorted(entries, key=lambda e: _ip_sort_key(e['ip']))
+    return _build(ordered, max(2, int(fanout)))
+
+
+class RelayPlanner:
+    """
+    中继树规划器
+    缓存最近一次构建的树，目标集合或中继可用性变化时才重建
+    """
+
+    def __init__(self, fanout=50, failure_cooldown=60):
+        self.fanout = fanout
+        self.failure_cooldown = failure_cooldown  # 中继失败后的冷却时间（秒）
+        self.lock = threading.Lock()
+        self._failed_until = {}
+        self._cache_key = None
+        self._tree = []
+        self.rebuild_count = 0
+        self.last_built_at = None
+
+    def mark_failed(self, ip):
+        """标记中继失败，冷却期内不再被选为中继"""
+        with self.lock:
+            self._failed_until[ip] = time.time() + self.failure_cooldown
+
+    def plan(self, entries):
+        """返回适用于 entries 的中继树（必要时重建）"""
+        now = time.time()
+        with self.lock:
+            self._failed_until = {ip: t for ip, t in self._failed_until.items() if t > now}
+            failed = set(self._failed_until)
+            candidates = [
+                {'ip': e['ip'], 'relay': bool(e.get('relay')) and e['ip'] not in failed}
+                for e in entries
+            ]
+            cache_key = (self.fanout, tuple((c['ip'], c['relay']) for c in candidates))
+            if cache_key != self._cache_key:
+                self._tree = build_relay_tree(candidates, self.fanout)
+                self._cache_key = cache_key
+                self.rebuild_count += 1
+                self.last_built_at = now
+            return self._tree
+
+    def describe(self):
+        """返回当前树的概要"""
+        with self.lock:
+            tree = self._tree
+            return {
+                'fanout': self.fanout,
+                'top_level_nodes': len(tree),
+                'relay_count': sum(1 for _ in _iter_relays(tree)),
+                'depth': tree_depth(tree),
+                'client_count': len(flatten_tree(tree)),
+                'rebuild_count': self.rebuild_count,
+                'last_built_at': self.last_built_at,
+                'cooling_down': sorted(self._failed_until),
+                'tree': tree
+            }
+
+
+def _iter_relays(nodes):
+    for node in nodes:
+        if node.get('children'):
+            yield node['ip']
+            yield from _iter_relays(node['children'])
+
+
+def relay_timeout(children, per_level=6, base=4):
+    """中继请求的超时时间，随子树深度增长"""
+    return base + per_level * tree_depth(children)
+
+
+async def relay_fan_out(session, nodes, command, send_leaf, hop=1,
+                        on_result=None, on_relay_failure=None, extra_timeout=0, headers=None):
+    """
+    按中继树并发下发指令
+    参数:
+        session: aiohttp会话
+        nodes: 本级需要发送的节点列表
+        command: 指令内容（/run 的请求体）
+        send_leaf: 协程函数 send_leaf(session, ip, command)，向单个客户端发送并返回结果字典
+        hop: 当前跳数（主服务器直接发送为1）
+        on_result: 可选回调，每个客户端结果到达时调用
+        on_relay_failure: 可选回调，中继失败时以中继IP调用
+        extra_timeout: 指令本身的执行时长（按键序列），叠加到中继请求超时上
+        headers: 发给中继的附加请求头（如 X-Trace-Id）
+    返回:
+        (results, relay_stats)
+        results: 每个客户端的结果列表，带 hop 与 latency
+        relay_stats: 每个中继的跳数、子树规模、往返耗时与中继内部耗时
+    """
+    results = []
+    relay_stats = []
+
+    def emit(result):
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    async def send_direct(ip):
+        start = time.time()
+        result = await send_leaf(session, ip, command)
+        result.setdefault('latency', round(time.time() - start, 4))
+        result['hop'] = hop
+        emit(result)
+
+    async def send_via_relay(node):
+        ip = node['ip']
+        children = node['children']
+        start = time.time()
+        try:
+            async with session.post(
+                f'http://{ip}:5000{RELAY_PATH}',
+                json={'command': command, 'children': children, 'hop': hop},
+                headers=headers,
+                timeout=ClientTimeout(total=relay_timeout(children) + extra_timeout, connect=2)
+            ) as resp:
+                if resp.status != 200:
+                    raise RuntimeError(f"HTTP {resp.status}")
+                data = await resp.json()
+            rtt = time.time() - start
+            for result in data.get('results', []):
+                emit(result)
+            relay_elapsed = data.get('elapsed')
+            relay_stats.append({
+                'relay': ip,
+                'hop': hop,
+                'subtree_size': len(flatten_tree(children)) + 1,
+                'rtt': round(rtt, 4),
+                'relay_elapsed': relay_elapsed,
+                'network_overhead': round(rtt - relay_elapsed, 4) if relay_elapsed is not None else None
+            })
+            relay_stats.extend(data.get('relay_stats', []))
+        except CONNECT_ERRORS as e:
+            # 中继未收到指令：由本级直接发送整个子树
+            relay_stats.append({
+                'relay': ip,
+                'hop': hop,
+                'subtree_size': len(flatten_tree(children)) + 1,
+                'error': str(e) or type(e).__name__,
+                'fallback': True
+            })
+            if on_relay_failure is not None:
+                on_relay_failure(ip)
+            await asyncio.gather(*(send_direct(sub_ip) for sub_ip in flatten_tree([node])))
+        except Exception as e:
+            # 指令已发出但没有得到有效响应：子树的执行情况未知，不重发，整个子树报告为失败
+            error = str(e) or type(e).__name__
+            relay_stats.append({
+                'relay': ip,
+                'hop': hop,
+                'subtree_size': len(flatten_tree(children)) + 1,
+                'error': error,
+                'fallback': False
+            })
+            if on_relay_failure is not None:
+                on_relay_failure(ip)
+            latency = round(time.time() - start, 4)
+            for sub_ip in flatten_tree([node]):
+                emit({'ip': sub_ip, 'status': 'error', 'outcome_unknown': True, 'hop': hop, 'latency': latency,
+                      'message': f"Relay {ip} failed after the command was sent ({error}); not resent"})
+
+    await asyncio.gather(*(
+        send_via_relay(node) if node.get('children') else send_direct(node['ip'])
+        for node in nodes
+    ))
+    return results, relay_stats
+
+
+def summarize_relay_stats(relay_stats):
+    """
+    按跳数汇总中继耗时
+    带 error 的中继都计为 failed（其中 fallback 为已改为直接发送的数量），往返时间只取成功的中继
+    """
+    hops = {}
+    for stat in relay_stats:
+        summary = hops.setdefault(stat['hop'], {'relays': 0, 'failed': 0, 'fallback': 0, 'rtt': []})
+        summary['relays'] += 1
+        if 'error' in stat:
+            summary['failed'] += 1
+            summary['fallback'] += bool(stat.get('fallback'))
+        elif stat.get('rtt') is not None:
+            summary['rtt'].append(stat['rtt'])
+    for summary in hops.values():
+        rtts = summary.pop('rtt')
+        summary['avg_rtt'] = round(sum(rtts) / len(rtts), 4) if rtts else None
+        summary['max_rtt'] = round(max(rtts), 4) if rtts else None
+    return {str(hop): hops[hop] for hop in sorted(hops)}
@@ -2,7 +2,7 @@ import pyautogui
 import time
 import socket
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import threading
 from datetime import datetime
@@ -10,6 +10,11 @@ import logging
 import logging.handlers
 import os
 
+from async_logging import setup_queue_logging
+from metrics_exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsExporter, add_process_metrics
+from slow_requests import SlowRequestLog
+from stack_profiler import profile_request
+
 app = Flask(__name__)
 CORS(app)
 
@@ -30,12 +35,14 @@ file_handler = logging.handlers.RotatingFileHandler(
 file_handler.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+
+# 文件与控制台输出由后台线程完成，请求线程只把记录放入有界队列（队列满时丢弃并计数）
+log_queue_handler, log_listener = setup_queue_logging(file_handler, console_handler)
+logger.addHandler(log_queue_handler)
 
 # 性能监控
 try:
@@ -45,6 +52,9 @@ except ImportError:
     PERFORMANCE_MONITORING = False
     monitor = None
 
+# 慢请求记录：阈值由 SLOW_REQUEST_SECONDS / SLOW_REQUEST_THRESHOLDS 配置，SLOW_REQUEST_SPILL=1 时另写入 logs/slow_client.jsonl
+slow_log = SlowRequestLog.from_env('client')
+
 @app.before_request
 def log_request_info():
     """记录请求信息并监控性能"""
@@ -56,9 +66,14 @@ def after_request(response):
     """请求后处理：记录性能数据"""
     if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
         response_time = time.time() - request.start_time
-        endpoint = f"{request.method} {request.path}"
+        # 按路由模板统计（如 /api/send/<ip>），避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
         is_error = response.status_code >= 400
         monitor.record_request(endpoint, response_time, is_error)
+        # 超过路由阈值的请求连同分阶段耗时与参数摘要写入慢请求记录
+        slow_log.observe(endpoint, response_time, response.status_code, request,
+                         getattr(request, 'trace', None), getattr(request, 'slow_info', None))
     return response
 
 def get_pc_name():
@@ -101,13 +116,53 @@ def health_check():
         'status': 'healthy',
         'timestamp': time.time(),
         'pc_name': get_pc_name(),
-        'ip': get_client_ip()
+        'ip': get_client_ip(),
+        'logging': log_queue_handler.get_stats()
     }
     if PERFORMANCE_MONITORING:
         health_status['performance'] = monitor.get_stats()
         health_status['system'] = monitor.get_system_info()
     return jsonify(health_status), 200
 
+# Prometheus 指标（请求统计、进程状态与日志队列）
+metrics = add_process_metrics(MetricsExporter('client', monitor))
+metrics.counter('log_records', 'Log records by outcome (dropped: queue full)',
+                lambda: [({'outcome': key}, log_queue_handler.get_stats()[key]) for key in ('enqueued', 'dropped')])
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus 文本格式指标
+    """
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    采样分析所有线程的调用栈（需设置 DEBUG_TOKEN），见 stack_profiler
+    """
+    result, status = profile_request(request.args, request.headers)
+    if isinstance(result, str):
+        return Response(result, mimetype='text/plain'), status
+    return jsonify(result), status
+
+@app.route('/debug/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """
+    查询最近的慢请求（耗时超过所在路由的阈值，见 slow_requests）
+    参数: endpoint（如 "POST /run_extract_amount"）、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": slow_log.get_stats(),
+        "requests": slow_log.query(request.args.get('endpoint'), min_ms, limit)
+    })
+
 def get_ip_addresses():
     """
     获取本机所有 IP 地址
@@ -9,10 +9,14 @@ import pyautogui
 import logging
 import logging.handlers
 import socket
+import asyncio
+import aiohttp
+from aiohttp import ClientTimeout
 import requests
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import threading
+import uuid
 from datetime import datetime
 
 import ctypes
@@ -20,12 +24,29 @@ import win32gui
 import win32con
 import win32api
 
+from relay_tree import relay_fan_out
+from udp_heartbeat import encode_heartbeat
+from async_logging import rate_limited_logger, setup_queue_logging
+from metrics_exporter import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsExporter, add_process_metrics
+from slow_requests import SlowRequestLog
+from stack_profiler import profile_request
+from tracing import TRACE_HEADER, tracer
+from input_control import (
+    InputController,
+    create_backend,
+    SequenceError,
+    InputTimeout,
+    parse_command,
+    describe_command,
+    command_duration
+)
+
 # 导入公共工具函数
 from utils import (
     get_pc_name,
     get_client_ip,
     get_ip_addresses,
-    simulate_keypress as utils_simulate_keypress,
+    probe_local_ip,
     preprocess_image_multiple_methods,
     ocr_with_multiple_configs,
     extract_amount_from_text,
@@ -54,12 +75,18 @@ file_handler = logging.handlers.RotatingFileHandler(
 file_handler.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s %(levelname)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+
+# 文件与控制台输出由后台线程完成，请求线程只把记录放入有界队列（队列满时丢弃并计数）
+log_queue_handler, log_listener = setup_queue_logging(file_handler, console_handler)
+logger.addHandler(log_queue_handler)
+
+# OCR 每个预处理方法与配置组合的识别结果（每个 ROI 可达数十条）按 OCR_LOG_RATE 条/秒限流
+ocr_combo_logger, ocr_log_limiter = rate_limited_logger(
+    'ocr.combinations', rate=float(os.environ.get('OCR_LOG_RATE', '5')), burst=20)
 
 # 性能监控
 try:
@@ -69,6 +96,9 @@ except ImportError:
     PERFORMANCE_MONITORING = False
     monitor = None
 
+# 慢请求记录：阈值由 SLOW_REQUEST_SECONDS / SLOW_REQUEST_THRESHOLDS 配置，SLOW_REQUEST_SPILL=1 时另写入 logs/slow_client.jsonl
+slow_log = SlowRequestLog.from_env('client')
+
 @app.before_request
 def log_request_info():
     """记录请求信息并监控性能"""
@@ -76,26 +106,74 @@ def log_request_info():
         request.start_time = time.time()
     # 减少日志输出，只在DEBUG模式下详细记录
     # logging.info("收到请求: %s %s, 参数: %s", request.method, request.path, dict(request.args))
+    if request.endpoint in TRACED_ENDPOINTS:
+        # 沿用主服务器下发时携带的追踪 ID，没有则新建
+        request.trace = tracer.begin(request.url_rule.rule, request.headers.get(TRACE_HEADER))
 
 @app.after_request
 def after_request(response):
     """请求后处理：记录性能数据"""
+    trace = getattr(request, 'trace', None)
+    if trace is not None:
+        response.headers[TRACE_HEADER] = trace.trace_id
+        response.headers['Server-Timing'] = trace.server_timing()
     if PERFORMANCE_MONITORING and hasattr(request, 'start_time'):
         response_time = time.time() - request.start_time
-        endpoint = f"{request.method} {request.path}"
+        # 按路由模板统计（如 /api/send/<ip>），避免每个实际路径产生一个统计项
+        rule = request.url_rule.rule if request.url_rule else "<unmatched>"
+        endpoint = f"{request.method} {rule}"
         is_error = response.status_code >= 400
         monitor.record_request(endpoint, response_time, is_error)
+        # 超过路由阈值的请求连同分阶段耗时与参数摘要写入慢请求记录
+        slow_log.observe(endpoint, response_time, response.status_code, request,
+                         getattr(request, 'trace', None), getattr(request, 'slow_info', None))
     return response
 
+@app.teardown_request
+def end_trace(error=None):
+    """请求结束（包括未处理的异常）时结束追踪并存入缓冲区"""
+    trace = getattr(request, 'trace', None)
+    if trace is not None:
+        tracer.end(trace, error=error is not None)
+
+# 分阶段追踪的接口：/traces 可按端点查询最近的追踪，响应头带 X-Trace-Id 与 Server-Timing
+TRACED_ENDPOINTS = {'run_script', 'relay_command', 'run_extract_amount', 'capture'}
+
+# 各阶段耗时同时写入性能监控（/metrics 中的 client_ocr_stage_duration_seconds）
+if PERFORMANCE_MONITORING:
+    tracer.add_listener(lambda name, seconds: monitor.record_timing('ocr_stage', seconds, stage=name))
+
 # 系统相关函数已移至utils.py，从那里导入使用
 
+# 输入子系统：所有按键、按键序列和窗口焦点切换都经由同一个输入队列串行执行
+# INPUT_BACKEND 可选 auto（默认，Windows 上使用 win32 keybd_event）、pyautogui、recording
+input_controller = InputController(create_backend(os.environ.get('INPUT_BACKEND', 'auto')))
+
 def simulate_keypress(key='f7'):
     """
     模拟按下指定的键盘按键（默认 F7）
-    同时在控制台打印和写入日志
-    使用utils中的函数，但添加日志功能
+    通过输入队列执行，避免与其他请求的输入操作穿插
+    """
+    logging.info("模拟按键: %s", key)
+    input_controller.press(key)
+
+def execute_command(command):
+    """
+    执行单个按键或按键序列指令
+    返回: 附加到确认信息中的字段（按键序列包含每个步骤的耗时）
     """
-    utils_simulate_keypress(key, use_logging=True)
+    if "sequence" in command:
+        start = time.perf_counter()
+        timeout = command_duration(command) + 10
+        logging.info("执行按键序列: %d 个步骤", len(command["sequence"]))
+        steps = input_controller.run_sequence(command["sequence"], timeout=timeout)
+        return {
+            "message": f"Sequence of {len(steps)} steps executed successfully",
+            "steps": steps,
+            "duration": round(time.perf_counter() - start, 4)
+        }
+    simulate_keypress(command["key"])
+    return {"message": f"Key '{command['key']}' pressed successfully"}
 
 # OCR相关函数已移至utils.py，从那里导入使用
 
@@ -122,73 +200,83 @@ def ocr_extract_amount(image, debug_dir=None, roi_index=None):
     # 2. 对每种预处理图像使用多种OCR配置识别
     all_results = []  # [(method_name, config_name, amount, confidence), ...]
     
-    for method_name, proc_img in processed_images:
-        ocr_results = ocr_with_multiple_configs(proc_img)
-        for config_name, text, confidence in ocr_results:
-            amount = extract_amount_from_text(text)
-            if amount:
-                all_results.append((method_name, config_name, amount, confidence, text))
-                logging.info(f"方法 {method_name} + 配置 {config_name}: 识别到金额 {amount} (置信度: {confidence:.1f}, 原始文本: {text})")
+    with tracer.span('recognize'):
+        for method_name, proc_img in processed_images:
+            ocr_results = ocr_with_multiple_configs(proc_img)
+            for config_name, text, confidence in ocr_results:
+                amount = extract_amount_from_text(text)
+                if amount:
+                    all_results.append((method_name, config_name, amount, confidence, text))
+                    ocr_combo_logger.info("方法 %s + 配置 %s: 识别到金额 %s (置信度: %.1f, 原始文本: %s)",
+                                          method_name, config_name, amount, confidence, text)
     
     if not all_results:
         logging.warning("所有OCR方法都未能识别到金额")
         # 返回第一个预处理图像作为fallback
         return None, processed_images[0][1] if processed_images else image
     
-    # 3. 结果验证和选择策略
-    # 策略1: 统计每个金额出现的次数（投票机制）
-    amount_votes = {}
-    for method_name, config_name, amount, confidence, text in all_results:
-        if amount not in amount_votes:
-            amount_votes[amount] = {
-                'count': 0,
-                'total_confidence': 0,
-                'methods': []
-            }
-        amount_votes[amount]['count'] += 1
-        amount_votes[amount]['total_confidence'] += confidence
-        amount_votes[amount]['methods'].append((method_name, config_name))
-    
-    # 策略2: 选择出现次数最多的金额
-    # 如果出现次数相同，选择置信度最高的
-    best_amount = None
-    best_score = -1
-    
-    for amount, data in amount_votes.items():
-        # 综合评分：出现次数 * 10 + 平均置信度
-        avg_confidence = data['total_confidence'] / data['count']
-        score = data['count'] * 10 + avg_confidence
+    with tracer.span('vote', candidates=len(all_results)) as vote_trace:
+        # 3. 结果验证和选择策略
+        # 策略1: 统计每个金额出现的次数（投票机制）
+        amount_votes = {}
+        for method_name, config_name, amount, confidence, text in all_results:
+            if amount not in amount_votes:
+                amount_votes[amount] = {
+                    'count': 0,
+                    'total_confidence': 0,
+                    'methods': []
+                }
+            amount_votes[amount]['count'] += 1
+            amount_votes[amount]['total_confidence'] += confidence
+            amount_votes[amount]['methods'].append((method_name, config_name))
+    
+        # 策略2: 选择出现次数最多的金额
+        # 如果出现次数相同，选择置信度最高的
+        best_amount = None
+        best_score = -1
+    
+        for amount, data in amount_votes.items():
+            # 综合评分：出现次数 * 10 + 平均置信度
+            avg_confidence = data['total_confidence'] / data['count']
+            score = data['count'] * 10 + avg_confidence
         
-        if score > best_score:
-            best_score = score
-            best_amount = amount
-    
-    # 策略3: 如果最佳金额只出现1次，尝试使用置信度最高的结果
-    if best_amount and best_amount in amount_votes and amount_votes[best_amount]['count'] == 1 and len(all_results) > 1:
-        # 找到置信度最高的结果
-        best_by_confidence = max(all_results, key=lambda x: x[3])
-        if best_by_confidence[3] > 60:  # 置信度阈值
-            best_amount = best_by_confidence[2]
-            logging.info(f"使用高置信度结果: {best_amount} (置信度: {best_by_confidence[3]:.1f})")
-    
-    # 策略4: 后处理验证 - 检查金额格式是否合理
-    if best_amount:
-        # 移除前导零（除非是小数）
-        if '.' not in best_amount and best_amount.startswith('0') and len(best_amount) > 1:
-            best_amount = best_amount.lstrip('0') or '0'
+            if score > best_score:
+                best_score = score
+                best_amount = amount
+    
+        # 策略3: 如果最佳金额只出现1次，尝试使用置信度最高的结果
+        if best_amount and best_amount in amount_votes and amount_votes[best_amount]['count'] == 1 and len(all_results) > 1:
+            # 找到置信度最高的结果
+            best_by_confidence = max(all_results, key=lambda x: x[3])
+            if best_by_confidence[3] > 60:  # 置信度阈值
+                best_amount = best_by_confidence[2]
+                logging.info(f"使用高置信度结果: {best_amount} (置信度: {best_by_confidence[3]:.1f})")
+    
+        # 策略4: 后处理验证 - 检查金额格式是否合理
+        if best_amount:
+            # 移除前导零（除非是小数）
+            if '.' not in best_amount and best_amount.startswith('0') and len(best_amount) > 1:
+                best_amount = best_amount.lstrip('0') or '0'
         
-        # 验证金额格式和合理性
-        best_amount = validate_ocr_result(best_amount, amount_votes, all_results)
+            # 验证金额格式和合理性
+            best_amount = validate_ocr_result(best_amount, amount_votes, all_results)
         
-        # 如果验证失败，尝试使用第二高的结果
-        if not best_amount or not validate_amount_format(best_amount):
-            logging.warning(f"金额 {best_amount} 验证失败，尝试使用备选结果")
-            sorted_amounts = sorted(amount_votes.items(), key=lambda x: x[1]['count'] * 10 + x[1]['total_confidence'] / x[1]['count'], reverse=True)
-            for amount, data in sorted_amounts[1:3]:  # 尝试前3个结果
-                if validate_amount_format(amount):
-                    best_amount = amount
-                    logging.info(f"使用备选金额: {best_amount}")
-                    break
+            # 如果验证失败，尝试使用第二高的结果
+            if not best_amount or not validate_amount_format(best_amount):
+                logging.warning(f"金额 {best_amount} 验证失败，尝试使用备选结果")
+                sorted_amounts = sorted(amount_votes.items(), key=lambda x: x[1]['count'] * 10 + x[1]['total_confidence'] / x[1]['count'], reverse=True)
+                for amount, data in sorted_amounts[1:3]:  # 尝试前3个结果
+                    if validate_amount_format(amount):
+                        best_amount = amount
+                        logging.info(f"使用备选金额: {best_amount}")
+                        break
+
+        # 投票过程记入 span 属性，慢请求记录与 /traces 中可以看到每个候选金额的票数
+        if tracer.current() is not None:
+            vote_trace['votes'] = {amount: {'count': data['count'],
+                                            'avg_confidence': round(data['total_confidence'] / data['count'], 1)}
+                                   for amount, data in amount_votes.items()}
+            vote_trace['chosen'] = best_amount
     
     # 找到对应的最佳预处理图像
     best_processed = None
@@ -213,11 +301,12 @@ def ocr_extract_amount(image, debug_dir=None, roi_index=None):
     
     return best_amount, best_processed
 
-def screenshot_extract_amount(rois, ld_index):
+def screenshot_extract_amount(rois, ld_index, screenshot=None):
     """
     截屏一次，并对截图按照传入的 ROIs 进行 OCR 提取金额，
     将全屏截图及各 ROI 的处理结果保存并返回。
     截图文件名根据 ld_index 来命名，如 screenshot_ldplayer_1.png
+    screenshot: 已在输入队列中截取好的截图，为空时在此处截屏
     """
     folder = "screenshots"
     if not os.path.exists(folder):
@@ -226,14 +315,18 @@ def screenshot_extract_amount(rois, ld_index):
     # 创建调试目录
     debug_dir = os.path.join(folder, f"debug_ldplayer_{ld_index}")
     
-    logging.info("开始截屏...")
-    screenshot = pyautogui.screenshot()
+    if screenshot is None:
+        logging.info("开始截屏...")
+        with tracer.span('screenshot'):
+            screenshot = pyautogui.screenshot()
     # 使用 ld_index 构造截图文件名
     filename = os.path.join(folder, f"screenshot_ldplayer_{ld_index}.png")
-    screenshot.save(filename)
+    with tracer.span('debug_write'):
+        screenshot.save(filename)
     logging.info("已保存截图到 %s", filename)
     
-    screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
+    with tracer.span('convert'):
+        screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
     
     roi_results = []
     for roi_idx, roi in enumerate(rois):
@@ -259,15 +352,18 @@ def screenshot_extract_amount(rois, ld_index):
             continue
         
         # 保存原始ROI图像用于调试
-        os.makedirs(debug_dir, exist_ok=True)
-        cv2.imwrite(os.path.join(debug_dir, f"roi_{roi_idx}_original.png"), roi_img)
+        with tracer.span('debug_write'):
+            os.makedirs(debug_dir, exist_ok=True)
+            cv2.imwrite(os.path.join(debug_dir, f"roi_{roi_idx}_original.png"), roi_img)
         
         # 使用增强OCR函数，传入调试目录和索引
-        amount, processed_img = ocr_extract_amount(roi_img, debug_dir=debug_dir, roi_index=roi_idx)
+        with tracer.span('ocr', roi=roi_idx):
+            amount, processed_img = ocr_extract_amount(roi_img, debug_dir=debug_dir, roi_index=roi_idx)
         
         # 编码处理后的图像
-        _, buffer = cv2.imencode('.png', processed_img)
-        roi_base64 = base64.b64encode(buffer).decode('utf-8')
+        with tracer.span('encode'):
+            _, buffer = cv2.imencode('.png', processed_img)
+            roi_base64 = base64.b64encode(buffer).decode('utf-8')
         
         roi_results.append({
             "amount": amount,
@@ -279,8 +375,9 @@ def screenshot_extract_amount(rois, ld_index):
         else:
             logging.warning(f"ROI {roi_idx} 未能识别到金额")
     
-    _, full_buffer = cv2.imencode('.png', screenshot_cv)
-    full_b64 = base64.b64encode(full_buffer).decode('utf-8')
+    with tracer.span('encode'):
+        _, full_buffer = cv2.imencode('.png', screenshot_cv)
+        full_b64 = base64.b64encode(full_buffer).decode('utf-8')
     
     result = {
         "full_screenshot": full_b64,
@@ -289,10 +386,11 @@ def screenshot_extract_amount(rois, ld_index):
     logging.info("截屏处理完成。")
     return result
 
-def find_ldplayer_windows(title_keyword="O-"):
+def find_ldplayer_windows(title_keyword="O-", verbose=True):
     """
     查找所有标题中包含 title_keyword 的 LDPlayer 窗口，
     并按窗口标题按字母顺序排序后返回。
+    verbose 为 False 时不打印窗口列表（用于心跳中统计窗口数）
     """
     def enum_handler(hwnd, result_list):
         if win32gui.IsWindowVisible(hwnd):
@@ -302,7 +400,8 @@ def find_ldplayer_windows(title_keyword="O-"):
     windows = []
     win32gui.EnumWindows(enum_handler, windows)
     sorted_windows = sorted(windows, key=lambda x: x[1])
-    print(sorted_windows)
+    if verbose:
+        print(sorted_windows)
     return sorted_windows
 
 def activate_window(hwnd):
@@ -335,37 +434,68 @@ def press_f11():
     time.sleep(0.1)
     win32api.keybd_event(0x7A, 0, win32con.KEYEVENTF_KEYUP, 0)  # F11 key up
 
+def capture_ldplayer_window(hwnd):
+    """
+    激活窗口、F11 最大化、截屏后取消最大化，返回截图
+    需在输入队列上独占执行，期间其他按键不会改变焦点
+    """
+    with tracer.span('activate'):
+        activate_window(hwnd)
+    with tracer.span('f11_wait'):
+        time.sleep(1)
+        press_f11()
+    try:
+        logging.info("开始截屏...")
+        with tracer.span('screenshot'):
+            return pyautogui.screenshot()
+    finally:
+        with tracer.span('f11_wait'):
+            time.sleep(1)
+            press_f11()  # 取消最大化状态
+
 # 定义路由
 
 @app.route('/run', methods=['POST'])
 def run_script():
     """
-    从请求中获取按键参数，并触发按键模拟
+    从请求中获取按键参数（或按键序列），并触发按键模拟
     返回确认信息，确保主服务器知道指令已接收并执行
     """
     data = request.get_json() or {}
-    key = data.get("key", "f7")
     
     try:
         # 验证按键参数
-        if not key or not isinstance(key, str):
+        try:
+            command = parse_command(data)
+        except SequenceError as e:
             return jsonify({
                 "status": "error",
-                "message": "Invalid key parameter",
+                "message": str(e),
                 "timestamp": time.time()
             }), 400
         
-        # 执行按键
-        simulate_keypress(key)
+        # 执行按键或按键序列
+        with tracer.span('input'):
+            ack = execute_command(command)
         
         # 返回确认信息
         return jsonify({
             "status": "success",
-            "message": f"Key '{key}' pressed successfully",
+            **ack,
             "timestamp": time.time(),
-            "pc_name": get_pc_name(),
-            "ip": get_client_ip()
+            "pc_name": client_identity.pc_name,
+            "ip": client_identity.ip
         }), 200
+    except InputTimeout as e:
+        # 已开始执行时结果未知，主服务器不应重发
+        logging.error(f"执行按键超时: {e}")
+        return jsonify({
+            "status": "error",
+            "message": str(e),
+            "outcome_unknown": e.outcome_unknown,
+            "timestamp": time.time(),
+            "pc_name": client_identity.pc_name
+        }), 504
     except Exception as e:
         logging.error(f"执行按键失败: {str(e)}", exc_info=True)
         return jsonify({
@@ -375,6 +505,98 @@ def run_script():
             "pc_name": get_pc_name()
         }), 500
 
+# ==================== 中继转发 ====================
+
+# 是否允许主服务器把本机选为中继（RELAY_ENABLED=0 可关闭）
+RELAY_ENABLED = os.environ.get('RELAY_ENABLED', '1') != '0'
+# 中继向子树转发时的最大并发数
+RELAY_CONCURRENCY = 100
+
+async def _relay_send_leaf(session, ip, command, semaphore, via, headers=None):
+    """中继向单个客户端转发指令（只尝试一次，失败由上游记录）"""
+    async with semaphore:
+        try:
+            async with session.post(f'http://{ip}:5000/run', json=command, headers=headers,
+                                    timeout=ClientTimeout(total=5 + command_duration(command), connect=2)) as resp:
+                text = await resp.text()
+                if resp.status == 200:
+                    return {"ip": ip, "status": "success", "response": text, "attempt": 1, "via": via}
+                return {"ip": ip, "status": "error", "message": f"HTTP {resp.status}", "attempt": 1, "via": via}
+        except asyncio.TimeoutError:
+            return {"ip": ip, "status": "error", "message": "Request timed out", "attempt": 1, "via": via}
+        except Exception as e:
+            return {"ip": ip, "status": "error", "message": str(e), "attempt": 1, "via": via}
+
+def _execute_local_command(command, hop):
+    """中继自身作为目标执行指令，返回与子节点一致的结果格式"""
+    start = time.time()
+    try:
+        with tracer.span('input'):
+            ack = execute_command(command)
+        return {"ip": client_identity.ip, "status": "success", "response": ack,
+                "attempt": 1, "hop": hop, "latency": round(time.time() - start, 4)}
+    except Exception as e:
+        return {"ip": client_identity.ip, "status": "error", "message": str(e),
+                "attempt": 1, "hop": hop, "latency": round(time.time() - start, 4)}
+
+async def _relay_async(command, children, hop):
+    """本地执行与子树转发并发进行"""
+    via = client_identity.ip
+    semaphore = asyncio.Semaphore(RELAY_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=RELAY_CONCURRENCY, force_close=False)
+    # 把追踪 ID 继续传给子树
+    trace = tracer.current()
+    headers = {TRACE_HEADER: trace.trace_id} if trace is not None else None
+
+    async def send_leaf(session, ip, cmd):
+        return await _relay_send_leaf(session, ip, cmd, semaphore, via, headers)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        local_task = asyncio.ensure_future(asyncio.to_thread(tracer.bind(_execute_local_command), command, hop))
+        results, relay_stats = await relay_fan_out(session, children, command, send_leaf, hop=hop + 1,
+                                                   extra_timeout=command_duration(command), headers=headers)
+        local_result = await local_task
+    return [local_result] + results, relay_stats
+
+@app.route('/relay', methods=['POST'])
+def relay_command():
+    """
+    中继转发接口：本机执行指令，同时把指令转发给主服务器分配的子树，
+    汇总所有客户端的确认结果后一次性返回，并附带每一跳的耗时
+    """
+    if not RELAY_ENABLED:
+        return jsonify({"status": "error", "message": "Relay disabled on this client"}), 403
+    
+    data = request.get_json() or {}
+    children = data.get("children") or []
+    try:
+        hop = int(data.get("hop", 1))
+    except (TypeError, ValueError):
+        hop = 1
+    
+    if not isinstance(data.get("command"), dict) or not isinstance(children, list):
+        return jsonify({"status": "error", "message": "Invalid relay payload"}), 400
+    try:
+        command = parse_command(data["command"])
+    except SequenceError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    
+    start = time.time()
+    try:
+        results, relay_stats = asyncio.run(_relay_async(command, children, hop))
+    except Exception as e:
+        logging.error(f"中继转发失败: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+    
+    return jsonify({
+        "status": "success",
+        "ip": client_identity.ip,
+        "hop": hop,
+        "elapsed": round(time.time() - start, 4),
+        "results": results,
+        "relay_stats": relay_stats
+    }), 200
+
 @app.route('/test', methods=['GET'])
 def test_connection():
     """
@@ -390,8 +612,10 @@ def health_check():
     health_status = {
         'status': 'healthy',
         'timestamp': time.time(),
-        'pc_name': get_pc_name(),
-        'ip': get_client_ip()
+        'pc_name': client_identity.pc_name,
+        'ip': client_identity.ip,
+        'input': input_controller.get_stats(),
+        'logging': {**log_queue_handler.get_stats(), 'ocr_rate_limit': ocr_log_limiter.get_stats()}
     }
     
     if PERFORMANCE_MONITORING:
@@ -400,6 +624,71 @@ def health_check():
     
     return jsonify(health_status), 200
 
+# Prometheus 指标：请求统计、OCR 各阶段耗时与输入队列状态
+metrics = add_process_metrics(MetricsExporter('client', monitor))
+metrics.gauge('input_queue_depth', 'Commands waiting in the input queue',
+              lambda: input_controller.get_stats()['queue_depth'])
+metrics.gauge('input_queue_max_depth', 'Largest input queue depth seen',
+              lambda: input_controller.get_stats()['max_queue_depth'])
+metrics.counter('log_records', 'Log records by outcome (dropped: queue full, rate_limited: OCR combination lines)',
+                lambda: [({'outcome': 'enqueued'}, log_queue_handler.get_stats()['enqueued']),
+                         ({'outcome': 'dropped'}, log_queue_handler.get_stats()['dropped']),
+                         ({'outcome': 'rate_limited'}, ocr_log_limiter.get_stats()['suppressed'])])
+metrics.counter('input_commands', 'Input queue tasks by result',
+                lambda: [({'result': 'executed'}, input_controller.get_stats()['executed']),
+                         ({'result': 'failed'}, input_controller.get_stats()['failed'])])
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus 文本格式指标
+    """
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """
+    采样分析所有线程的调用栈（需设置 DEBUG_TOKEN），见 stack_profiler
+    """
+    result, status = profile_request(request.args, request.headers)
+    if isinstance(result, str):
+        return Response(result, mimetype='text/plain'), status
+    return jsonify(result), status
+
+@app.route('/debug/slow_requests', methods=['GET'])
+def get_slow_requests():
+    """
+    查询最近的慢请求（耗时超过所在路由的阈值，见 slow_requests）
+    参数: endpoint（如 "POST /run_extract_amount"）、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": slow_log.get_stats(),
+        "requests": slow_log.query(request.args.get('endpoint'), min_ms, limit)
+    })
+
+@app.route('/traces', methods=['GET'])
+def get_traces():
+    """
+    查询最近的分阶段追踪
+    参数: endpoint（如 /run_extract_amount）、trace_id、min_ms（最小耗时）、limit
+    """
+    try:
+        min_ms = float(request.args['min_ms']) if request.args.get('min_ms') else None
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        return jsonify({"status": "error", "message": "min_ms and limit must be numbers"}), 400
+    return jsonify({
+        "status": "success",
+        "stats": tracer.get_stats(),
+        "traces": tracer.query(request.args.get('endpoint'), request.args.get('trace_id'), min_ms, limit)
+    })
+
 @app.route('/run_extract_amount', methods=['POST'])
 def run_extract_amount():
     """
@@ -419,7 +708,8 @@ def run_extract_amount():
         }), 400
     
     try:
-        ldplayer_windows = find_ldplayer_windows("O-")
+        with tracer.span('find_windows'):
+            ldplayer_windows = find_ldplayer_windows("O-")
         
         if not ldplayer_windows:
             return jsonify({
@@ -431,13 +721,12 @@ def run_extract_amount():
 
         for idx, (hwnd, title) in enumerate(ldplayer_windows, start=1):
             try:
-                activate_window(hwnd)
-                time.sleep(1)
-                press_f11()
+                # 窗口切换与截屏在输入队列上独占执行，OCR 在队列外进行，不阻塞其他按键
+                # capture 包含排队等待时间，激活、F11 与截屏各阶段在输入线程中记为其子阶段
+                with tracer.span('capture', window=idx):
+                    screenshot = input_controller.run_exclusive(tracer.bind(capture_ldplayer_window), hwnd)
                 # 调用时传入当前窗口的序号，用以命名截图
-                roi_results = screenshot_extract_amount(rois, idx)
-                time.sleep(1)
-                press_f11()  # 取消最大化状态
+                roi_results = screenshot_extract_amount(rois, idx, screenshot=screenshot)
 
                 screenshots_data.append({
                     "iteration": idx,
@@ -455,7 +744,8 @@ def run_extract_amount():
                     "roi_results": []
                 })
 
-        return jsonify({"status": "ok", "screenshots": screenshots_data})
+        return jsonify({"status": "ok", "screenshots": screenshots_data,
+                        "timings": request.trace.breakdown()})
     except Exception as e:
         logging.error(f"/run_extract_amount 处理失败: {str(e)}", exc_info=True)
         return jsonify({
@@ -470,15 +760,28 @@ def capture():
     供前端预览截图使用。
     """
     try:
-        screenshot = pyautogui.screenshot()
-        screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-        _, buffer = cv2.imencode('.png', screenshot_cv)
-        img_base64 = base64.b64encode(buffer).decode('utf-8')
+        with tracer.span('screenshot'):
+            screenshot = pyautogui.screenshot()
+        with tracer.span('convert'):
+            screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
+        with tracer.span('encode'):
+            _, buffer = cv2.imencode('.png', screenshot_cv)
+            img_base64 = base64.b64encode(buffer).decode('utf-8')
         return jsonify({'image': img_base64})
     except Exception as e:
         logging.error("/capture 截屏失败: %s", str(e), exc_info=True)
         return jsonify({'error': f'截屏失败: {str(e)}'}), 500
 
+# 客户端标签（逗号分隔），注册时上报给主服务器，用于按分组下发指令，例如 CLIENT_TAGS=room1,floor2
+CLIENT_TAGS = [t.strip() for t in os.environ.get('CLIENT_TAGS', '').split(',') if t.strip()]
+
+def count_ldplayer_windows():
+    """统计当前 LDPlayer 窗口数量，失败时返回 None"""
+    try:
+        return len(find_ldplayer_windows("O-", verbose=False))
+    except Exception:
+        return None
+
 # 创建全局Session用于连接池复用，减少连接开销
 heartbeat_session = requests.Session()
 heartbeat_session.headers.update({
@@ -486,15 +789,112 @@ heartbeat_session.headers.update({
     'Keep-Alive': 'timeout=30, max=100'
 })
 
+# 主服务器地址
+MASTER_HOST = "192.168.0.254"
+MASTER_URL = f"http://{MASTER_HOST}:5000"
+
+class ClientIdentity:
+    """
+    本机网络身份缓存
+    IP 与 PC 名称只在启动、网络接口变化或超过 refresh_interval 秒时重新获取；
+    每次检查只做一次 UDP connect 探测（到主服务器的出口地址），不调用 gethostbyname_ex
+    """
+
+    def __init__(self, master_host=MASTER_HOST, refresh_interval=300):
+        self.client_id = f"{uuid.getnode():012x}"  # 基于网卡 MAC 的稳定客户端ID
+        self.master_host = master_host
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self._ip = None
+        self._pc_name = None
+        self._probe_ip = None
+        self._refreshed_at = 0
+
+    def _refresh(self):
+        self._ip = get_client_ip()
+        self._pc_name = get_pc_name()
+        self._probe_ip = probe_local_ip(self.master_host)
+        self._refreshed_at = time.time()
+
+    def check(self):
+        """
+        检测网络身份是否变化
+        返回:
+            (ip, pc_name, changed)
+        """
+        with self.lock:
+            old = (self._ip, self._pc_name)
+            if (self._ip is None
+                    or probe_local_ip(self.master_host) != self._probe_ip
+                    or time.time() - self._refreshed_at > self.refresh_interval):
+                self._refresh()
+            return self._ip, self._pc_name, (self._ip, self._pc_name) != old
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self.check()
+        return self._ip
+
+    @property
+    def pc_name(self):
+        if self._pc_name is None:
+            self.check()
+        return self._pc_name
+
+client_identity = ClientIdentity()
+
+# 窗口数统计需要枚举所有窗口，签到时按该间隔（秒）刷新
+WINDOW_COUNT_REFRESH = 30
+# 使用 UDP 心跳时，每隔多少次心跳仍发送一次 HTTP 签到（确认会话、发现主服务器重启）
+HTTP_CHECKIN_EVERY = 20
+
+try:
+    import psutil
+    psutil.cpu_percent(interval=None)  # 第一次调用只建立基准
+except ImportError:
+    psutil = None
+
+def _load_metrics():
+    """返回 (cpu%, 内存%)，psutil 不可用时为 None（非阻塞）"""
+    if psutil is None:
+        return None, None
+    try:
+        return psutil.cpu_percent(interval=None), psutil.virtual_memory().percent
+    except Exception:
+        return None, None
+
+def _legacy_register(info):
+    """旧版主服务器没有 /api/checkin 时：分别注册与发送心跳"""
+    response = heartbeat_session.post(f"{MASTER_URL}/api/ips", json=info, timeout=2)
+    if response.status_code == 200:
+        try:
+            heartbeat_session.post(f"{MASTER_URL}/api/heartbeat",
+                                   json={"ip": info["ip"], "pc_name": info["pc_name"]}, timeout=1)
+        except:
+            pass  # 心跳失败不影响主流程
+    return response
+
+def _delay_until_slot(interval, offset, now=None):
+    """距离下一个满足 (时间 mod interval) == offset 的时刻还有多少秒"""
+    delay = (offset - (now or time.time())) % interval
+    return delay if delay > 0.05 else delay + interval
+
 def periodic_send_ip():
     """
     智能心跳机制：错峰发送 + 连接池复用 + 动态间隔调整
     1. 根据IP地址计算偏移时间，避免所有客户端同时发送
     2. 使用连接池复用TCP连接，减少连接建立时间
     3. 根据服务器响应时间动态调整心跳间隔
+    4. 注册与心跳合并为一次 /api/checkin：平时只发送客户端ID与序号，
+       首次签到、信息变化或服务器要求时才携带完整注册信息
+    5. 主服务器开启 UDP 心跳时，平时改发固定格式的 UDP 数据报，HTTP 签到降为定期确认与后备
+    6. 签到响应带有推荐间隔与时间槽偏移时按主服务器的安排发送，不再本地调整间隔
+    7. 主服务器在签到响应中给出 metrics_interval 时，每隔该秒数在签到中附带一次本机指标
+       （请求/OCR 阶段耗时直方图与 CPU/内存），到期时即使使用 UDP 心跳也改走一次 HTTP 签到
     """
     # 计算错峰偏移：根据IP地址最后一段计算0-4秒的偏移
-    client_ip = get_client_ip()
+    client_ip = client_identity.ip
     if client_ip:
         try:
             ip_last_octet = int(client_ip.split('.')[-1])
@@ -512,31 +912,90 @@ def periodic_send_ip():
     
     consecutive_success = 0
     consecutive_failures = 0
+
+    seq = 0
+    sent_info = None        # 服务器已确认的注册信息
+    legacy_master = False   # 主服务器不支持 /api/checkin
+    window_count = None
+    window_count_at = 0
+    udp_port = None         # 主服务器在签到响应中告知的 UDP 心跳端口
+    udp_seq = 0
+    beats_since_checkin = 0
+    server_interval = None  # 主服务器推荐的心跳间隔与时间槽偏移
+    server_offset = 0
+    metrics_interval = None # 主服务器要求的指标上报间隔，为空时不上报
+    metrics_sent_at = 0
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     
     while True:
-        client_ip = get_client_ip()
-        pc_name = get_pc_name()
+        client_ip, pc_name, changed = client_identity.check()
+        if changed and client_ip:
+            print(f"本机网络身份: {client_ip} - {pc_name}")
         
         if client_ip:
             try:
+                if time.time() - window_count_at > WINDOW_COUNT_REFRESH:
+                    window_count = count_ldplayer_windows()
+                    window_count_at = time.time()
+                info = {"ip": client_ip, "pc_name": pc_name, "window_count": window_count,
+                        "relay": RELAY_ENABLED}
+                if CLIENT_TAGS:
+                    info["tags"] = CLIENT_TAGS
+
+                metrics_due = (metrics_interval and PERFORMANCE_MONITORING
+                               and time.time() - metrics_sent_at >= metrics_interval)
+
+                # 信息未变化且主服务器支持 UDP：发送 UDP 心跳，定期再走一次 HTTP 签到
+                if (udp_port and info == sent_info and not legacy_master and not metrics_due
+                        and beats_since_checkin < HTTP_CHECKIN_EVERY):
+                    try:
+                        udp_seq += 1
+                        cpu, mem = _load_metrics()
+                        udp_sock.sendto(encode_heartbeat(client_ip, pc_name, udp_seq, cpu, mem, window_count),
+                                        (MASTER_HOST, udp_port))
+                        beats_since_checkin += 1
+                        time.sleep(_delay_until_slot(server_interval, server_offset)
+                                   if server_interval else current_interval)
+                        continue
+                    except OSError as e:
+                        print(f"UDP 心跳发送失败，改用 HTTP: {e}")
+                        udp_port = None
+
                 start_time = time.time()
-                
-                # 注册IP（使用连接池）
-                url = "http://192.168.0.254:5000/api/ips"
-                payload = {"ip": client_ip, "pc_name": pc_name}
-                response = heartbeat_session.post(url, json=payload, timeout=2)
+                beats_since_checkin = 0
+                if legacy_master:
+                    response = _legacy_register(info)
+                else:
+                    seq += 1
+                    payload = {"id": client_identity.client_id, "seq": seq}
+                    if info != sent_info:
+                        payload["info"] = info
+                    if metrics_due:
+                        cpu, mem = _load_metrics()
+                        payload["metrics"] = {**monitor.export(), "cpu": cpu, "mem": mem}
+                    response = heartbeat_session.post(f"{MASTER_URL}/api/checkin", json=payload, timeout=2)
+                    if response.status_code == 404:
+                        print("主服务器不支持 /api/checkin，改用 /api/ips + /api/heartbeat")
+                        legacy_master = True
+                        response = _legacy_register(info)
+                    elif response.status_code == 200:
+                        result = response.json()
+                        udp_port = result.get("udp_port")
+                        if result.get("interval"):
+                            server_interval = max(min_interval, float(result["interval"]))
+                            server_offset = float(result.get("offset") or 0)
+                        if not result.get("resend") and not result.get("stale"):
+                            metrics_interval = result.get("metrics_interval")
+                            if "metrics" in payload:
+                                metrics_sent_at = time.time()
+                        if result.get("resend"):
+                            sent_info = None  # 下次携带完整注册信息
+                        elif "info" in payload:
+                            sent_info = info
                 
                 elapsed = time.time() - start_time
                 
                 if response.status_code == 200:
-                    # 发送心跳（使用连接池）
-                    try:
-                        heartbeat_url = "http://192.168.0.254:5000/api/heartbeat"
-                        heartbeat_payload = {"ip": client_ip, "pc_name": pc_name}
-                        heartbeat_session.post(heartbeat_url, json=heartbeat_payload, timeout=1)
-                    except:
-                        pass  # 心跳失败不影响主流程
-                    
                     consecutive_success += 1
                     consecutive_failures = 0
                     
@@ -564,6 +1023,7 @@ def periodic_send_ip():
             except Exception as e:
                 consecutive_failures += 1
                 consecutive_success = 0
+                sent_info = None  # 连接失败后重新携带完整信息，防止服务器已重启
                 current_interval = min(max_interval, base_interval + offset + consecutive_failures * 0.5)
                 print("\033[91m错误:发送IP到主机失败:{} at {}.\033[0m".format(
                     e, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
@@ -574,8 +1034,11 @@ def periodic_send_ip():
             print("\033[91m错误:未找到符合条件的本机 IP at {}.\033[0m".format(
                 datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
         
-        # 使用动态调整的间隔
-        time.sleep(current_interval)
+        # 正常时按主服务器分配的时间槽发送，出错或旧版主服务器时使用本地动态调整的间隔
+        if server_interval and consecutive_failures == 0:
+            time.sleep(_delay_until_slot(server_interval, server_offset))
+        else:
+            time.sleep(current_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,167 @@
+"""
+慢请求记录模块
+耗时超过所在路由阈值的请求连同分阶段耗时、参数摘要（图片等大字段只记录长度）、处理线程
+以及视图附加的信息（如 OCR 投票过程）写入有界环形缓冲区，通过 /debug/slow_requests 查询；
+可选地由后台线程追加写入按大小轮转的 JSON Lines 文件，不在请求线程中写盘
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+# 超过该长度的字符串只记录长度（base64 图片、截图等）
+MAX_STRING = 200
+# 这些字段无论长短都只记录长度
+SIZE_ONLY_KEYS = {'image', 'img', 'screenshot', 'full_screenshot', 'data'}
+
+
+def summarize_params(value, depth=0):
+    """参数摘要：保留结构与短值，长字符串与图片字段替换为 "<N chars>" """
+    if isinstance(value, dict):
+        if depth >= 4:
+            return f'<dict {len(value)} keys>'
+        return {k: (f'<{len(v)} chars>' if k in SIZE_ONLY_KEYS and isinstance(v, (str, bytes))
+                    else summarize_params(v, depth + 1)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if depth >= 4 or len(value) > 20:
+            return f'<list {len(value)} items>'
+        return [summarize_params(v, depth + 1) for v in value]
+    if isinstance(value, (str, bytes)) and len(value) > MAX_STRING:
+        return f'<{len(value)} chars>'
+    if isinstance(value, bytes):
+        return f'<{len(value)} bytes>'
+    return value
+
+
+def parse_thresholds(text):
+    """解析 "POST /run_extract_amount=30,POST /api/send_all=10" 形式的路由阈值（秒）"""
+    thresholds = {}
+    for item in (text or '').split(','):
+        endpoint, _, seconds = item.rpartition('=')
+        if endpoint.strip() and seconds.strip():
+            thresholds[endpoint.strip()] = float(seconds)
+    return thresholds
+
+
+class SlowRequestLog:
+    """
+    慢请求环形缓冲区
+    参数:
+        default_threshold: 未单独配置的路由的阈值（秒）
+        thresholds: 路由（"方法 路由模板"，与性能统计的键相同）-> 阈值（秒）
+        max_entries: 缓冲区保留的记录数
+        spill_path: 追加写入的文件路径，为空时不写盘
+        max_bytes / backup_count: 文件轮转参数
+    """
+
+    def __init__(self, default_threshold=5.0, thresholds=None, max_entries=200,
+                 spill_path=None, max_bytes=5 * 1024 * 1024, backup_count=3):
+        self.default_threshold = default_threshold
+        self.thresholds = dict(thresholds or {})
+        self.lock = threading.Lock()
+        self._entries = deque(maxlen=max_entries)
+        self.spill_path = spill_path
+        self._spill_queue = None
+        self._spill_handler = None
+        self.stats = {'recorded': 0, 'spilled': 0, 'spill_dropped': 0}
+        if spill_path:
+            os.makedirs(os.path.dirname(spill_path) or '.', exist_ok=True)
+            self._spill_handler = logging.handlers.RotatingFileHandler(
+                spill_path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            self._spill_queue = queue.Queue(maxsize=1000)
+            threading.Thread(target=self._spill_loop, name="slow-request-spill", daemon=True).start()
+
+    @classmethod
+    def from_env(cls, service):
+        """
+        按环境变量创建：SLOW_REQUEST_SECONDS（默认阈值）、SLOW_REQUEST_THRESHOLDS（路由阈值），
+        SLOW_REQUEST_SPILL=1 时写入 SLOW_REQUEST_DIR（默认 logs）下的 slow_<service>.jsonl
+        """
+        spill_path = None
+        if os.environ.get('SLOW_REQUEST_SPILL') == '1':
+            spill_path = os.path.join(os.environ.get('SLOW_REQUEST_DIR', 'logs'), f'slow_{service}.jsonl')
+        return cls(default_threshold=float(os.environ.get('SLOW_REQUEST_SECONDS', '5')),
+                   thresholds=parse_thresholds(os.environ.get('SLOW_REQUEST_THRESHOLDS')),
+                   spill_path=spill_path)
+
+    def threshold(self, endpoint):
+        return self.thresholds.get(endpoint, self.default_threshold)
+
+    def observe(self, endpoint, seconds, status, request=None, trace=None, extra=None):
+        """
+        请求结束时调用；未超过阈值时立即返回
+        request 为 Flask 请求对象（只在超过阈值时读取参数），trace 为该请求的 tracing.Trace，
+        extra 为视图附加的信息（如 OCR 投票过程）
+        返回:
+            是否记录
+        """
+        if seconds < self.threshold(endpoint):
+            return False
+        entry = {
+            'timestamp': time.time(),
+            'endpoint': endpoint,
+            'status': status,
+            'duration_ms': round(seconds * 1000, 2),
+            'threshold_ms': round(self.threshold(endpoint) * 1000, 2),
+            'thread': threading.current_thread().name,
+        }
+        if request is not None:
+            entry['path'] = request.path
+            entry['args'] = summarize_params(request.args.to_dict())
+            entry['content_length'] = request.content_length
+            body = request.get_json(silent=True)
+            if body is not None:
+                entry['body'] = summarize_params(body)
+        if trace is not None:
+            entry['trace_id'] = trace.trace_id
+            entry['timings'] = trace.breakdown()
+            # 各 span 的属性中带有 OCR 投票等过程信息
+            entry['spans'] = trace.to_dict()['spans']
+        if extra:
+            entry['extra'] = summarize_params(extra)
+        with self.lock:
+            self._entries.append(entry)
+            self.stats['recorded'] += 1
+        if self._spill_queue is not None:
+            try:
+                self._spill_queue.put_nowait(entry)
+            except queue.Full:
+                with self.lock:
+                    self.stats['spill_dropped'] += 1
+        return True
+
+    def _spill_loop(self):
+        while True:
+            entry = self._spill_queue.get()
+            try:
+                line = json.dumps(entry, ensure_ascii=False, default=str)
+                self._spill_handler.emit(logging.makeLogRecord({'msg': line}))
+                with self.lock:
+                    self.stats['spilled'] += 1
+            except Exception as e:
+                print(f"写入慢请求记录失败: {e}")
+
+    def query(self, endpoint=None, min_ms=None, limit=50):
+        """按路由或最小耗时查询最近的慢请求，最新的在前"""
+        with self.lock:
+            entries = list(self._entries)
+        result = []
+        for entry in reversed(entries):
+            if endpoint and entry['endpoint'] != endpoint:
+                continue
+            if min_ms is not None and entry['duration_ms'] < min_ms:
+                continue
+            result.append(entry)
+            if len(result) >= limit:
+                break
+        return result
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'buffered': len(self._entries), 'capacity': self._entries.maxlen,
+                    'default_threshold': self.default_threshold, 'thresholds': self.thresholds,
+                    'spill_path': self.spill_path}
@@ -0,0 +1,276 @@
+"""
+SQLite 存储模块（可选）
+客户端注册表与心跳保存在 SQLite（WAL 模式）中：
+- 所有写入由一个后台线程批量提交，心跳按 IP 合并后每隔 flush_interval 毫秒 executemany 一次
+- 读取使用一个小的共享只读连接池（Flask 每个请求一个线程，按线程建连接会每次请求都新建连接），
+  连接复用使语句缓存生效，WAL 模式下读写互不阻塞
+- /api/ips 的分页与名称筛选、/api/client_status?source=db 直接在 SQL 中完成，无需把全部数据载入 Python
+
+通过环境变量 CLIENT_STORE=sqlite 启用（见 app_server.py）
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    ip TEXT PRIMARY KEY,
+    pc_name TEXT,
+    data TEXT NOT NULL,
+    seq INTEGER NOT NULL,  -- 注册顺序（更新记录时保持不变）
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_clients_pc_name ON clients(pc_name);
+CREATE INDEX IF NOT EXISTS idx_clients_seq ON clients(seq);
+CREATE TABLE IF NOT EXISTS heartbeats (
+    ip TEXT PRIMARY KEY,
+    pc_name TEXT,
+    last_seen REAL NOT NULL,
+    beat_count INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS idx_heartbeats_pc_name ON heartbeats(pc_name);
+CREATE INDEX IF NOT EXISTS idx_heartbeats_last_seen ON heartbeats(last_seen);
+"""
+
+# 共享只读连接的最大数量，同时进行的读取超过该数量时临时新建连接，用完关闭
+READER_POOL_SIZE = 4
+
+# 写入语句保持为常量字符串，sqlite3 会缓存其预编译结果
+SQL_UPSERT_CLIENT = """
+INSERT INTO clients (ip, pc_name, data, seq, updated_at) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(ip) DO UPDATE SET pc_name = excluded.pc_name, data = excluded.data,
+    updated_at = excluded.updated_at
+"""
+SQL_DELETE_CLIENT = "DELETE FROM clients WHERE ip = ?"
+SQL_DELETE_HEARTBEAT = "DELETE FROM heartbeats WHERE ip = ?"
+SQL_UPSERT_HEARTBEAT = """
+INSERT INTO heartbeats (ip, pc_name, last_seen, beat_count) VALUES (?, ?, ?, ?)
+ON CONFLICT(ip) DO UPDATE SET pc_name = excluded.pc_name, last_seen = excluded.last_seen,
+    beat_count = heartbeats.beat_count + excluded.beat_count
+"""
+
+
+class SQLiteStore:
+    """
+    客户端与心跳存储
+    参数:
+        path: 数据库文件路径
+        flush_interval_ms: 批量提交间隔（毫秒）
+    """
+
+    def __init__(self, path="clients.db", flush_interval_ms=200):
+        self.path = path
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.lock = threading.Lock()
+        self.registry = None
+        self._client_ops = []   # [(op, ip, entry)]，按变更顺序提交
+        self._beats = {}        # ip -> [pc_name, last_seen, beat_count]，同一 IP 的多次心跳合并
+        self._readers = queue.LifoQueue(maxsize=READER_POOL_SIZE)
+        self._seq = 0
+        self._thread = None
+        self.stats = {
+            'flushes': 0,
+            'client_rows_written': 0,
+            'heartbeat_rows_written': 0,
+            'heartbeats_received': 0,
+            'reader_connections_opened': 0,
+            'last_flush_seconds': None,
+            'last_error': None,
+        }
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+        self._writer.commit()
+        row = self._writer.execute("SELECT COALESCE(MAX(seq), 0) FROM clients").fetchone()
+        self._seq = row[0]
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """从连接池借出一个只读连接，查询结果须在 with 块内取完"""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+            conn.row_factory = sqlite3.Row
+            with self.lock:
+                self.stats['reader_connections_opened'] += 1
+        try:
+            yield conn
+        finally:
+            try:
+                self._readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    # ---------------- 写入（只进入内存队列，由后台线程提交） ----------------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sqlite-store", daemon=True)
+            self._thread.start()
+        return self
+
+    def attach(self, registry):
+        """订阅注册表变化，同步写入 clients 表（应在注册表加载完成之后调用）"""
+        self.registry = registry
+        registry.add_listener(self._on_registry_change)
+
+    def import_clients(self, entries):
+        """用给定记录整体替换 clients 表（首次启用时从 ips.json 导入）"""
+        with self.lock:
+            self._client_ops.append(('load', None, list(entries)))
+
+    def _on_registry_change(self, op, ip, entry):
+        if op == 'load':
+            # 整体替换：按当前注册表内容重写 clients 表（回调在注册表锁内，快照一致）
+            entry = self.registry.snapshot()
+        with self.lock:
+            if op == 'remove':
+                # 删除客户端时一并删除心跳记录，尚未写盘的心跳直接丢弃
+                self._beats.pop(ip, None)
+            self._client_ops.append((op, ip, entry))
+
+    def record_heartbeat(self, ip, pc_name, last_seen=None):
+        """记录一次心跳（合并后批量写入）"""
+        last_seen = last_seen or time.time()
+        with self.lock:
+            self.stats['heartbeats_received'] += 1
+            beat = self._beats.get(ip)
+            if beat is None:
+                self._beats[ip] = [pc_name, last_seen, 1]
+            else:
+                beat[0] = pc_name
+                beat[1] = max(beat[1], last_seen)
+                beat[2] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """把队列中的变更在一个事务中提交"""
+        with self.lock:
+            client_ops, self._client_ops = self._client_ops, []
+            beats, self._beats = self._beats, {}
+        if not client_ops and not beats:
+            return
+        start = time.time()
+        try:
+            with self._writer:
+                for op, ip, entry in client_ops:
+                    if op == 'put':
+                        self._seq += 1
+                        self._writer.execute(SQL_UPSERT_CLIENT, (
+                            ip, entry.get('pc_name'), json.dumps(entry, ensure_ascii=False),
+                            self._seq, start))
+                    elif op == 'remove':
+                        self._writer.execute(SQL_DELETE_CLIENT, (ip,))
+                        self._writer.execute(SQL_DELETE_HEARTBEAT, (ip,))
+                    elif op == 'load':
+                        self._writer.execute("DELETE FROM clients")
+                        rows = []
+                        for e in entry:
+                            self._seq += 1
+                            rows.append((e['ip'], e.get('pc_name'), json.dumps(e, ensure_ascii=False),
+                                         self._seq, start))
+                        self._writer.executemany(SQL_UPSERT_CLIENT, rows)
+                if beats:
+                    self._writer.executemany(SQL_UPSERT_HEARTBEAT, [
+                        (ip, beat[0], beat[1], beat[2]) for ip, beat in beats.items()
+                    ])
+            self.stats['flushes'] += 1
+            self.stats['client_rows_written'] += len(client_ops)
+            self.stats['heartbeat_rows_written'] += len(beats)
+            self.stats['last_flush_seconds'] = round(time.time() - start, 4)
+        except sqlite3.Error as e:
+            # 提交失败：放回队列等待下次重试（心跳只保留较新的时间）
+            with self.lock:
+                self._client_ops[:0] = client_ops
+                for ip, beat in beats.items():
+                    current = self._beats.get(ip)
+                    if current is None:
+                        self._beats[ip] = beat
+                    else:
+                        current[1] = max(current[1], beat[1])
+                        current[2] += beat[2]
+            self.stats['last_error'] = str(e)
+            print(f"SQLite 写入失败: {e}")
+
+    # ---------------- 读取 ----------------
+
+    def load_clients(self):
+        """按注册顺序返回所有客户端记录（启动时加载注册表）"""
+        with self._reader() as conn:
+            rows = conn.execute("SELECT data FROM clients ORDER BY seq").fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def load_heartbeats(self):
+        """返回所有心跳记录 {ip: {...}}（启动时恢复心跳表）"""
+        with self._reader() as conn:
+            rows = conn.execute("SELECT ip, pc_name, last_seen FROM heartbeats").fetchall()
+        return {row['ip']: {'ip': row['ip'], 'pc_name': row['pc_name'],
+                            'last_heartbeat': row['last_seen']} for row in rows}
+
+    def list_clients(self, limit=None, offset=0, name_prefix=None):
+        """分页查询客户端，name_prefix 按 PC 名称前缀筛选（使用 pc_name 索引）"""
+        sql = "SELECT data FROM clients"
+        params = []
+        if name_prefix:
+            sql += " WHERE pc_name >= ? AND pc_name < ?"
+            params += [name_prefix, name_prefix + '\uffff']
+        sql += " ORDER BY seq LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else int(limit), int(offset)]
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [json.loads(row['data']) for row in rows]
+
+    def client_status(self, timeout, status=None, limit=None, offset=0, now=None):
+        """
+        查询客户端在线状态，在线在前、最近心跳在前（使用 last_seen 索引）
+        参数:
+            timeout: 超过该秒数未收到心跳视为离线
+            status: 'online' / 'offline' / None（全部）
+        """
+        now = now or time.time()
+        cutoff = now - timeout
+        sql = ("SELECT ip, pc_name, last_seen, beat_count, "
+               "CASE WHEN last_seen >= ? THEN 'online' ELSE 'offline' END AS status FROM heartbeats")
+        params = [cutoff]
+        if status == 'online':
+            sql += " WHERE last_seen >= ?"
+            params.append(cutoff)
+        elif status == 'offline':
+            sql += " WHERE last_seen < ?"
+            params.append(cutoff)
+        sql += " ORDER BY last_seen DESC LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else int(limit), int(offset)]
+        with self._reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return [{
+            'ip': row['ip'],
+            'pc_name': row['pc_name'],
+            'last_heartbeat': row['last_seen'],
+            'beat_count': row['beat_count'],
+            'status': row['status'],
+            'time_since_heartbeat': round(now - row['last_seen'], 2)
+        } for row in rows]
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **self.stats,
+                'path': self.path,
+                'flush_interval_ms': int(self.flush_interval * 1000),
+                'pending_client_ops': len(self._client_ops),
+                'pending_heartbeats': len(self._beats),
+            }
@@ -0,0 +1,134 @@
+"""
+按需采样分析模块
+/debug/profile?seconds=N 在指定时间内按固定间隔读取所有线程的调用栈（sys._current_frames），
+返回折叠栈（flamegraph.pl / speedscope 可直接读取的 "线程;函数;函数 次数" 格式）与按函数汇总的前 N 项；
+不插桩、不开启 sys.setprofile，只在采样期间有开销，并在结果中报告采样本身占用的时间
+需要设置环境变量 DEBUG_TOKEN 才能使用，请求须带 X-Debug-Token 头或 token 参数
+"""
+import hmac
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN', '')
+TOKEN_HEADER = 'X-Debug-Token'
+MAX_SECONDS = 60
+
+# 同一进程同时只允许一次采样
+_profile_lock = threading.Lock()
+
+
+def _frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample_stacks(seconds, interval=0.01, top=30):
+    """
+    对除当前线程外的所有线程采样 seconds 秒
+    返回:
+        samples: 采样轮数；thread_samples: 采到的线程栈总数
+        overhead_ms / overhead_percent: 采样本身耗费的时间及其占采样时长的比例
+        collapsed: 折叠栈 -> 次数（根在前，以线程名开头）
+        top_self: 位于栈顶（正在执行）的次数最多的函数
+        top_total: 出现在栈中（含被调用函数的时间）的次数最多的函数
+    """
+    own = threading.get_ident()
+    labels = {}  # code 对象 -> 标签，避免重复格式化
+    collapsed = Counter()
+    self_counts = Counter()
+    total_counts = Counter()
+    samples = thread_samples = 0
+    overhead = 0.0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        tick = time.perf_counter()
+        if tick >= deadline:
+            break
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = _frame_label(code)
+                stack.append(label)
+                frame = frame.f_back
+            if not stack:
+                continue
+            self_counts[stack[0]] += 1
+            for label in set(stack):
+                total_counts[label] += 1
+            stack.append(names.get(ident, f'thread-{ident}'))
+            collapsed[';'.join(reversed(stack))] += 1
+            thread_samples += 1
+        samples += 1
+        spent = time.perf_counter() - tick
+        overhead += spent
+        time.sleep(max(0.0, interval - spent))
+    wall = time.perf_counter() - started
+
+    def ranked(counts):
+        return [{'function': label, 'samples': count,
+                 'percent': round(count * 100 / thread_samples, 2) if thread_samples else 0.0}
+                for label, count in counts.most_common(top)]
+
+    return {
+        'seconds': round(wall, 3),
+        'interval_ms': round(interval * 1000, 2),
+        'samples': samples,
+        'thread_samples': thread_samples,
+        'overhead_ms': round(overhead * 1000, 2),
+        'overhead_percent': round(overhead * 100 / wall, 2) if wall else 0.0,
+        'collapsed': dict(collapsed.most_common()),
+        'top_self': ranked(self_counts),
+        'top_total': ranked(total_counts),
+    }
+
+
+def _authorized(args, headers):
+    token = headers.get(TOKEN_HEADER) or args.get('token') or ''
+    return hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode())
+
+
+def profile_request(args, headers):
+    """
+    处理 /debug/profile 请求，供各服务的路由调用
+    参数（查询字符串）:
+        seconds: 采样时长，默认 5，最长 MAX_SECONDS
+        interval_ms: 采样间隔，默认 10
+        top: 汇总的函数数量，默认 30
+        format: collapsed 时只返回折叠栈文本
+    返回:
+        (结果, HTTP 状态码)；format=collapsed 时结果为文本
+    """
+    if not DEBUG_TOKEN:
+        return {"status": "error", "message": "profiling disabled (DEBUG_TOKEN not set)"}, 404
+    if not _authorized(args, headers):
+        return {"status": "error", "message": "invalid debug token"}, 403
+    try:
+        seconds = float(args.get('seconds', 5))
+        interval_ms = float(args.get('interval_ms', 10))
+        top = max(1, int(args.get('top', 30)))
+    except ValueError:
+        return {"status": "error", "message": "seconds, interval_ms and top must be numbers"}, 400
+    # nan 会穿过 min/max 的范围限制，使采样永不结束
+    if not (math.isfinite(seconds) and math.isfinite(interval_ms)):
+        return {"status": "error", "message": "seconds and interval_ms must be finite"}, 400
+    seconds = min(max(seconds, 0.1), MAX_SECONDS)
+    interval = min(max(interval_ms, 1.0), 1000.0) / 1000
+    if not _profile_lock.acquire(blocking=False):
+        return {"status": "error", "message": "a profile is already running"}, 409
+    try:
+        result = sample_stacks(seconds, interval, top)
+    finally:
+        _profile_lock.release()
+    if args.get('format') == 'collapsed':
+        return ''.join(f'{stack} {count}\n' for stack, count in result['collapsed'].items()), 200
+    return {"status": "success", **result}, 200
@@ -0,0 +1,124 @@
+"""
+系统资源采样模块
+后台线程按固定间隔采集进程 CPU、内存、线程数、打开文件数、磁盘与各核心负载，
+写入环形缓冲区；健康检查直接读取最近一次采样与历史，不在请求线程中等待 CPU 采样
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# 历史记录中保留的字段（各核心负载与磁盘只在最近一次采样中返回）
+HISTORY_FIELDS = ('timestamp', 'cpu_percent', 'system_cpu_percent', 'memory_mb', 'thread_count', 'open_files')
+
+
+class SystemSampler:
+    """
+    系统资源采样器
+    CPU 使用率使用 interval=None 的非阻塞方式，得到的是两次采样之间的平均值
+    参数:
+        interval: 采样间隔（秒）
+        history: 环形缓冲区保留的采样数
+        path: 统计磁盘用量的路径
+    """
+
+    def __init__(self, interval=5.0, history=120, path='.'):
+        self.interval = interval
+        self.path = path
+        self.lock = threading.Lock()
+        self._samples = deque(maxlen=history)
+        self._thread = None
+        self._process = psutil.Process(os.getpid()) if PSUTIL_AVAILABLE else None
+        self.stats = {'samples': 0, 'errors': 0, 'last_duration_ms': None}
+
+    def start(self):
+        """启动后台采样线程；启动时先同步采样一次，保证随后的读取总有结果"""
+        if self._thread is None and PSUTIL_AVAILABLE:
+            with self.lock:
+                if self._thread is not None:
+                    return self
+                self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+            self.sample()
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def _open_files(self):
+        process = self._process
+        # Windows 上 open_files() 较慢且可能卡住，改用句柄数
+        if sys.platform == 'win32' and hasattr(process, 'num_handles'):
+            return process.num_handles()
+        return len(process.open_files())
+
+    def sample(self):
+        """采集一次并写入缓冲区，返回本次采样"""
+        started = time.perf_counter()
+        process = self._process
+        try:
+            with process.oneshot():
+                memory_info = process.memory_info()
+                cpu_percent = process.cpu_percent(interval=None)
+                memory_percent = process.memory_percent()
+            try:
+                open_files = self._open_files()
+            except Exception:
+                open_files = None  # 权限不足等情况下只缺这一项
+            # 只调用 percpu 形式：psutil.cpu_percent() 的基准是模块级共享的，会干扰其它调用方
+            per_cpu = psutil.cpu_percent(interval=None, percpu=True)
+            disk = psutil.disk_usage(self.path)
+            snapshot = {
+                'timestamp': time.time(),
+                'cpu_percent': round(cpu_percent, 2),
+                'system_cpu_percent': round(sum(per_cpu) / len(per_cpu), 2) if per_cpu else None,
+                'per_cpu_percent': per_cpu,
+                'memory_mb': round(memory_info.rss / (1024 * 1024), 2),
+                'memory_percent': round(memory_percent, 2),
+                'thread_count': threading.active_count(),
+                'os_thread_count': process.num_threads(),
+                'open_files': open_files,
+                'disk_usage': {
+                    'total_gb': round(disk.total / (1024**3), 2),
+                    'used_gb': round(disk.used / (1024**3), 2),
+                    'free_gb': round(disk.free / (1024**3), 2),
+                    'percent': round(disk.percent, 2)
+                }
+            }
+        except Exception as e:
+            with self.lock:
+                self.stats['errors'] += 1
+            return {'error': str(e)}
+        with self.lock:
+            self._samples.append(snapshot)
+            self.stats['samples'] += 1
+            self.stats['last_duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return snapshot
+
+    def latest(self):
+        """最近一次采样，尚未采样时为 None"""
+        samples = self._samples
+        return samples[-1] if samples else None
+
+    def history(self, seconds=None):
+        """最近 seconds 秒（为空时为缓冲区全部）的采样，只含 HISTORY_FIELDS，按时间先后排列"""
+        with self.lock:
+            samples = list(self._samples)
+        if seconds is not None:
+            oldest = time.time() - seconds
+            samples = [s for s in samples if s['timestamp'] >= oldest]
+        return [{key: s[key] for key in HISTORY_FIELDS} for s in samples]
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, 'interval': self.interval, 'buffered': len(self._samples),
+                    'capacity': self._samples.maxlen}
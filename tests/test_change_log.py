@@ -0,0 +1,53 @@
+from change_log import ChangeLog
+
+
+def test_since_returns_changes_after_version():
+    log = ChangeLog()
+    for i in range(3):
+        log.append(i)
+
+    assert log.since(0) == ([0, 1, 2], 3)
+    assert log.since(2) == ([2], 3)
+    assert log.since(3) == ([], 3)
+
+
+def test_since_requires_full_sync_after_truncation():
+    log = ChangeLog(max_entries=2)
+    for i in range(5):
+        log.append(i)
+
+    assert log.since(3) == ([3, 4], 5)
+    assert log.since(2) == (None, 5)
+    assert log.since(0) == (None, 5)
+
+
+def test_since_requires_full_sync_after_reset():
+    log = ChangeLog()
+    log.append('a')
+    log.reset()
+    log.append('b')
+
+    assert log.since(1) == (None, 3)
+    assert log.since(2) == (['b'], 3)
+    # 比当前还新的版本来自别的进程
+    assert log.since(10) == (None, 3)
+
+
+def test_tokens_are_bound_to_the_process_epoch():
+    log = ChangeLog()
+    log.append('a')
+    restarted = ChangeLog()
+    restarted.append('b')
+
+    assert log.parse_token(log.token()) == 1
+    assert log.parse_token(log.token(0)) == 0
+    assert restarted.parse_token(log.token()) is None
+    for token in (None, '', '1', f'{log.epoch}:x'):
+        assert log.parse_token(token) is None
+
+
+def test_wait_returns_when_version_advances():
+    log = ChangeLog()
+    assert log.wait(0, timeout=0.01) == 0
+    log.append('a')
+    assert log.wait(0, timeout=5) == 1
@@ -0,0 +1,53 @@
+import pytest
+
+from client_selector import ClientIndex, SelectorError
+
+
+@pytest.fixture
+def index():
+    index = ClientIndex()
+    index.rebuild([
+        {'ip': '10.0.0.3', 'pc_name': 'PC-A2', 'tags': ['room1'], 'window_count': 3},
+        {'ip': '10.0.0.1', 'pc_name': 'PC-A1', 'tags': ['room1', 'vip'], 'window_count': '2'},
+        {'ip': '10.0.0.2', 'pc_name': 'pc-b1', 'tags': ['room2'], 'window_count': 0},
+        {'ip': '10.0.0.4', 'pc_name': 'Other', 'tags': [], 'window_count': None},
+    ])
+    return index
+
+
+def ips(entries):
+    return [entry['ip'] for entry in entries]
+
+
+@pytest.mark.parametrize('selector, expected', [
+    ('all', ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4']),
+    ('ip:10.0.0.2,10.0.0.9', ['10.0.0.2']),
+    ('tag:room1', ['10.0.0.1', '10.0.0.3']),
+    ('tag:room1,room2', ['10.0.0.1', '10.0.0.2', '10.0.0.3']),
+    ('name:pc-a*', ['10.0.0.1', '10.0.0.3']),
+    ('name:PC-B1', ['10.0.0.2']),
+    ('name:PC-B', []),
+    ('windows:>=2', ['10.0.0.1', '10.0.0.3']),
+    ('windows:0', ['10.0.0.2']),
+    ('tag:room1 & !tag:vip', ['10.0.0.3']),
+    ('name:PC* windows:<3', ['10.0.0.1', '10.0.0.2']),
+    ('!tag:room1', ['10.0.0.2', '10.0.0.4']),
+])
+def test_resolve(index, selector, expected):
+    assert ips(index.resolve(selector)) == expected
+
+
+@pytest.mark.parametrize('selector', ['', '   ', 'tag', 'tag:', 'color:red', 'windows:many'])
+def test_resolve_rejects_invalid(index, selector):
+    with pytest.raises(SelectorError):
+        index.resolve(selector)
+
+
+def test_index_follows_updates_and_removals(index):
+    index.add({'ip': '10.0.0.3', 'pc_name': 'Renamed', 'tags': ['room2'], 'window_count': 1})
+    index.remove('10.0.0.1')
+
+    assert ips(index.resolve('tag:room1')) == []
+    assert ips(index.resolve('tag:room2')) == ['10.0.0.2', '10.0.0.3']
+    assert ips(index.resolve('name:pc-a*')) == []
+    assert index.tag_counts() == {'room2': 2}
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from command_ledger import CommandLedger
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    # 写盘间隔设得很长，由测试显式调用 flush
+    return CommandLedger(str(tmp_path), flush_interval=3600).start()
+
+
+def test_commands_round_trip(ledger, tmp_path):
+    first = ledger.begin('job-1', {'key': 'f7'}, 2, 'direct', 'f7')
+    second = ledger.begin('trace-2', {'sequence': []}, 1, 'single', 'sequence(3 steps)')
+    ledger.flush()
+
+    assert second == first + 1
+    assert [(c['number'], c['command_id'], c['kind'], c['mode'], c['target_count'], c['command'])
+            for c in ledger.commands(hours=1)] == [
+        (second, 'trace-2', 'sequence', 'single', 1, 'sequence(3 steps)'),
+        (first, 'job-1', 'key', 'direct', 2, 'f7'),
+    ]
+    # 重新打开后序号接着上次的最大值
+    assert CommandLedger(str(tmp_path), flush_interval=3600).start().begin('job-3', {}, 1, 'relay') == second + 1
+
+
+def test_results_round_trip(ledger):
+    number = ledger.begin('job-1', {'key': 'f7'}, 3, 'relay', 'f7')
+    other = ledger.begin('job-2', {'key': 'f8'}, 1, 'direct', 'f8')
+    ledger.record_result(number, {'ip': '10.0.0.1', 'status': 'success', 'latency': 0.05})
+    ledger.record_result(number, {'ip': '10.0.0.2', 'status': 'error', 'message': 'Request timed out',
+                                  'attempt': 2, 'hop': 1, 'latency': 3.0})
+    ledger.record_result(number, {'ip': '10.0.0.3', 'status': 'error', 'message': 'Connection error: refused'})
+    ledger.record_result(other, {'ip': '10.0.0.1', 'status': 'error', 'message': 'HTTP 500'}, latency=0.2)
+    ledger.flush()
+
+    report = ledger.query(hours=1)
+    assert report['outcomes'] == {'success': 1, 'timeout': 1, 'connection_error': 1, 'http_error': 1, 'error': 0}
+    assert report['client_count'] == 3
+    clients = {c['ip']: c for c in report['by_client']}
+    assert clients['10.0.0.1']['count'] == 2
+    assert clients['10.0.0.1']['errors'] == 1
+    assert clients['10.0.0.2']['retried'] == 1
+    assert clients['10.0.0.2']['latency']['max'] == pytest.approx(3.0)
+    assert clients['10.0.0.3']['latency'] == {'count': 0}  # 未知延迟不计入分布
+    assert sum(hour['count'] for hour in report['by_hour']) == 4
+
+    assert ledger.query(hours=1, ip='10.0.0.1')['client_count'] == 1
+    assert ledger.query(hours=1, number=other)['outcomes']['http_error'] == 1
+    assert len(ledger.query(hours=1, limit=1)['by_client']) == 1
+
+
+def test_cleanup_removes_expired_segments(ledger, tmp_path):
+    ledger.begin('job-1', {'key': 'f7'}, 1, 'direct')
+    ledger.flush()
+    assert ledger.commands(hours=1)
+
+    ledger.cleanup(now=time.time() + (ledger.retention_hours + 2) * 3600)
+
+    assert ledger.commands(hours=1) == []
+    assert not list(tmp_path.iterdir())
+
+
+def test_segments_are_named_in_utc(ledger, tmp_path):
+    ledger.begin('job-1', {'key': 'f7'}, 1, 'direct')
+    ledger.flush()
+
+    (segment,) = [p.name for p in tmp_path.iterdir()]
+    assert segment == f"commands-{time.strftime('%Y%m%d%H', time.gmtime())}.bin"
+    (start, _), = ledger._segments('commands')
+    assert start == time.time() // 3600 * 3600
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'limit': -1}, {'hours': -1}, {'hours': float('nan')}, {'ip': 'not-an-ip'}, {'ip': '10.1'},
+])
+def test_query_rejects_invalid_arguments(ledger, kwargs):
+    with pytest.raises(ValueError):
+        ledger.query(**kwargs)
+
+
+def test_commands_limit_zero_returns_nothing(ledger):
+    ledger.begin('job-1', {'key': 'f7'}, 1, 'direct')
+    ledger.flush()
+    assert ledger.commands(hours=1, limit=0) == []
+    with pytest.raises(ValueError):
+        ledger.commands(hours=1, limit=-1)
@@ -0,0 +1,35 @@
+import pytest
+
+from fleet_metrics import FleetMetrics
+from performance_monitor import LatencyHistogram
+
+
+def report(requests=10, errors=0, cpu=None, mem=None, latencies=(0.01, 0.02)):
+    hist = LatencyHistogram()
+    for value in latencies:
+        hist.record(value)
+    return {'requests': requests, 'errors': errors, 'latency': hist.to_dict(), 'cpu': cpu, 'mem': mem}
+
+
+def test_non_numeric_cpu_does_not_break_rankings():
+    fleet = FleetMetrics()
+    assert fleet.update('10.0.0.1', 'PC-1', report(cpu='high', mem=[1]), now=100)
+    assert fleet.update('10.0.0.2', 'PC-2', report(cpu='42.5', mem=30), now=100)
+    assert fleet.update('10.0.0.3', 'PC-3', report(cpu=float('nan')), now=100)
+
+    summary = fleet.summary(now=101)
+
+    assert [row['ip'] for row in summary['rankings']['cpu']] == ['10.0.0.2']
+    assert summary['rankings']['cpu'][0]['cpu'] == 42.5
+    assert summary['clients_reporting'] == 3
+
+
+@pytest.mark.parametrize('buckets', [{'-1': 1}, {str(LatencyHistogram.BUCKETS): 1}, {'3': -2}, {'x': 1}])
+def test_rejects_histograms_with_invalid_buckets(buckets):
+    fleet = FleetMetrics()
+    bad = report()
+    bad['latency']['buckets'] = buckets
+
+    assert not fleet.update('10.0.0.1', 'PC-1', bad)
+    assert fleet.get_stats()['rejected'] == 1
+    assert fleet.get_stats()['clients'] == 0
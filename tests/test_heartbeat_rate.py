@@ -0,0 +1,28 @@
+import pytest
+
+from heartbeat_rate import MISSED_BEATS, HeartbeatPolicy
+
+
+def test_recommended_interval_stays_below_offline_timeout():
+    policy = HeartbeatPolicy(target_rate=100, offline_timeout=30)
+    policy.update(slowdown=2)
+
+    for fleet_size in (10, 2000, 5000, 100000):
+        assert policy.recommend(fleet_size) * MISSED_BEATS <= 30
+
+
+@pytest.mark.parametrize('fields', [
+    {'max_interval': 11}, {'min_interval': 20}, {'slowdown': 0}, {'min_interval': 'nan'},
+    {'max_interval': 5, 'min_interval': 6}, {'timeout': 60},
+])
+def test_update_rejects_invalid_values_without_partial_changes(fields):
+    policy = HeartbeatPolicy(offline_timeout=30)
+    before = policy.get_stats()
+    with pytest.raises(ValueError):
+        policy.update(target_rate=50, **fields)
+    assert policy.get_stats()['target_rate'] == before['target_rate']
+
+
+def test_constructor_rejects_interval_above_limit():
+    with pytest.raises(ValueError):
+        HeartbeatPolicy(max_interval=60, offline_timeout=30)
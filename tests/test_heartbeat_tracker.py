@@ -0,0 +1,35 @@
+from client_registry import ClientRegistry
+from heartbeat_tracker import HeartbeatTracker
+from sqlite_store import SQLiteStore
+
+
+def test_remove_drops_client_and_emits_event():
+    tracker = HeartbeatTracker(timeout=30)
+    for ip in ('10.0.0.1', '10.0.0.2'):
+        tracker.beat(ip, f'PC-{ip}')
+    cursor = tracker.events_since()['cursor']
+
+    tracker.remove('10.0.0.1')
+    tracker.remove('10.0.0.9')  # 不存在的客户端：不产生事件
+
+    assert [e['ip'] for e in tracker.status_list()] == ['10.0.0.2']
+    assert tracker.counts() == {'online': 1, 'offline': 0, 'total': 1}
+    assert [(e['ip'], e['status']) for e in tracker.events_since(cursor)['events']] == [('10.0.0.1', 'removed')]
+
+
+def test_store_deletes_heartbeat_row_with_client(tmp_path):
+    registry = ClientRegistry()
+    store = SQLiteStore(str(tmp_path / 'clients.db'))
+    store.attach(registry)
+    for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+        registry.upsert(ip, f'PC-{ip}')
+        store.record_heartbeat(ip, f'PC-{ip}')
+    store.flush()
+
+    registry.remove('10.0.0.1')
+    store.record_heartbeat('10.0.0.3', 'PC-10.0.0.3')
+    registry.remove('10.0.0.3')  # 尚未写盘的心跳一并丢弃
+    store.flush()
+
+    assert list(store.load_heartbeats()) == ['10.0.0.2']
+    assert [e['ip'] for e in store.load_clients()] == ['10.0.0.2']
@@ -0,0 +1,150 @@
+import threading
+
+import pytest
+
+from input_control import (
+    MAX_REPEAT, MAX_STEPS, PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL,
+    InputController, InputTimeout, RecordingBackend, SequenceError, Win32Backend, parse_command,
+)
+
+
+@pytest.mark.parametrize('data', [
+    {'key': ''},
+    {'key': 5},
+    {'sequence': []},
+    {'sequence': 'f7'},
+    {'sequence': [5]},
+    {'sequence': [{'delay': 0.1}]},
+    {'sequence': [{'key': 'f7', 'delay': -1}]},
+    {'sequence': [{'key': 'f7', 'delay': 'soon'}]},
+    {'sequence': [{'key': 'f7', 'delay': float('nan')}]},
+    {'sequence': [{'key': 'f7', 'hold': float('inf')}]},
+    {'sequence': [{'key': 'f7', 'interval': 'nan'}]},
+    {'sequence': [{'key': 'f7', 'repeat': 0}]},
+    {'sequence': [{'key': 'f7', 'repeat': MAX_REPEAT + 1}]},
+    {'sequence': [{'key': 'f7', 'repeat': 'twice'}]},
+    {'sequence': ['f7'] * (MAX_STEPS + 1)},
+    {'sequence': [{'key': 'f7', 'delay': 59}, {'key': 'f8', 'delay': 2}]},
+])
+def test_parse_command_rejects_invalid(data):
+    with pytest.raises(SequenceError):
+        parse_command(data)
+
+
+def test_parse_command_normalizes_steps():
+    assert parse_command({}) == {'key': 'f7'}
+    assert parse_command({'sequence': ['enter', {'key': 'f7', 'delay': '0.5', 'repeat': 2}]}) == {'sequence': [
+        {'key': 'enter', 'delay': 0.0, 'hold': 0.0, 'repeat': 1, 'interval': 0.0},
+        {'key': 'f7', 'delay': 0.5, 'hold': 0.0, 'repeat': 2, 'interval': 0.0},
+    ]}
+
+
+def test_input_queue_runs_by_priority_then_fifo():
+    backend = RecordingBackend()
+    controller = InputController(backend)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    # 先占住输入线程，让后面的任务都在队列中排队
+    controller.queue.submit(block, priority=PRIORITY_HIGH)
+    assert started.wait(5)
+    futures = [controller.queue.submit(backend.press, key, priority=priority) for key, priority in [
+        ('low', PRIORITY_LOW), ('normal-1', PRIORITY_NORMAL), ('high-1', PRIORITY_HIGH),
+        ('normal-2', PRIORITY_NORMAL), ('high-2', PRIORITY_HIGH),
+    ]]
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+
+    assert [key for _, key, _ in backend.events] == ['high-1', 'high-2', 'normal-1', 'normal-2', 'low']
+    assert controller.get_stats()['executed'] == 6
+
+
+def test_input_controller_runs_sequence_and_reports_failures():
+    backend = RecordingBackend()
+    controller = InputController(backend)
+    steps = parse_command({'sequence': [{'key': 'a', 'repeat': 2}, {'key': 'b', 'hold': 0.001}]})['sequence']
+
+    timings = controller.run_sequence(steps, timeout=5)
+
+    assert [(action, key) for action, key, _ in backend.events] == [
+        ('press', 'a'), ('press', 'a'), ('down', 'b'), ('up', 'b')]
+    assert [t['key'] for t in timings] == ['a', 'b']
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        controller.run_exclusive(fail, timeout=5)
+    assert controller.get_stats()['failed'] == 1
+
+
+def test_run_timeout_cancels_queued_task_and_reports_started_one():
+    backend = RecordingBackend()
+    controller = InputController(backend)
+    started, release = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    # 正在执行的任务超时：结果未知
+    with pytest.raises(InputTimeout) as running:
+        controller.queue.run(block, timeout=0.05)
+    assert running.value.outcome_unknown
+    assert started.is_set()
+
+    # 排队中的任务超时：被取消，之后不会再执行
+    with pytest.raises(InputTimeout) as queued:
+        controller.press('f7', timeout=0.05)
+    assert not queued.value.outcome_unknown
+    release.set()
+    controller.queue.run(lambda: None, timeout=5)
+    assert backend.events == []
+    assert controller.get_stats()['cancelled'] == 1
+
+
+class FakeWin32Api:
+    """按 US 键盘布局返回 VkKeyScan 结果，并记录 keybd_event 调用"""
+
+    SCANS = {'a': 0x041, 'A': 0x141, '1': 0x031, '!': 0x131, '@': 0x632}
+
+    def __init__(self):
+        self.events = []
+
+    def VkKeyScan(self, char):
+        return self.SCANS.get(char, -1)
+
+    def keybd_event(self, vk, scan, flags, extra):
+        self.events.append(('up' if flags else 'down', vk))
+
+
+def win32_backend():
+    backend = Win32Backend.__new__(Win32Backend)
+    backend._win32api = FakeWin32Api()
+    backend._keyup_flag = 2
+    backend._fallback = None
+    return backend
+
+
+@pytest.mark.parametrize('key, expected', [
+    ('a', [('down', 0x41), ('up', 0x41)]),
+    ('A', [('down', 0x10), ('down', 0x41), ('up', 0x41), ('up', 0x10)]),
+    ('!', [('down', 0x10), ('down', 0x31), ('up', 0x31), ('up', 0x10)]),
+    ('@', [('down', 0x11), ('down', 0x12), ('down', 0x32), ('up', 0x32), ('up', 0x12), ('up', 0x11)]),
+    ('F7', [('down', 0x76), ('up', 0x76)]),
+])
+def test_win32_backend_applies_shift_state(key, expected):
+    backend = win32_backend()
+    backend.press(key)
+    assert backend._win32api.events == expected
+
+
+def test_win32_backend_hold_keeps_modifiers_down():
+    backend = win32_backend()
+    backend.key_down('A')
+    backend.key_up('A')
+    assert backend._win32api.events == [('down', 0x10), ('down', 0x41), ('up', 0x41), ('up', 0x10)]
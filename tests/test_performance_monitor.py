@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from performance_monitor import LatencyHistogram
+
+# 子桶中点相对真实值的最大误差
+RELATIVE_ERROR = 1 / (2 * LatencyHistogram.SUB_BUCKETS)
+
+
+def histogram(values):
+    hist = LatencyHistogram()
+    for value in values:
+        hist.record(value)
+    return hist
+
+
+def test_percentile_within_bucket_error():
+    values = [i / 1000 for i in range(1, 1001)]  # 1ms ~ 1s
+    hist = histogram(values)
+
+    for q in (50, 90, 99):
+        expected = values[int(len(values) * q / 100) - 1]
+        assert hist.percentile(q) == pytest.approx(expected, rel=RELATIVE_ERROR)
+    assert hist.summary()['count'] == 1000
+
+
+def test_percentile_is_clamped_to_observed_range():
+    hist = histogram([0.123])
+    assert hist.percentile(1) == 0.123
+    assert hist.percentile(99.9) == 0.123
+    assert LatencyHistogram().percentile(50) is None
+
+
+def test_out_of_range_values_land_in_edge_buckets():
+    hist = histogram([0.0, 1e-9, 10_000.0])
+    assert hist.counts[0] == 2
+    assert hist.counts[-1] == 1
+
+
+def test_merge_equals_recording_everything_once():
+    rng = random.Random(1)
+    first = [rng.expovariate(20) for _ in range(500)]
+    second = [rng.expovariate(5) for _ in range(300)]
+
+    merged = histogram(first).merge(histogram(second))
+    combined = histogram(first + second)
+
+    assert merged.counts == combined.counts
+    assert merged.count == 800
+    assert merged.total == pytest.approx(combined.total)
+    assert (merged.min, merged.max) == (combined.min, combined.max)
+    assert merged.percentile(99) == combined.percentile(99)
+    assert histogram(first).merge(LatencyHistogram()).counts == histogram(first).counts
+
+
+def test_subtract_returns_the_interval_distribution():
+    earlier = histogram([0.01, 0.02])
+    later = histogram([0.01, 0.02]).merge(histogram([0.5]))
+
+    delta = later.subtract(earlier)
+
+    assert delta.count == 1
+    assert delta.counts == histogram([0.5]).counts
+
+
+def test_cumulative_counts_below_bounds():
+    hist = histogram([0.1, 0.3, 0.6, 3.0])
+    assert hist.cumulative([0.25, 0.5, 1.0, 2.0]) == [1, 2, 3, 3]
+
+
+def test_cumulative_includes_values_equal_to_bound():
+    # Prometheus 的 le 为 <=：恰好等于上界的值计入该上界
+    hist = histogram([0.25, 0.5, 0.75, 1.0, 512.0])
+    assert hist.cumulative([0.25, 0.5, 1.0, 512.0]) == [1, 2, 4, 5]
+    lower, upper = LatencyHistogram.bucket_bounds(LatencyHistogram.bucket_index(0.5))
+    assert lower < 0.5 == upper
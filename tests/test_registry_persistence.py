@@ -0,0 +1,22 @@
+from client_registry import ClientRegistry
+from registry_persistence import RegistryPersister, load_snapshot
+
+
+def test_journal_replay_keeps_registration_order(tmp_path):
+    registry = ClientRegistry()
+    persister = RegistryPersister(registry, str(tmp_path / 'ips.json'),
+                                  journal_path=str(tmp_path / 'ips.journal'))
+    for ip, name in [('10.0.0.1', 'pc-a'), ('10.0.0.2', 'pc-b'), ('10.0.0.3', 'pc-c')]:
+        registry.upsert(ip, name)
+    persister.flush()
+
+    registry.upsert('10.0.0.1', 'pc-a2')  # 更新不改变注册顺序
+    registry.remove('10.0.0.2')
+    registry.upsert('10.0.0.4', 'pc-d')
+    registry.upsert('10.0.0.2', 'pc-b')  # 删除后重新注册排到末尾
+    persister._write_journal()
+
+    entries, replayed = load_snapshot(persister.path, persister.journal_path)
+    assert replayed == 4
+    assert entries == registry.snapshot()
+    assert [e['ip'] for e in entries] == ['10.0.0.1', '10.0.0.3', '10.0.0.4', '10.0.0.2']
@@ -0,0 +1,39 @@
+import threading
+
+from client_registry import ClientRegistry
+from sqlite_store import READER_POOL_SIZE, SQLiteStore
+
+
+def registry_with_store(tmp_path):
+    registry = ClientRegistry()
+    store = SQLiteStore(str(tmp_path / 'clients.db'))
+    store.attach(registry)
+    for ip, name in [('10.0.0.9', 'PC-b x'), ('10.0.0.1', 'pc-a'), ('10.0.0.5', 'PC-a,1'), ('10.0.0.2', 'PC-A')]:
+        registry.upsert(ip, name)
+    registry.upsert('10.0.0.9', 'PC-bb')  # 更新不改变注册顺序
+    store.flush()
+    return registry, store
+
+
+def test_name_prefix_matches_registry(tmp_path):
+    registry, store = registry_with_store(tmp_path)
+
+    for prefix in ('PC-', 'PC-a,', 'pc', 'PC b', 'PC-A'):
+        assert store.list_clients(name_prefix=prefix) == registry.find_by_name_prefix(prefix)
+    assert [e['ip'] for e in registry.find_by_name_prefix('PC-')] == ['10.0.0.9', '10.0.0.5', '10.0.0.2']
+
+
+def test_reader_connections_are_shared_across_threads(tmp_path):
+    _, store = registry_with_store(tmp_path)
+
+    def read():
+        for _ in range(5):
+            store.list_clients(limit=2)
+
+    threads = [threading.Thread(target=read) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+        thread.join()  # 依次运行：每个新线程都应复用连接池中的连接
+
+    assert store.get_stats()['reader_connections_opened'] == 1
+    assert store._readers.qsize() <= READER_POOL_SIZE
@@ -0,0 +1,37 @@
+import pytest
+
+from udp_heartbeat import UDPHeartbeatListener, decode_heartbeat, encode_heartbeat
+
+
+def test_round_trip():
+    record = decode_heartbeat(encode_heartbeat('10.0.0.7', 'PC-7', 42, cpu=12.6, mem=None, window_count=3, boot=99))
+    assert record == {'ip': '10.0.0.7', 'pc_name': 'PC-7', 'boot': 99, 'seq': 42,
+                      'cpu': 13, 'mem': None, 'window_count': 3}
+
+
+@pytest.mark.parametrize('data', [b'', b'XX\x02\x00' + bytes(30), b'HB\x07\x00' + bytes(30),
+                                  encode_heartbeat('10.0.0.7', 'PC-7', 1)[:-2]])
+def test_decode_rejects_malformed(data):
+    with pytest.raises(ValueError):
+        decode_heartbeat(data)
+
+
+def test_restart_resets_sequence_state():
+    listener = UDPHeartbeatListener(on_batch=None)
+    accepted = [listener._track_seq('10.0.0.7', seq, boot=1) for seq in range(1, 501)]
+    # 少于 RESTART_GAP 次心跳后重启：新进程的序号从 1 重新开始
+    accepted += [listener._track_seq('10.0.0.7', seq, boot=2) for seq in range(1, 200)]
+
+    assert all(accepted)
+    assert listener.stats['restarts'] == 1
+    assert listener.stats['lost'] == 0
+    assert listener.stats['reordered'] == 0
+
+
+def test_loss_duplicates_and_reordering_within_one_boot():
+    listener = UDPHeartbeatListener(on_batch=None)
+    assert [listener._track_seq('10.0.0.7', seq, boot=1) for seq in (1, 2, 5, 5, 4)] == [
+        True, True, True, False, False]
+    assert listener.stats['duplicates'] == 1
+    assert listener.stats['reordered'] == 1
+    assert listener.stats['lost'] == 1  # 3 丢失，4 迟到后补回
@@ -0,0 +1,219 @@
+"""
+请求链路追踪模块
+在截图/OCR 流水线等耗时路径上记录分阶段的 span，按追踪 ID（请求头 X-Trace-Id，
+由主服务器下发指令时生成并沿中继转发）串联同一次下发在各节点上的处理；
+完成的追踪保存在有界内存缓冲区中，可按端点或追踪 ID 查询，
+并在响应中返回本次请求的分阶段耗时
+"""
+import itertools
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_HEADER = 'X-Trace-Id'
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Trace:
+    """一次请求的追踪记录"""
+
+    __slots__ = ('trace_id', 'endpoint', 'timestamp', 'status', 'duration', 'spans',
+                 '_started', '_ids')
+
+    def __init__(self, trace_id, endpoint):
+        self.trace_id = trace_id
+        self.endpoint = endpoint
+        self.timestamp = time.time()
+        self.status = 'ok'
+        self.duration = None
+        self.spans = []  # (span_id, parent_id, 名称, 开始偏移, 耗时, 属性)
+        self._started = time.perf_counter()
+        self._ids = itertools.count(1)
+
+    def breakdown(self):
+        """
+        按阶段名汇总耗时（毫秒），阶段按首次出现的顺序排列
+        unaccounted_ms 为总耗时中未被顶层阶段覆盖的部分
+        """
+        stages = {}
+        top_level = 0.0
+        for _, parent, name, start, duration, _ in sorted(self.spans, key=lambda s: s[3]):
+            stage = stages.setdefault(name, {'ms': 0.0, 'count': 0})
+            stage['ms'] += duration * 1000
+            stage['count'] += 1
+            if parent is None:
+                top_level += duration
+        for stage in stages.values():
+            stage['ms'] = round(stage['ms'], 2)
+        total = self.duration if self.duration is not None else time.perf_counter() - self._started
+        return {
+            'trace_id': self.trace_id,
+            'total_ms': round(total * 1000, 2),
+            'stages': stages,
+            'unaccounted_ms': round(max(0.0, total - top_level) * 1000, 2),
+        }
+
+    def server_timing(self):
+        """生成 Server-Timing 响应头（各阶段耗时，浏览器开发者工具可直接显示）"""
+        breakdown = self.breakdown()
+        parts = [f'{name};dur={stage["ms"]}' for name, stage in breakdown['stages'].items()]
+        parts.append(f'total;dur={breakdown["total_ms"]}')
+        return ', '.join(parts)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'endpoint': self.endpoint,
+            'timestamp': self.timestamp,
+            'status': self.status,
+            'duration_ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+            'spans': [
+                {'id': span_id, 'parent': parent, 'name': name,
+                 'start_ms': round(start * 1000, 2), 'duration_ms': round(duration * 1000, 2), **attrs}
+                for span_id, parent, name, start, duration, attrs in sorted(self.spans, key=lambda s: s[3])
+            ],
+        }
+
+
+class Tracer:
+    """
+    追踪器
+    当前线程没有进行中的追踪时 span() 不做任何记录，未追踪的调用开销很小
+    参数:
+        max_traces: 缓冲区保留的追踪数量
+    """
+
+    def __init__(self, max_traces=500):
+        self._local = threading.local()
+        self._traces = deque(maxlen=max_traces)
+        self._listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """注册 span 完成回调 callback(名称, 耗时秒)，如写入 performance_monitor 的阶段耗时"""
+        self._listeners.append(callback)
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    @contextmanager
+    def _activate(self, trace, parent):
+        previous = (getattr(self._local, 'trace', None), getattr(self._local, 'stack', None))
+        self._local.trace = trace
+        self._local.stack = [parent] if parent is not None else []
+        try:
+            yield
+        finally:
+            self._local.trace, self._local.stack = previous
+
+    def begin(self, endpoint, trace_id=None):
+        """在当前线程开始一次追踪（用于 before_request 等无法使用 with 的场合），需配对调用 end"""
+        trace = Trace(trace_id or new_trace_id(), endpoint)
+        self._local.trace = trace
+        self._local.stack = []
+        return trace
+
+    def end(self, trace, error=False):
+        """结束追踪并存入缓冲区，重复调用无效"""
+        if trace.duration is not None:
+            return
+        if error:
+            trace.status = 'error'
+        trace.duration = time.perf_counter() - trace._started
+        if getattr(self._local, 'trace', None) is trace:
+            self._local.trace = None
+            self._local.stack = None
+        with self.lock:
+            self._traces.append(trace)
+
+    @contextmanager
+    def trace(self, endpoint, trace_id=None):
+        """开始一次追踪（包住一段处理），结束后存入缓冲区"""
+        trace = Trace(trace_id or new_trace_id(), endpoint)
+        with self._activate(trace, None):
+            try:
+                yield trace
+            except BaseException:
+                trace.status = 'error'
+                raise
+            finally:
+                trace.duration = time.perf_counter() - trace._started
+                with self.lock:
+                    self._traces.append(trace)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """
+        记录一个阶段；可嵌套，嵌套的 span 以外层为父节点
+        with 语句得到该 span 的属性字典，可在阶段内补充结果（如投票结果）
+        """
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            yield attrs
+            return
+        stack = self._local.stack
+        span_id = next(trace._ids)
+        parent = stack[-1] if stack else None
+        stack.append(span_id)
+        started = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            duration = time.perf_counter() - started
+            stack.pop()
+            trace.spans.append((span_id, parent, name, started - trace._started, duration, attrs))
+            for callback in self._listeners:
+                try:
+                    callback(name, duration)
+                except Exception:
+                    pass
+
+    def bind(self, fn):
+        """
+        把当前追踪绑定到 fn 上，使其在其它线程（如输入队列线程）中执行时的 span
+        记到同一次追踪、以当前 span 为父节点
+        """
+        trace = self.current()
+        if trace is None:
+            return fn
+        stack = self._local.stack
+        parent = stack[-1] if stack else None
+
+        def bound(*args, **kwargs):
+            with self._activate(trace, parent):
+                return fn(*args, **kwargs)
+        return bound
+
+    def query(self, endpoint=None, trace_id=None, min_duration_ms=None, limit=20):
+        """按端点、追踪 ID 或最小耗时查询最近的追踪，最新的在前"""
+        with self.lock:
+            traces = list(self._traces)
+        result = []
+        for trace in reversed(traces):
+            if endpoint and trace.endpoint != endpoint:
+                continue
+            if trace_id and trace.trace_id != trace_id:
+                continue
+            if min_duration_ms is not None and trace.duration * 1000 < min_duration_ms:
+                continue
+            result.append(trace.to_dict())
+            if len(result) >= limit:
+                break
+        return result
+
+    def get_stats(self):
+        with self.lock:
+            traces = list(self._traces)
+        endpoints = {}
+        for trace in traces:
+            endpoints[trace.endpoint] = endpoints.get(trace.endpoint, 0) + 1
+        return {'buffered': len(traces), 'capacity': self._traces.maxlen, 'endpoints': endpoints}
+
+
+# 全局追踪器实例
+tracer = Tracer()
@@ -0,0 +1,185 @@
+"""
+UDP 心跳模块
+客户端以固定格式的小数据报发送心跳，主服务器由一个接收线程解析后按批次写入心跳表，
+省去 HTTP 心跳的线程切换、请求头解析与 JSON 编解码；HTTP 心跳仍作为后备
+
+数据报格式（网络字节序，版本 2）:
+    magic(2s) version(B) flags(B) ip(4s) boot(I) seq(I) cpu(B) mem(B) window_count(H) name_len(B) + name(UTF-8)
+    boot 为客户端进程启动时生成的随机数，seq 在每个进程中从 1 开始递增；
+    boot 变化即表示客户端已重启，接收方据此重置序号状态
+    cpu/mem 为百分比，255 表示未知；window_count 为 65535 表示未知
+版本 1（没有 boot 字段）的数据报仍可接收，重启只能按序号大幅回退来推断
+"""
+import random
+import socket
+import struct
+import threading
+import time
+
+MAGIC = b'HB'
+VERSION = 2
+HEADER = struct.Struct('!2sBB4sIIBBHB')
+HEADER_V1 = struct.Struct('!2sBB4sIBBHB')
+MAX_NAME_BYTES = 64
+UNKNOWN_PERCENT = 255
+UNKNOWN_COUNT = 65535
+
+# 本进程的启动标识，随每个心跳发送
+BOOT_ID = random.SystemRandom().getrandbits(32)
+
+
+def encode_heartbeat(ip, pc_name, seq, cpu=None, mem=None, window_count=None, boot=BOOT_ID):
+    """编码一个心跳数据报"""
+    name = (pc_name or '').encode('utf-8')[:MAX_NAME_BYTES]
+    return HEADER.pack(
+        MAGIC, VERSION, 0, socket.inet_aton(ip), boot, seq & 0xFFFFFFFF,
+        UNKNOWN_PERCENT if cpu is None else max(0, min(100, int(round(cpu)))),
+        UNKNOWN_PERCENT if mem is None else max(0, min(100, int(round(mem)))),
+        UNKNOWN_COUNT if window_count is None else max(0, min(UNKNOWN_COUNT - 1, int(window_count))),
+        len(name)
+    ) + name
+
+
+def decode_heartbeat(data):
+    """解码心跳数据报，格式不正确时抛出 ValueError；版本 1 的数据报 boot 为 None"""
+    if len(data) < 4 or data[:2] != MAGIC:
+        raise ValueError("bad magic")
+    if data[2] == VERSION:
+        header = HEADER
+    elif data[2] == 1:
+        header = HEADER_V1
+    else:
+        raise ValueError("unsupported version")
+    if len(data) < header.size:
+        raise ValueError("datagram too short")
+    if header is HEADER:
+        _, _, _, ip, boot, seq, cpu, mem, window_count, name_len = header.unpack_from(data)
+    else:
+        _, _, _, ip, seq, cpu, mem, window_count, name_len = header.unpack_from(data)
+        boot = None
+    name = data[header.size:header.size + name_len]
+    if len(name) != name_len:
+        raise ValueError("truncated name")
+    return {
+        'ip': socket.inet_ntoa(ip),
+        'pc_name': name.decode('utf-8', errors='replace'),
+        'boot': boot,
+        'seq': seq,
+        'cpu': None if cpu == UNKNOWN_PERCENT else cpu,
+        'mem': None if mem == UNKNOWN_PERCENT else mem,
+        'window_count': None if window_count == UNKNOWN_COUNT else window_count
+    }
+
+
+class UDPHeartbeatListener:
+    """
+    UDP 心跳接收器
+    参数:
+        on_batch: 回调 on_batch(records, received_at)，records 为本批次每个 IP 最新的心跳
+        host, port: 监听地址
+        batch_interval: 批量提交间隔（秒）
+    """
+
+    # 只用于版本 1 的数据报（没有 boot 字段）：序号比上次小这么多时视为客户端重启，而不是乱序
+    RESTART_GAP = 1000
+
+    def __init__(self, on_batch, host='0.0.0.0', port=5001, batch_interval=0.2):
+        self.on_batch = on_batch
+        self.host = host
+        self.port = port
+        self.batch_interval = batch_interval
+        self.lock = threading.Lock()
+        self._pending = {}     # ip -> 最新心跳
+        self._last_seq = {}    # ip -> (boot, 已收到的最大序号)
+        self._sock = None
+        self.stats = {
+            'received': 0,
+            'invalid': 0,
+            'lost': 0,
+            'reordered': 0,
+            'duplicates': 0,
+            'restarts': 0,
+            'batches': 0,
+        }
+
+    def start(self):
+        """绑定端口并启动接收与批量提交线程"""
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self._sock.bind((self.host, self.port))
+        threading.Thread(target=self._receive_loop, name="udp-heartbeat-recv", daemon=True).start()
+        threading.Thread(target=self._flush_loop, name="udp-heartbeat-flush", daemon=True).start()
+        return self
+
+    def _track_seq(self, ip, seq, boot=None):
+        """
+        更新丢包与乱序统计（调用方持有锁），返回该心跳是否比已记录的更新
+        boot 与上次不同表示客户端已重启：重置该 IP 的序号状态，不计入丢包或乱序
+        """
+        state = self._last_seq.get(ip)
+        if state is None:
+            self._last_seq[ip] = (boot, seq)
+            return True
+        last_boot, last = state
+        if boot is None and last_boot is None:
+            # 版本 1 的数据报：只能按序号大幅回退推断重启
+            restarted = seq + self.RESTART_GAP < last
+        else:
+            restarted = boot != last_boot
+        if restarted:
+            self.stats['restarts'] += 1
+            self._last_seq[ip] = (boot, seq)
+            return True
+        if seq > last:
+            self.stats['lost'] += seq - last - 1
+            self._last_seq[ip] = (boot, seq)
+            return True
+        if seq == last:
+            self.stats['duplicates'] += 1
+        else:
+            # 迟到的数据报：之前计为丢失，现在补回
+            self.stats['reordered'] += 1
+            self.stats['lost'] = max(0, self.stats['lost'] - 1)
+        return False
+
+    def _receive_loop(self):
+        while True:
+            try:
+                data, _ = self._sock.recvfrom(512)
+            except OSError:
+                continue
+            try:
+                record = decode_heartbeat(data)
+            except (ValueError, struct.error):
+                with self.lock:
+                    self.stats['invalid'] += 1
+                continue
+            with self.lock:
+                self.stats['received'] += 1
+                if self._track_seq(record['ip'], record['seq'], record['boot']):
+                    self._pending[record['ip']] = record
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.batch_interval)
+            with self.lock:
+                records, self._pending = self._pending, {}
+            if not records:
+                continue
+            try:
+                self.on_batch(list(records.values()), time.time())
+                self.stats['batches'] += 1
+            except Exception as e:
+                print(f"UDP 心跳批量写入失败: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            received = self.stats['received']
+            lost = self.stats['lost']
+            return {
+                **self.stats,
+                'port': self.port,
+                'clients': len(self._last_seq),
+                'loss_rate': round(lost / (received + lost), 4) if received + lost else 0.0,
+                'pending': len(self._pending),
+            }
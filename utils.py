@@ -11,6 +11,8 @@ import pytesseract
 import re
 import pyautogui
 
+from tracing import tracer
+
 # ==================== 系统相关函数 ====================
 
 def get_pc_name():
@@ -36,6 +38,21 @@ def get_client_ip():
             return ip
     return None
 
+def probe_local_ip(target_host="192.168.0.254", port=5000):
+    """
+    获取访问目标主机时使用的本机 IP
+    通过 UDP connect 让系统选择路由，不发送数据包也不查询 DNS，开销远小于 gethostbyname_ex
+    失败时返回 None
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((target_host, port))
+        return sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
 def simulate_keypress(key='f7', use_logging=False):
     """
     模拟按下指定的键盘按键（默认 F7）
@@ -43,15 +60,12 @@ def simulate_keypress(key='f7', use_logging=False):
         key: 按键名称
         use_logging: 是否使用日志记录
     """
-    message = f"Simulating pressing the '{key}' key..."
-    print(message)
     if use_logging:
         logging.info("模拟按键: %s", key)
-    pyautogui.press(key)
-    message2 = f"Key '{key}' pressed."
-    print(message2)
-    if use_logging:
-        logging.info("按键 '%s' 执行完毕。", key)
+    else:
+        print(f"Simulating pressing the '{key}' key...")
+    # 关闭 pyautogui 每次调用后的默认停顿（PAUSE），减少按键延迟
+    pyautogui.press(key, _pause=False)
 
 # ==================== OCR相关函数 ====================
 
@@ -60,6 +74,20 @@ def preprocess_image_multiple_methods(image, debug_dir=None, roi_index=None):
     使用多种方法预处理图像，返回多个预处理后的图像
     返回: 预处理后的图像列表 [(method_name, processed_image), ...]
     """
+    with tracer.span('preprocess'):
+        processed_images = _preprocess_methods(image)
+    
+    # 保存调试图像
+    if debug_dir and roi_index is not None:
+        with tracer.span('debug_write'):
+            os.makedirs(debug_dir, exist_ok=True)
+            for method_name, proc_img in processed_images:
+                debug_path = os.path.join(debug_dir, f"roi_{roi_index}_{method_name}.png")
+                cv2.imwrite(debug_path, proc_img)
+    
+    return processed_images
+
+def _preprocess_methods(image):
     processed_images = []
     
     # 转换为灰度图
@@ -130,13 +158,6 @@ def preprocess_image_multiple_methods(image, debug_dir=None, roi_index=None):
     sharpened = cv2.filter2D(enhanced1, -1, kernel_sharpen)
     processed_images.append(("sharpened", sharpened))
     
-    # 保存调试图像
-    if debug_dir and roi_index is not None:
-        os.makedirs(debug_dir, exist_ok=True)
-        for method_name, proc_img in processed_images:
-            debug_path = os.path.join(debug_dir, f"roi_{roi_index}_{method_name}.png")
-            cv2.imwrite(debug_path, proc_img)
-    
     return processed_images
 
 def ocr_with_multiple_configs(image):
@@ -158,8 +179,9 @@ def ocr_with_multiple_configs(image):
     for config_name, config_str in psm_configs:
         try:
             # 获取文本和置信度
-            data = pytesseract.image_to_data(image, config=config_str, output_type=pytesseract.Output.DICT)
-            text = pytesseract.image_to_string(image, config=config_str).strip()
+            with tracer.span('tesseract', config=config_name):
+                data = pytesseract.image_to_data(image, config=config_str, output_type=pytesseract.Output.DICT)
+                text = pytesseract.image_to_string(image, config=config_str).strip()
             
             # 计算平均置信度
             confidences = [int(conf) for conf in data['conf'] if int(conf) > 0]